@@ -16,6 +16,8 @@ controller_dict = {'random':1,'nelder_mead':2,'gaussian_process':3,'differential
 number_of_controllers = len(controller_dict)
 default_controller_archive_filename = 'controller_archive'
 default_controller_archive_file_type = 'txt'
+#Archive keys holding the history of the runs, which are written to the journal rather than the summary of a journaled archive
+journal_keys = ['out_params','out_type','out_extras','in_costs','in_uncers','in_bads','in_extras','in_run_indexs']
 
 class ControllerInterrupt(Exception):
     '''
@@ -72,9 +74,12 @@ class Controller():
         target_cost (Optional [float]): The target cost for the run. If a run achieves a cost lower than the target, the controller is stopped. Default float('-inf'), meaning the controller will run until another condition is met.
         max_num_runs_without_better_params (Optional [float]): Puts a limit on the number of runs are allowed before a new better set of parameters is found. Default float('inf'), meaning the controller will run until another condition is met.
         controller_archive_filename (Optional [string]): Filename for archive. Contains costs, parameter history and other details depending on the controller type. Default 'ControllerArchive.mat'
-        controller_archive_file_type (Optional [string]): File type for archive. Can be either 'txt' a human readable text file, 'pkl' a python dill file, 'mat' a matlab file or None if there is no archive. Default 'mat'.
+        controller_archive_file_type (Optional [string]): File type for archive. Can be either 'txt' a human readable text file, 'pkl' a python dill file, 'mat' a matlab file, 'h5' an HDF5 file or None if there is no archive. Default 'mat'.
         archive_extra_dict (Optional [dict]): A dictionary with any extra variables that are to be saved to the archive. If None, nothing is added. Default None.
+        controller_archive_journal (Optional [bool]): If True the archive is journaled. Each set of parameters sent to the experiment and each cost received is appended as a line to a journal file next to the archive, and the archive itself is only rewritten every controller_archive_summary_interval runs as a summary without the history of the runs. The complete archive is written when the controller ends. Use mlu.get_controller_archive_dict to load an archive that may be a summary. This avoids rewriting the whole history on every run. Default False.
+        controller_archive_summary_interval (Optional [int]): Number of costs received between rewrites of the summary when the archive is journaled. Default 50.
         start_datetime (Optional datetime): Datetime for when controller was started.
+        max_in_flight (Optional [int]): The maximum number of parameter sets that can be sent to the experiment before their costs have been returned. Costs are matched back to the parameters that produced them and are passed to the learners in the order they complete. Learners that need the cost of every run before suggesting the next one (random, Nelder–Mead and differential evolution) only ever have one parameter set in flight, the machine learning controllers can have a whole generation in flight. If None, it is set to the number of runs the interface can evaluate at the same time: the batch_size of a BatchInterface, the num_workers of a ParallelShellInterface and 1 otherwise. Default None.
     Attributes:
         params_out_queue (queue): Queue for parameters to next be run by experiment.
         costs_in_queue (queue): Queue for costs (and other details) that have been returned by experiment.
@@ -89,6 +94,8 @@ class Controller():
         out_extras (list): Any extras associated with the output parameters.
         in_costs (list): List of costs received by controller.
         in_uncers (list): List of uncertainties received by controller.
+        in_run_indexs (list): For each cost received, the index in out_params of the parameters that produced it.
+        in_flight (dict): Parameters (and their type) sent to the experiment whose costs have not been returned yet, keyed by run index.
         best_cost (float): The lowest, and best, cost received by the learner.
         best_uncer (float): The uncertainty associated with the best cost.
         best_params (array): The best parameters received by the learner.
@@ -102,7 +109,10 @@ class Controller():
                  controller_archive_filename=default_controller_archive_filename,
                  controller_archive_file_type=default_controller_archive_file_type,
                  archive_extra_dict = None,
+                 controller_archive_journal = False,
+                 controller_archive_summary_interval = 50,
                  start_datetime = None,
+                 max_in_flight = None,
                  **kwargs):
 
         #Make logger
@@ -120,6 +130,7 @@ class Controller():
         self.in_uncers = []
         self.in_bads = []
         self.in_extras = []
+        self.in_run_indexs = []
         self.best_cost = float('inf')
         self.best_uncer = float('nan')
         self.best_index = float('nan')
@@ -132,6 +143,10 @@ class Controller():
         self.curr_uncer = None
         self.curr_bad = None
         self.curr_extras = None
+        self.curr_run_index = None
+        self.curr_param_type = None
+        self.curr_sent_to_learner = True
+        self.in_flight = {}
 
         #Constants
         self.controller_wait = float(1)
@@ -169,6 +184,16 @@ class Controller():
         if self.max_num_runs_without_better_params<=0:
             self.log.error('Max number of repeats must be greater than zero. max_num_runs:'+repr(max_num_runs_without_better_params))
             raise ValueError
+        if max_in_flight is None:
+            max_in_flight = interface.max_parallel_runs
+        self.max_in_flight = int(max_in_flight)
+        if self.max_in_flight<=0:
+            self.log.error('Maximum number of runs in flight must be greater than zero. max_in_flight:'+repr(max_in_flight))
+            raise ValueError
+        # Only the machine learning controllers send the next parameters
+        # before the last cost has been returned, so the interface otherwise
+        # only ever has one run to evaluate.
+        self.interface.max_in_flight = 1
 
         if mlu.check_file_type_supported(controller_archive_file_type):
             self.controller_archive_file_type = controller_archive_file_type
@@ -196,6 +221,17 @@ class Controller():
             if not os.path.exists(archive_dir):
                 os.makedirs(archive_dir)
 
+        self.controller_archive_journal = bool(controller_archive_journal) and (self.controller_archive_filename is not None)
+        self.controller_archive_summary_interval = int(controller_archive_summary_interval)
+        if self.controller_archive_summary_interval<=0:
+            self.log.error('Summary interval must be greater than zero. controller_archive_summary_interval:'+repr(controller_archive_summary_interval))
+            raise ValueError
+        self.journal_file = None
+        self.num_in_costs_at_summary = None
+        self.archive_writer = None
+        if self.controller_archive_journal:
+            self.total_journal_filename = os.path.splitext(self.total_archive_filename)[0] + '.journal'
+
         self.archive_dict = {'mloop_version':__version__,
                              'archive_type':'controller',
                              'num_out_params':self.num_out_params,
@@ -206,12 +242,17 @@ class Controller():
                              'in_uncers':self.in_uncers,
                              'in_bads':self.in_bads,
                              'in_extras':self.in_extras,
+                             'in_run_indexs':self.in_run_indexs,
                              'max_num_runs':self.max_num_runs,
+                             'max_in_flight':self.max_in_flight,
                              'start_datetime':mlu.datetime_to_string(self.start_datetime)}
 
         if archive_extra_dict is not None:
             self.archive_dict.update(archive_extra_dict)
 
+        if self.controller_archive_journal:
+            self.archive_dict['journal_filename'] = os.path.basename(self.total_journal_filename)
+
         self.log.debug('Controller init completed.')
 
     def check_end_conditions(self):
@@ -246,21 +287,30 @@ class Controller():
         Keyword Args:
             **kwargs: any additional data to be attached to file sent to experiment
         '''
+        run_index = self.num_out_params
         out_dict = {'params':params}
         out_dict.update(kwargs)
+        out_dict[mli.run_index_key] = run_index
         self.params_out_queue.put(out_dict)
+        self.in_flight[run_index] = (params, param_type)
         self.num_out_params += 1
         self.last_out_params = params
         self.out_params.append(params)
         self.out_extras.append(kwargs)
         if param_type is not None:
             self.out_type.append(param_type)
+        self._write_journal_record(record='out',
+                                   run_index=run_index,
+                                   params=params,
+                                   param_type=param_type,
+                                   extras=kwargs)
         self.log.info('params ' + str(params))
         #self.log.debug('Put params num:' + repr(self.num_out_params ))
 
     def _get_cost_and_in_dict(self):
         '''
         Get cost, uncertainty, parameters, bad and extra data from experiment. Stores in a list of history and also puts variables in their appropriate 'current' variables
+        The cost is matched to the parameters in flight that produced it using the run index returned by the interface. If the interface does not return a run index the oldest parameters in flight are used.
         Note returns nothing, stores everything in the internal storage arrays and the curr_variables
         '''
         while True:
@@ -274,6 +324,16 @@ class Controller():
         self.num_in_costs += 1
         self.num_last_best_cost += 1
 
+        run_index = in_dict.pop(mli.run_index_key, None)
+        if run_index not in self.in_flight:
+            if not self.in_flight:
+                self.log.error('Received a cost but there are no parameters in flight.')
+                raise ValueError
+            run_index = min(self.in_flight)
+        (self.curr_params, self.curr_param_type) = self.in_flight.pop(run_index)
+        self.curr_run_index = run_index
+        self.curr_sent_to_learner = False
+
         if not ('cost' in in_dict) and (not ('bad' in in_dict) or not in_dict['bad']):
             self.log.error('You must provide at least the key cost or the key bad with True.')
             raise ValueError
@@ -292,7 +352,13 @@ class Controller():
         self.in_uncers.append(self.curr_uncer)
         self.in_bads.append(self.curr_bad)
         self.in_extras.append(self.curr_extras)
-        self.curr_params = self.last_out_params
+        self.in_run_indexs.append(self.curr_run_index)
+        self._write_journal_record(record='in',
+                                   run_index=self.curr_run_index,
+                                   cost=self.curr_cost,
+                                   uncer=self.curr_uncer,
+                                   bad=self.curr_bad,
+                                   extras=self.curr_extras)
         if self.curr_cost < self.best_cost:
             self.best_cost = self.curr_cost
             self.best_uncer = self.curr_uncer
@@ -305,9 +371,26 @@ class Controller():
             self.log.info('cost ' + str(self.curr_cost) + ' +/- ' + str(self.curr_uncer))
         #self.log.debug('Got cost num:' + repr(self.num_in_costs))
 
-    def save_archive(self):
+    def _write_journal_record(self, **record):
+        '''
+        Append a record to the journal of the archive, if the archive is journaled. The journal is flushed after every record so it is complete up to the last run even if the controller does not end cleanly.
+        Keyword Args:
+            **record: The values to be written on one line of the journal.
+        '''
+        if not self.controller_archive_journal:
+            return
+        if self.journal_file is None:
+            self.journal_file = open(self.total_journal_filename, 'w')
+        self.journal_file.write(mlu.dict_to_txt_line(record) + '\n')
+        self.journal_file.flush()
+
+    def save_archive(self, full=False):
         '''
         Save the archive associated with the controller class. Only occurs if the filename for the archive is not None. Saves with the format previously set.
+        The archive is written by a background mlu.ArchiveWriter so the controller does not wait for it, and is flushed when the controller shuts down.
+        If the archive is journaled, the history of the runs is already in the journal, so only a summary without it is saved, and only once every controller_archive_summary_interval runs.
+        Keyword Args:
+            full (Optional [bool]): If True the complete archive is saved even if it is journaled. Default False.
         '''
         if self.controller_archive_filename is not None:
             self.archive_dict.update({'num_in_costs':self.num_in_costs,
@@ -316,8 +399,19 @@ class Controller():
                                       'best_uncer':self.best_uncer,
                                       'best_params':self.best_params,
                                       'best_index':self.best_index})
+            if self.controller_archive_journal:
+                self.archive_dict['archive_is_summary'] = not full
+            if self.controller_archive_journal and not full:
+                if (self.num_in_costs_at_summary is not None) and (self.num_in_costs < self.num_in_costs_at_summary + self.controller_archive_summary_interval):
+                    return
+                self.num_in_costs_at_summary = self.num_in_costs
+                archive_dict = {key:value for key, value in self.archive_dict.items() if key not in journal_keys}
+            else:
+                archive_dict = self.archive_dict
+            if self.archive_writer is None:
+                self.archive_writer = mlu.ArchiveWriter(self.total_archive_filename,self.controller_archive_file_type)
             try:
-                mlu.save_dict_to_file(self.archive_dict,self.total_archive_filename,self.controller_archive_file_type)
+                self.archive_writer.save(archive_dict)
             except ValueError:
                 self.log.error('Attempted to save with unknown archive file type, or some other value error.')
                 raise
@@ -355,6 +449,11 @@ class Controller():
         '''
         Start the learner and interface threads/processes.
         '''
+        # Controllers with a single learner record its type once, before any
+        # parameters are sent, so it is journaled separately.
+        for param_type in self.out_type:
+            self._write_journal_record(record='type',
+                                       param_type=param_type)
         self.learner.start()
         self.interface.start()
 
@@ -373,7 +472,12 @@ class Controller():
         self.log.debug('Learner joined.')
         self.interface.join()
         self.log.debug('Interface joined.')
-        self.save_archive()
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+        self.save_archive(full=True)
+        if self.archive_writer is not None:
+            self.archive_writer.close()
 
     def print_results(self):
         '''
@@ -435,6 +539,30 @@ class Controller():
             self.curr_bad,
         )
         self.learner_costs_queue.put(message)
+        self.curr_sent_to_learner = True
+
+    def _pipeline_has_space(self):
+        '''
+        Check whether another set of parameters can be sent to the experiment.
+        Returns:
+            bool : True if fewer than max_in_flight runs are in flight and sending another run would not exceed max_num_runs.
+        '''
+        return (len(self.in_flight) < self.max_in_flight) and (self.num_out_params < self.max_num_runs)
+
+    def _get_returned_costs(self):
+        '''
+        Get the cost of the next run to complete, waiting if necessary, followed by the costs of any other runs in flight that have already been returned. All the cost dicts of a batch are therefore ingested before the pipeline is refilled.
+        '''
+        self._get_cost_and_in_dict()
+        while self.in_flight and not self.costs_in_queue.empty():
+            self._get_cost_and_in_dict()
+
+    def _get_in_flight_costs(self):
+        '''
+        Wait for the costs of all the runs still in flight, so that every set of parameters sent to the experiment has its cost recorded.
+        '''
+        while self.in_flight:
+            self._get_cost_and_in_dict()
 
     def _next_params(self):
         '''
@@ -511,6 +639,7 @@ class MachineLearnerController(Controller):
         training_type (Optional [string]): The type for the initial training source can be 'random' for the random learner, 'nelder_mead' for the Nelder–Mead learner or 'differential_evolution' for the Differential Evolution learner. This learner is also called if the machine learning learner is too slow and a new point is needed. Default 'differential_evolution'.
         num_training_runs (Optional [int]): The number of training runs to before starting the learner. If None, will be ten or double the number of parameters, whatever is larger.
         no_delay (Optional [bool]): If True, there is never any delay between a returned cost and the next parameters to run for the experiment. In practice, this means if the machine learning learner has not prepared the next parameters in time the learner defined by the initial training source is used instead. If false, the controller will wait for the machine learning learner to predict the next parameters and there may be a delay between runs.
+        shared_run_store (Optional [bool]): If True, the costs are passed to the machine learning learner through a SharedRunStore in shared memory, which the learner reads without copying or unpickling each run, rather than through a queue. Falls back to the queue if shared memory is not available (python < 3.8). Default True.
     '''
 
     def __init__(self, interface,
@@ -518,6 +647,7 @@ class MachineLearnerController(Controller):
                  machine_learner_type='machine_learner',
                  num_training_runs=None,
                  no_delay=True,
+                 shared_run_store=True,
                  num_params=None,
                  min_boundary=None,
                  max_boundary=None,
@@ -528,11 +658,11 @@ class MachineLearnerController(Controller):
                  **kwargs):
 
         super(MachineLearnerController,self).__init__(interface, **kwargs)
+        self.interface.max_in_flight = self.max_in_flight
         self.machine_learner_type = machine_learner_type
 
         self.last_training_cost = None
         self.last_training_bad = None
-        self.last_training_run_flag = False
 
         if num_training_runs is None:
             if num_params is None:
@@ -545,6 +675,8 @@ class MachineLearnerController(Controller):
             self.log.error('Number of training runs must be larger than zero:'+repr(self.num_training_runs))
             raise ValueError
         self.no_delay = bool(no_delay)
+        self.shared_run_store = bool(shared_run_store)
+        self.run_store = None
 
         self.training_type = str(training_type)
         if self.training_type == 'random':
@@ -596,27 +728,37 @@ class MachineLearnerController(Controller):
         self.remaining_kwargs = self.ml_learner.remaining_kwargs
         self.generation_num = self.ml_learner.generation_num
         self.start_index = self.ml_learner.costs_count
+        if self.shared_run_store:
+            if mlu.shared_memory is None:
+                self.log.debug('Shared memory not available, sending costs to the machine learner through a queue.')
+            else:
+                self.run_store = mlu.SharedRunStore(self.ml_learner.num_params)
+                self.ml_learner.run_store = self.run_store
 
     def _put_params_and_out_dict(self, params):
         '''
-        Override _put_params_and_out_dict function, used when the training learner creates parameters. Makes the default param_type the training type and sets last_training_run_flag.
+        Override _put_params_and_out_dict function, used when the training learner creates parameters. Makes the default param_type the training type.
         '''
         super(MachineLearnerController,self)._put_params_and_out_dict(params, param_type=self.training_type)
-        self.last_training_run_flag = True
 
     def _get_cost_and_in_dict(self):
         '''
         Call _get_cost_and_in_dict() of parent Controller class. But also sends cost to machine learning learner and saves the cost if the parameters came from a trainer.
         '''
         super(MachineLearnerController,self)._get_cost_and_in_dict()
-        if self.last_training_run_flag:
+        if self.curr_param_type == self.training_type:
             self.last_training_cost = self.curr_cost
             self.last_training_bad = self.curr_bad
-            self.last_training_run_flag = False
-        self.ml_learner_costs_queue.put((self.curr_params,
-                                         self.curr_cost,
-                                         self.curr_uncer,
-                                         self.curr_bad))
+        if self.run_store is not None:
+            self.run_store.append(self.curr_params,
+                                  self.curr_cost,
+                                  self.curr_uncer,
+                                  self.curr_bad)
+        else:
+            self.ml_learner_costs_queue.put((self.curr_params,
+                                             self.curr_cost,
+                                             self.curr_uncer,
+                                             self.curr_bad))
 
     def _start_up(self):
         '''
@@ -667,26 +809,36 @@ class MachineLearnerController(Controller):
             ml_count = 0
 
         while self.check_end_conditions():
-            run_num = self.num_in_costs + 1
-            if ml_consec==self.generation_num or (self.no_delay and self.ml_learner_params_queue.empty()):
-                self.log.info('Run:' + str(self.start_index + run_num) + ' (trainer)')
-                next_params = self._next_params()
-                self._put_params_and_out_dict(next_params)
-                ml_consec = 0
-            else:
-                self.log.info('Run:' + str(self.start_index + run_num) + ' (machine learner)')
-                next_params = self.ml_learner_params_queue.get()
-                super(MachineLearnerController,self)._put_params_and_out_dict(next_params, param_type=self.machine_learner_type)
-                ml_consec += 1
-                ml_count += 1
+            # Keep up to max_in_flight runs with the experiment. Stop filling
+            # the pipeline when the next parameters can only be produced once
+            # another cost has been returned.
+            while self._pipeline_has_space():
+                run_num = self.num_out_params + 1
+                if ml_consec==self.generation_num or (self.no_delay and self.ml_learner_params_queue.empty()):
+                    if self.in_flight and self.curr_sent_to_learner:
+                        break
+                    self.log.info('Run:' + str(self.start_index + run_num) + ' (trainer)')
+                    next_params = self._next_params()
+                    self._put_params_and_out_dict(next_params)
+                    ml_consec = 0
+                else:
+                    if self.in_flight and self.ml_learner_params_queue.empty():
+                        break
+                    self.log.info('Run:' + str(self.start_index + run_num) + ' (machine learner)')
+                    next_params = self.ml_learner_params_queue.get()
+                    super(MachineLearnerController,self)._put_params_and_out_dict(next_params, param_type=self.machine_learner_type)
+                    ml_consec += 1
+                    ml_count += 1
 
             self.save_archive()
-            self._get_cost_and_in_dict()
+            self._get_returned_costs()
 
-            if ml_count==self.generation_num:
+            if ml_count>=self.generation_num:
                 self.new_params_event.set()
                 ml_count = 0
 
+        self._get_in_flight_costs()
+
 
 
     def _shut_down(self):
@@ -695,7 +847,12 @@ class MachineLearnerController(Controller):
         '''
         self.log.debug('ML learner end set.')
         self.end_ml_learner.set()
-        self.ml_learner.join()
+        try:
+            self.ml_learner.join()
+        finally:
+            # Free the shared memory even if the learner could not be joined.
+            if self.run_store is not None:
+                self.run_store.close()
 
         self.log.debug('ML learner joined')
         last_dict = None
@@ -770,6 +927,11 @@ class GaussianProcessController(MachineLearnerController):
                                                        param_names=param_names,
                                                        **kwargs)
 
+        if self.remaining_kwargs.get('batch_acquisition', False) and self.remaining_kwargs.get('generation_num') is None:
+            # Find batches large enough to keep every run in flight busy, and
+            # no smaller than the learner's default generation of 4.
+            self.remaining_kwargs['generation_num'] = max(4, self.max_in_flight)
+
         self.ml_learner = mll.GaussianProcessLearner(start_datetime=self.start_datetime,
                                                      num_params=num_params,
                                                      min_boundary=min_boundary,
@@ -6,7 +6,6 @@ __metaclass__ = type
 
 import time
 import subprocess as sp
-import numpy as np
 import os
 import sys
 import threading
@@ -15,13 +14,18 @@ import mloop.utilities as mlu
 import mloop.testing as mlt
 import logging
 
+# Key used to tag each params dict and the cost dict returned for it with the
+# index of the run, so the controller can match costs to the parameters that
+# produced them when several runs are in flight.
+run_index_key = 'run_index'
+
 def create_interface(interface_type='file', 
                       **interface_config_dict):
     '''
     Start a new interface with the options provided.
     
     Args:
-        interface_type (Optional [str]): Defines the type of interface, can be 'file', 'shell' or 'test'. Default 'file'.
+        interface_type (Optional [str]): Defines the type of interface, can be 'file', 'shell', 'parallel_shell' or 'test'. Default 'file'.
         **interface_config_dict : Options to be passed to interface.
         
     Returns:
@@ -35,6 +39,9 @@ def create_interface(interface_type='file',
     elif interface_type == 'shell':
         interface = ShellInterface(**interface_config_dict)
         log.info('Using the command line interface with the experiment.')
+    elif interface_type == 'parallel_shell':
+        interface = ParallelShellInterface(**interface_config_dict)
+        log.info('Using the parallel command line interface with the experiment.')
     elif interface_type == 'test':
         interface = TestInterface(**interface_config_dict)
         log.info('Using the test interface with the experiment.')
@@ -89,6 +96,9 @@ class Interface(threading.Thread):
         if self.interface_wait<=0:
             self.log.error('Interface wait time must be a positive number.')
             raise ValueError
+        
+        #Number of runs the interface can evaluate at the same time, used by the controller as the default for max_in_flight
+        self.max_parallel_runs = 1
     
     def run(self):
         '''
@@ -103,7 +113,10 @@ class Interface(threading.Thread):
                 except mlu.empty_exception:
                     continue
                 else:
+                    run_index = params_dict.pop(run_index_key, None)
                     cost_dict = self.get_next_cost_dict(params_dict)
+                    if run_index is not None:
+                        cost_dict[run_index_key] = run_index
                     self.costs_in_queue.put(cost_dict)
         except InterfaceInterrupt:
             pass
@@ -121,6 +134,87 @@ class Interface(threading.Thread):
             cost_dict (dictionary): The cost and other properties derived from the experiment when it was run with the parameters. If just a cost was produced provide {'cost':[float]}, if you also have an uncertainty provide {'cost':[float],'uncer':[float]}. If the run was bad you can simply provide {'bad':True}. For completeness you can always provide all three using {'cost':[float],'uncer':[float],'bad':[bool]}. Providing any extra keys will also be saved byt he controller.
         '''
         pass
+
+class BatchInterface(Interface):
+    '''
+    A abstract class for interfaces that can evaluate several sets of parameters in one call, for example by running several traps or sequential sub-shots in one experimental cycle. Inherits from Interface.
+    
+    Collects up to batch_size parameter dicts from the params_out_queue, evaluates them together with get_next_cost_dicts and puts each of the returned cost dicts on the costs_in_queue. Machine learning controllers given a batch interface keep batch_size runs in flight by default, so a full batch is ready whenever the experiment is. The random, Nelder-Mead and differential evolution controllers need each cost before they suggest the next parameters, so they only ever send batches of one.
+    
+    Keyword Args:
+        batch_size (Optional [int]): Maximum number of parameter sets evaluated in one call of get_next_cost_dicts. Default 1.
+        batch_wait (Optional [float]): Time in seconds to wait for further parameters once the first parameters of a batch have been received. If they do not arrive in time a smaller batch is run. Default 0.1.
+    '''
+    
+    def __init__(self,
+                 batch_size = 1,
+                 batch_wait = 0.1,
+                 **kwargs):
+        
+        super(BatchInterface,self).__init__(**kwargs)
+        
+        self.batch_size = int(batch_size)
+        if self.batch_size<=0:
+            self.log.error('Batch size must be greater than zero:' + repr(batch_size))
+            raise ValueError
+        self.max_parallel_runs = self.batch_size
+        #Number of runs the controller keeps in flight, set by the controller. No batch can be larger than this.
+        self.max_in_flight = self.batch_size
+        self.batch_wait = float(batch_wait)
+        if self.batch_wait<0:
+            self.log.error('Batch wait time must not be negative:' + repr(batch_wait))
+            raise ValueError
+        
+    def run(self):
+        '''
+        The run sequence for the batch interface. This method does not need to be overloaded create a working interface.
+        
+        '''
+        self.log.debug('Entering main loop of batch interface.')
+        try:
+            while not self.end_event.is_set():
+                try:
+                    params_dicts = [self.params_out_queue.get(True, self.interface_wait)]
+                except mlu.empty_exception:
+                    continue
+                # Don't wait for parameters the controller will only send once
+                # it has the costs of this batch.
+                while len(params_dicts) < min(self.batch_size, self.max_in_flight):
+                    try:
+                        params_dicts.append(self.params_out_queue.get(True, self.batch_wait))
+                    except mlu.empty_exception:
+                        break
+                run_indexs = [params_dict.pop(run_index_key, None) for params_dict in params_dicts]
+                self.log.debug('Evaluating batch of ' + repr(len(params_dicts)) + ' parameter sets.')
+                cost_dicts = self.get_next_cost_dicts(params_dicts)
+                if len(cost_dicts) != len(params_dicts):
+                    self.log.error('get_next_cost_dicts must return one cost dict for each params dict. Received ' + repr(len(cost_dicts)) + ' for ' + repr(len(params_dicts)) + '.')
+                    raise ValueError
+                for run_index, cost_dict in zip(run_indexs, cost_dicts):
+                    if run_index is not None:
+                        cost_dict[run_index_key] = run_index
+                    self.costs_in_queue.put(cost_dict)
+        except InterfaceInterrupt:
+            pass
+        self.log.debug('Interface ended')
+    
+    def get_next_cost_dicts(self,params_dicts):
+        '''
+        Abstract method. This is the only method that needs to be implemented to make a working batch interface. Given a list of parameter dicts the interface must produce a cost dict for each of them, in the same order. If you wish to abruptly end this interface for whatever reason please raise the exception InterfaceInterrupt, which will then be safely caught.
+        
+        Args:
+            params_dicts (list): A list of at most batch_size dictionaries containing the parameters. Use params_dict['params'] to access them.
+        
+        Returns:
+            cost_dicts (list): A list with one cost dict for each of the params dicts, in the same order. Each cost dict has the same format as the one returned by Interface.get_next_cost_dict.
+        '''
+        pass
+    
+    def get_next_cost_dict(self,params_dict):
+        '''
+        Evaluates a single set of parameters as a batch of size one.
+        '''
+        return self.get_next_cost_dicts([params_dict])[0]
     
 class FileInterface(Interface):
     '''
@@ -134,12 +228,16 @@ class FileInterface(Interface):
         interface_out_filename (Optional [string]): filename for file written with parameters.
         interface_in_filename (Optional [string]): filename for file written with parameters.
         interface_file_type (Optional [string]): file type to be written either 'mat' for matlab or 'txt' for readable text file. Defaults to 'txt'.
+        watch_in_file (Optional [bool]): If True the interface is woken as soon as the experiment has finished writing the file with the costs, using inotify on Linux. The file must be closed once it is complete, or written elsewhere and moved into place. If inotify is not available the interface falls back to polling every interface_wait seconds. If False the interface polls. Default False.
+        atomic_file_handoff (Optional [bool]): If True both the interface and the experiment must write each file under a temporary name in the same folder, and then rename it, so a file is complete as soon as it appears. The interface then reads the file from the experiment immediately rather than waiting for it to be written. Default False.
     '''
     
     def __init__(self,
                  interface_out_filename=mlu.default_interface_out_filename, 
                  interface_in_filename=mlu.default_interface_in_filename,
                  interface_file_type=mlu.default_interface_file_type,
+                 watch_in_file=False,
+                 atomic_file_handoff=False,
                  **kwargs):
         
         super(FileInterface,self).__init__(**kwargs)
@@ -156,6 +254,30 @@ class FileInterface(Interface):
         self.total_out_filename = self.out_filename + '.' + self.out_file_type
         self.in_filename = str(interface_in_filename)
         self.total_in_filename = self.in_filename + '.' + self.in_file_type
+        
+        self.atomic_file_handoff = bool(atomic_file_handoff)
+        if self.atomic_file_handoff:
+            self.in_file_write_wait = 0
+        else:
+            self.in_file_write_wait = mlu.filewrite_wait
+        
+        if watch_in_file:
+            self.in_file_watcher = mlu.FileWatcher(self.total_in_filename, write_wait=self.in_file_write_wait)
+            if not self.in_file_watcher.inotify:
+                self.log.warning('Unable to watch ' + self.total_in_filename + ', polling for it instead.')
+        else:
+            self.in_file_watcher = None
+    
+    def run(self):
+        '''
+        The run sequence for the file interface. Runs the main loop of the interface and then stops watching for the file.
+        
+        '''
+        try:
+            super(FileInterface,self).run()
+        finally:
+            if self.in_file_watcher is not None:
+                self.in_file_watcher.close()
 
     def get_next_cost_dict(self,params_dict):
         '''
@@ -164,10 +286,16 @@ class FileInterface(Interface):
         self.out_file_count += 1
         self.log.debug('Writing out_params to file. Count:' + repr(self.out_file_count))
         self.last_params_dict = params_dict
-        mlu.save_dict_to_file(self.last_params_dict,self.total_out_filename,self.out_file_type)
+        mlu.save_dict_to_file(self.last_params_dict,self.total_out_filename,self.out_file_type,atomic=self.atomic_file_handoff)
         while not self.end_event.is_set():
-            if os.path.isfile(self.total_in_filename):
-                time.sleep(mlu.filewrite_wait) #wait for file to be written to disk
+            if self.in_file_watcher is not None:
+                in_file_ready = self.in_file_watcher.wait(self.interface_wait)
+            elif os.path.isfile(self.total_in_filename):
+                time.sleep(self.in_file_write_wait) #wait for file to be written to disk
+                in_file_ready = True
+            else:
+                in_file_ready = False
+            if in_file_ready:
                 try:
                     in_dict = mlu.get_dict_from_file(self.total_in_filename, self.in_file_type)
                 except IOError:
@@ -180,7 +308,7 @@ class FileInterface(Interface):
                 self.in_file_count += 1
                 self.log.debug('Putting dict from file onto in queue. Count:' + repr(self.in_file_count))
                 break
-            else:
+            elif self.in_file_watcher is None:
                 time.sleep(self.interface_wait)
         else:
             raise InterfaceInterrupt
@@ -247,12 +375,14 @@ class ShellInterface(Interface):
             
             Default 'direct'.
         param_names (Optional [string]): List of names for parameters to be passed as options to the shell command, replacing --param1, --param2, etc. Default None
+        persistent_worker (Optional [bool]): If True the command is only run once, and the program is then kept running as a worker which is sent the parameters for each run as a single line on its standard input, in the style set by params_args_type (for example '7 5 9' or '--param1 7 --param2 5 --param3 9'). For each line it must print the cost between M-LOOP_start and M-LOOP_end as usual and flush its output, the first M-LOOP_end line completes the run. This avoids paying the start up time of the program for every run. The worker's standard input is closed when the interface ends. Default False.
     '''
     
     def __init__(self,
                  command = './run_exp',
                  params_args_type = 'direct',
                  param_names = None,
+                 persistent_worker = False,
                  **kwargs):
         
         super(ShellInterface,self).__init__(param_names=param_names,**kwargs)
@@ -265,9 +395,25 @@ class ShellInterface(Interface):
             self.log.error('params_args_type not recognized: ' + repr(params_args_type))
         
         self.param_names = param_names
+        self.persistent_worker = bool(persistent_worker)
+        
+        #Persistent worker processes, one for each thread that runs commands
+        self.workers = []
+        self.workers_lock = threading.Lock()
+        self.thread_workers = threading.local()
         
         #Counters
         self.command_count = 0
+    
+    def run(self):
+        '''
+        The run sequence for the shell interface. Runs the main loop of the interface and then stops any persistent workers.
+        
+        '''
+        try:
+            super(ShellInterface,self).run()
+        finally:
+            self._stop_workers()
         
     def get_next_cost_dict(self,params_dict):
         '''
@@ -277,30 +423,141 @@ class ShellInterface(Interface):
         self.log.debug('Running command count' + repr(self.command_count))
         self.last_params_dict = params_dict
         
-        params = params_dict['params'] 
+        #execute command and look at output
+        cli_return = self._run_command(params_dict['params'])
+        print(cli_return)
+        
+        return self._get_cost_dict_from_output(cli_return)
+    
+    def _run_command(self,params):
+        '''
+        Run the experiment with the parameters provided, either by executing the command or by sending the parameters to a persistent worker.
+        
+        Args:
+            params (array): The parameters to be passed to the experiment.
+        
+        Returns:
+            cli_return (str): The output of the experiment.
+        '''
+        if self.persistent_worker:
+            return self._run_worker(params)
+        curr_command = self.command + self._get_params_string(params)
+        return sp.check_output(curr_command.split()).decode(sys.stdout.encoding)
+    
+    def _run_worker(self,params):
+        '''
+        Send the parameters to the persistent worker of the current thread, starting it if needed, and read its output up to the first M-LOOP_end line.
+        
+        Args:
+            params (array): The parameters to be passed to the worker.
+        
+        Returns:
+            cli_return (str): The output of the worker for these parameters.
+        '''
+        worker = getattr(self.thread_workers, 'worker', None)
+        if worker is None:
+            self.log.debug('Starting persistent worker: ' + self.command)
+            worker = sp.Popen(self.command.split(), stdin=sp.PIPE, stdout=sp.PIPE, universal_newlines=True)
+            self.thread_workers.worker = worker
+            with self.workers_lock:
+                self.workers.append(worker)
+        try:
+            worker.stdin.write(self._get_params_string(params).strip() + '\n')
+            worker.stdin.flush()
+        except IOError:
+            self.log.error('Unable to send parameters to persistent worker. Return code:' + repr(worker.poll()))
+            self._discard_worker(worker)
+            raise
+        lines = []
+        while True:
+            line = worker.stdout.readline()
+            if not line:
+                self.log.error('Persistent worker ended before returning a cost. Return code:' + repr(worker.poll()))
+                self._discard_worker(worker)
+                raise IOError('Persistent worker ended before returning a cost.')
+            lines.append(line)
+            temp = line.partition('#')[0].strip()
+            if temp == 'M-LOOP_end' or temp == 'MLOOP_end':
+                break
+        return ''.join(lines)
+    
+    def _discard_worker(self,worker):
+        '''
+        Stop using a persistent worker that can no longer be used, so that a new one is started for the next run of the current thread.
+        
+        Args:
+            worker (Popen): The worker to discard.
+        '''
+        self.thread_workers.worker = None
+        with self.workers_lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        if worker.poll() is None:
+            worker.terminate()
+        worker.wait()
+    
+    def _stop_workers(self):
+        '''
+        Close the standard input of the persistent workers, and terminate any that have not ended after interface_wait.
+        '''
+        with self.workers_lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            try:
+                worker.stdin.close()
+            except IOError:
+                pass
+        end_time = time.time() + self.interface_wait
+        for worker in workers:
+            while worker.poll() is None and time.time() < end_time:
+                time.sleep(0.01)
+            if worker.poll() is None:
+                self.log.warning('Persistent worker did not end, terminating it.')
+                worker.terminate()
+            worker.wait()
+    
+    def _get_params_string(self,params):
+        '''
+        Build the arguments that pass the parameters provided to the experiment, in the style set by params_args_type.
+        
+        Args:
+            params (array): The parameters to be passed to the experiment.
+        
+        Returns:
+            params_string (str): The arguments, each preceded by a space.
+        '''
         param_names = self.param_names
         
         #If no param_names supplied, construct the default list
         if param_names == None:
             param_names = []
             for ind,p in enumerate(params):
-                self.param_names.append('param' + str(ind+1))
+                param_names.append('param' + str(ind+1))
                 
-        curr_command = self.command
+        params_string = ''
         
         if self.params_args_type == 'direct':
             for p in params:
-                curr_command += ' ' + str(p)
+                params_string += ' ' + str(p)
         elif self.params_args_type == 'named':
             for ind,p in enumerate(params):
-                curr_command += ' ' + '--' + str(param_names[ind]) + ' ' + str(p)
+                params_string += ' ' + '--' + str(param_names[ind]) + ' ' + str(p)
         else:
             self.log.error('THIS SHOULD NOT HAPPEN. params_args_type not recognized')
         
-        #execute command and look at output
-        cli_return = sp.check_output(curr_command.split()).decode(sys.stdout.encoding)
-        print(cli_return)
+        return params_string
+    
+    def _get_cost_dict_from_output(self,cli_return):
+        '''
+        Parse the cost dict from the output of the command, found between the lines M-LOOP_start and M-LOOP_end.
         
+        Args:
+            cli_return (str): The output of the command.
+        
+        Returns:
+            tdict (dict): The cost dict.
+        '''
         tdict_string = ''
         take_flag = False
         for line in cli_return.splitlines():
@@ -310,18 +567,80 @@ class ShellInterface(Interface):
             elif temp == 'M-LOOP_end' or temp == 'MLOOP_end':
                 take_flag = False
             elif take_flag:
-                tdict_string += temp + ','
+                tdict_string += line + '\n'
         
         print(tdict_string)
         
-        #Setting up words for parsing a dict, ignore eclipse warnings
-        array = np.array    #@UnusedVariable
-        inf = float('inf')  #@UnusedVariable
-        nan = float('nan')  #@UnusedVariable
-        tdict = eval('dict('+tdict_string+')')
+        try:
+            tdict = mlu.txt_string_to_dict(tdict_string)
+        except ValueError:
+            self.log.error('Unable to parse the output of the command:\n' + tdict_string)
+            raise
         
         return tdict
 
+class ParallelShellInterface(ShellInterface):
+    '''
+    Interface for running several instances of a program from the shell at the same time, each with its own parameters. Inherits from ShellInterface and takes the same options.
+    
+    Each of the num_workers workers takes parameters from the params_out_queue, runs the command in its own subprocess and puts the cost dict on the costs_in_queue as soon as the command finishes, so costs can be returned in a different order to the parameters. If the command fails, or its output can not be parsed, the run is returned as bad. With persistent_worker each of the workers keeps its own persistent program running. Controllers given a parallel shell interface keep num_workers runs in flight by default, so every worker has a command to run.
+    
+    Keyword Args:
+        num_workers (Optional [int]): The number of commands run at the same time. If None, the number of CPUs on the machine. Default None.
+    '''
+    
+    def __init__(self,
+                 num_workers = None,
+                 **kwargs):
+        
+        super(ParallelShellInterface,self).__init__(**kwargs)
+        
+        if num_workers is None:
+            num_workers = mp.cpu_count()
+        self.num_workers = int(num_workers)
+        if self.num_workers<=0:
+            self.log.error('Number of workers must be greater than zero:' + repr(num_workers))
+            raise ValueError
+        self.max_parallel_runs = self.num_workers
+        
+        self.count_lock = threading.Lock()
+    
+    def run(self):
+        '''
+        The run sequence for the parallel shell interface. Starts num_workers threads which each run the main loop of the interface, and waits for them to end.
+        
+        '''
+        self.log.debug('Starting ' + repr(self.num_workers) + ' shell workers.')
+        #Each thread runs the main loop of Interface, the persistent workers are stopped once they have all ended
+        workers = [threading.Thread(target=super(ShellInterface,self).run) for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self._stop_workers()
+        self.log.debug('All shell workers ended')
+    
+    def get_next_cost_dict(self,params_dict):
+        '''
+        Runs a command with parameters on the command line and reads the result. Called concurrently by each of the workers.
+        '''
+        with self.count_lock:
+            self.command_count += 1
+            command_num = self.command_count
+        self.log.debug('Running command count' + repr(command_num))
+        
+        #execute command and look at output. A failed run is returned as bad, rather than ending the worker and leaving the controller waiting for its cost
+        try:
+            cli_return = self._run_command(params_dict['params'])
+            self.log.debug('Output of command count' + repr(command_num) + ':\n' + cli_return)
+            return self._get_cost_dict_from_output(cli_return)
+        except InterfaceInterrupt:
+            raise
+        except Exception as e:
+            self.log.error('Command count' + repr(command_num) + ' failed, the run is marked as bad:' + repr(e))
+            return {'bad':True}
+
 
 
 
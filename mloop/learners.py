@@ -10,25 +10,38 @@ import threading
 import numpy as np
 import random
 import numpy.random as nr
-import scipy.optimize as so
+import scipy.linalg as sl
 import logging
 import datetime
 import os
+import time
 import mloop.utilities as mlu
 import multiprocessing as mp
+import multiprocessing.pool as mpp
 
 import sklearn.gaussian_process as skg
 import sklearn.gaussian_process.kernels as skk
 import sklearn.preprocessing as skp
 
 from mloop import __version__
-import mloop.neuralnet as mlnn
 #Lazy import of scikit-learn and tensorflow
 
 learner_thread_count = 0
 default_learner_archive_filename = 'learner_archive'
 default_learner_archive_file_type = 'txt'
 
+# mloop.neuralnet imports TensorFlow, which is slow, so it is only imported by _import_neuralnet() when a neural net learner is created.
+mlnn = None
+
+def _import_neuralnet():
+    '''
+    Import the mloop.neuralnet module, and with it TensorFlow, as mlnn.
+    '''
+    global mlnn
+    if mlnn is None:
+        import mloop.neuralnet as mlnn
+    return mlnn
+
 class LearnerInterrupt(Exception):
     '''
     Exception that is raised when the learner is ended with the end flag or event.
@@ -51,7 +64,7 @@ class Learner():
         min_boundary (Optional [array]): Array with minimum values allowed for each parameter. Note if certain values have no minimum value you can set them to -inf for example [-1, 2, float('-inf')] is a valid min_boundary. If None sets all the boundaries to '-1'. Default None.
         max_boundary (Optional [array]): Array with maximum values allowed for each parameter. Note if certain values have no maximum value you can set them to +inf for example [0, float('inf'),3,-12] is a valid max_boundary. If None sets all the boundaries to '1'. Default None.
         learner_archive_filename (Optional [string]): Name for python archive of the learners current state. If None, no archive is saved. Default None. But this is typically overloaded by the child class.
-        learner_archive_file_type (Optional [string]):  File type for archive. Can be either 'txt' a human readable text file, 'pkl' a python dill file, 'mat' a matlab file or None if there is no archive. Default 'mat'.
+        learner_archive_file_type (Optional [string]):  File type for archive. Can be either 'txt' a human readable text file, 'pkl' a python dill file, 'mat' a matlab file, 'h5' an HDF5 file or None if there is no archive. Default 'mat'.
         log_level (Optional [int]): Level for the learners logger. If None, set to warning. Default None.
         start_datetime (Optional [datetime]): Start date time, if None, is automatically generated.
         param_names (Optional [list of str]): A list of names of the parameters for use e.g. in plot legends. Number of elements must equal num_params. If None, each name will be set to an empty sting. Default None.
@@ -161,6 +174,9 @@ class Learner():
         # Ensure that all of the entries are strings.
         self.param_names = [str(name) for name in self.param_names]
 
+        #Written to by a background thread, created when the archive is first saved
+        self.archive_writer = None
+
         #Storage variables, archived
         self.all_params = np.array([], dtype=float)
         self.all_costs = np.array([], dtype=float)
@@ -311,6 +327,42 @@ class Learner():
             self.log.error('Provided uncertainty must be larger or equal to zero:' + repr(uncer))
         return params, cost, uncer, bad
 
+    @property
+    def all_params(self):
+        '''
+        Array of the parameters of all runs, one run per row. A view of a growable array, so runs can be added without copying the earlier ones.
+        '''
+        return self._all_params.view
+
+    @all_params.setter
+    def all_params(self, all_params):
+        all_params = np.array(all_params, dtype=float)
+        if all_params.size == 0:
+            all_params = all_params.reshape((0, self.num_params))
+        self._all_params = mlu.GrowableArray.from_array(all_params)
+
+    @property
+    def all_costs(self):
+        '''
+        Array of the costs of all runs. A view of a growable array.
+        '''
+        return self._all_costs.view
+
+    @all_costs.setter
+    def all_costs(self, all_costs):
+        self._all_costs = mlu.GrowableArray.from_array(np.ravel(all_costs))
+
+    @property
+    def all_uncers(self):
+        '''
+        Array of the uncertainties of all runs. A view of a growable array.
+        '''
+        return self._all_uncers.view
+
+    @all_uncers.setter
+    def all_uncers(self, all_uncers):
+        self._all_uncers = mlu.GrowableArray.from_array(np.ravel(all_uncers))
+
     def _update_run_data_attributes(self, params, cost, uncer, bad):
         '''
         Update attributes that store the results returned by the controller.
@@ -321,20 +373,9 @@ class Learner():
             uncer (float): The uncertainty measured for `params`.
             bad (bool): Whether or not the run was bad.
         '''
-        if self.all_params.size==0:
-            self.all_params = np.array([params], dtype=float)
-            self.all_costs = np.array([cost], dtype=float)
-            self.all_uncers = np.array([uncer], dtype=float)
-        else:
-            # params
-            params_array = np.array([params], dtype=float)
-            self.all_params = np.append(self.all_params, params_array, axis=0)
-            # cost
-            cost_array = np.array([cost], dtype=float)
-            self.all_costs = np.append(self.all_costs, cost_array, axis=0)
-            # uncer
-            uncer_array = np.array([uncer], dtype=float)
-            self.all_uncers = np.append(self.all_uncers, uncer_array, axis=0)
+        self._all_params.append(params)
+        self._all_costs.append(cost)
+        self._all_uncers.append(uncer)
         if bad:
             cost_index = len(self.all_costs) - 1
             self.bad_run_indexs.append(cost_index)
@@ -342,10 +383,14 @@ class Learner():
     def save_archive(self):
         '''
         Save the archive associated with the learner class. Only occurs if the filename for the archive is not None. Saves with the format previously set.
+
+        The archive is written by a background mlu.ArchiveWriter, which is created by the thread or process running the learner, so the learner does not wait for it. It is flushed when the learner shuts down or its thread ends.
         '''
         self.update_archive()
         if self.learner_archive_filename is not None:
-            mlu.save_dict_to_file(self.archive_dict, self.total_archive_filename, self.learner_archive_file_type)
+            if self.archive_writer is None:
+                self.archive_writer = mlu.ArchiveWriter(self.total_archive_filename, self.learner_archive_file_type)
+            self.archive_writer.save(self.archive_dict)
 
     def update_archive(self):
         '''
@@ -401,6 +446,8 @@ class Learner():
         '''
         self.log.debug('Performing shut down of learner.')
         self.save_archive()
+        if self.archive_writer is not None:
+            self.archive_writer.close()
 
 
 class RandomLearner(Learner, threading.Thread):
@@ -1052,9 +1099,10 @@ class MachineLearner(Learner):
             the current optimization. If `None`, no past results will be used.
             Default `None`.
         training_file_type (Optional [str]): File type of the training archive.
-            Can be `'txt'`, `'pkl'`, `'mat'`, or `None`. If set to `None`, then
-            the file type will be determined automatically. This argument has no
-            effect if `training_filename` is set to `None`. Default `None`.
+            Can be `'txt'`, `'pkl'`, `'mat'`, `'h5'`, or `None`. If set to
+            `None`, then the file type will be determined automatically. This
+            argument has no effect if `training_filename` is set to `None`.
+            Default `None`.
 
     Attributes:
         all_params (array): Array containing all parameters sent to learner.
@@ -1070,6 +1118,8 @@ class MachineLearner(Learner):
         cost_range (float): Difference between worst_cost and best_cost
         params_count (int): Counter for the number of parameters asked to be evaluated by the learner.
         has_trust_region (bool): Whether the learner has a trust region.
+        run_store (SharedRunStore): If not None, the costs are read from this shared memory store instead of from costs_in_queue. Set by the controller before the learner is started.
+        run_store_cursor (int): The number of runs that have been read from run_store.
     '''
 
     def __init__(self,
@@ -1309,6 +1359,8 @@ class MachineLearner(Learner):
 
         # Multiprocessor controls
         self.new_params_event = mp.Event()
+        self.run_store = None
+        self.run_store_cursor = 0
 
         # Storage variables and counters
         self.search_params = []
@@ -1437,9 +1489,58 @@ class MachineLearner(Learner):
             self.log.debug('Learner end signal received. Ending')
             raise LearnerInterrupt
 
+    def new_costs_available(self):
+        '''
+        Check whether the controller has provided costs that have not been read by get_params_and_costs() yet.
+
+        Returns:
+            bool : True if there are new costs.
+        '''
+        if self.run_store is not None:
+            return self.run_store.num_runs > self.run_store_cursor
+        return not self.costs_in_queue.empty()
+
+    def _shut_down(self):
+        '''
+        Close the shared run store in the learner process, then shut down and perform one final save of the learner.
+        '''
+        if self.run_store is not None:
+            self.run_store.close()
+        super(MachineLearner, self)._shut_down()
+
+    def _get_new_runs(self):
+        '''
+        Get the runs provided by the controller since this was last called, from run_store if it is set and otherwise from costs_in_queue.
+
+        Returns:
+            list : The runs, each a tuple of the form (params, cost, uncer, bad).
+        '''
+        if self.run_store is not None:
+            # The controller adds the runs to the store before setting the
+            # new_params_event, so they can be read straight away.
+            (params, costs, uncers, bads) = self.run_store.read(self.run_store_cursor)
+            self.run_store_cursor += costs.size
+            new_runs = list(zip(params, costs, uncers, bads != 0))
+        else:
+            new_runs = []
+            try:
+                # Block for 1s, because there might be a race with the
+                # new_params_event being set. See comment in
+                # controllers.MachineLearnerController._optimization_routine().
+                new_runs.append(self.costs_in_queue.get(block=True, timeout=1))
+                while True:
+                    new_runs.append(self.costs_in_queue.get_nowait())
+            except mlu.empty_exception:
+                pass
+        if not new_runs:
+            msg = 'Learner asked for new parameters but no new costs were provided.'
+            self.log.error(msg)
+            raise ValueError(msg)
+        return new_runs
+
     def get_params_and_costs(self):
         '''
-        Get the parameters and costs from the queue and place in their appropriate all_[type] arrays.
+        Get the parameters and costs provided by the controller and place in their appropriate all_[type] arrays.
 
         Also updates bad costs, best parameters, and search boundaries given trust region.
         '''
@@ -1449,24 +1550,7 @@ class MachineLearner(Learner):
         new_bads = []
         update_bads_flag = False
 
-        first_dequeue = True
-        while True:
-            if first_dequeue:
-                try:
-                    # Block for 1s, because there might be a race with the
-                    # new_params_event being set. See comment in
-                    # controllers.MachineLearnerController._optimization_routine().
-                    (param, cost, uncer, bad) = self.costs_in_queue.get(block=True, timeout=1)
-                    first_dequeue = False
-                except mlu.empty_exception:
-                    msg = 'Learner asked for new parameters but no new costs were provided after 1s.'
-                    self.log.error(msg)
-                    raise ValueError(msg)
-            else:
-                try:
-                    (param, cost, uncer, bad) = self.costs_in_queue.get_nowait()
-                except mlu.empty_exception:
-                    break
+        for (param, cost, uncer, bad) in self._get_new_runs():
 
             self.costs_count +=1
 
@@ -1503,14 +1587,9 @@ class MachineLearner(Learner):
             new_costs.append(cost)
             new_uncers.append(uncer)
 
-        if self.all_params.size==0:
-            self.all_params = np.array(new_params, dtype=float)
-            self.all_costs = np.array(new_costs, dtype=float)
-            self.all_uncers = np.array(new_uncers, dtype=float)
-        else:
-            self.all_params = np.concatenate((self.all_params, np.array(new_params, dtype=float)))
-            self.all_costs = np.concatenate((self.all_costs, np.array(new_costs, dtype=float)))
-            self.all_uncers = np.concatenate((self.all_uncers, np.array(new_uncers, dtype=float)))
+        self._all_params.extend(new_params)
+        self._all_costs.extend(new_costs)
+        self._all_uncers.extend(new_uncers)
 
         self.bad_run_indexs.extend(new_bads)
 
@@ -1554,6 +1633,22 @@ class MachineLearner(Learner):
             self.search_params.append(self.search_min + nr.uniform(size=self.num_params) * self.search_diff)
 
 
+def _fit_gaussian_process_hyperparameters(fit_args):
+    '''
+    Fit the hyperparameters of a Gaussian process with a single run of the optimizer, starting from the hyperparameters of the kernel. Defined at module level so that it can be run by a multiprocessing pool.
+
+    Args:
+        fit_args (tuple): The kernel, alpha, parameters and scaled costs for the Gaussian process.
+
+    Returns:
+        tuple : The log marginal likelihood and the log-transformed hyperparameters (theta) of the fitted kernel.
+    '''
+    (kernel, alpha, params, scaled_costs) = fit_args
+    gaussian_process = skg.GaussianProcessRegressor(alpha=alpha, kernel=kernel, n_restarts_optimizer=0)
+    gaussian_process.fit(params, scaled_costs)
+    return (gaussian_process.log_marginal_likelihood_value_, gaussian_process.kernel_.theta)
+
+
 class GaussianProcessLearner(MachineLearner, mp.Process):
     '''
     Gaussian process learner.
@@ -1595,6 +1690,54 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         update_hyperparameters (Optional [bool]): Whether the length scales and
             noise estimate should be updated when new data is provided. Default
             `True`.
+        update_hyperparameters_schedule (Optional [int or str]): When the
+            length scales and noise estimate are updated, if
+            `update_hyperparameters` is `True`. If an integer `k`, they are
+            updated every `k` fits of the Gaussian process. If `'geometric'`,
+            they are updated whenever the number of runs has grown by a factor
+            of `hyperparameter_update_factor` since they were last updated. In
+            between, the Gaussian process is fitted with the last values of the
+            hyperparameters, which is much faster. Each update starts from the
+            last values. Default `1`, which updates them every fit.
+        batch_acquisition (Optional [bool]): If `True`, each generation of
+            parameters is found as a batch with the constant liar method. After
+            each set of parameters is found, it is added to the Gaussian process
+            as a run with the highest cost measured so far, so that the sets of parameters in a generation are spread out
+            rather than clustered, and can all be run at the same time. If
+            `False`, each set of parameters in a generation is found from the
+            same fit with a different bias towards uncertain regions. Default
+            `False`.
+        generation_num (Optional [int]): The number of sets of parameters
+            found each generation, from one fit of the Gaussian process. Must
+            be larger than 2. If `None`, set to `4`. The Gaussian process
+            controller sets it to the number of runs it keeps in flight, if
+            that is larger, when `batch_acquisition` is `True`. Default `None`.
+        local_fit_runs (Optional [int]): If set, once more than this number of
+            runs have been made, the gaussian process is only fitted to the
+            `local_fit_runs` runs closest to the best parameters, with distances
+            measured in units of the length scales. This keeps the time and
+            memory taken to fit the gaussian process and to search it bounded
+            in long optimizations, at the cost of forgetting runs far from the
+            best parameters. It works best together with a `trust_region`,
+            which keeps the search close to the runs that are fitted. If
+            `None`, all runs are fitted. If `None` and a training archive is
+            provided, the value from the archive is used. Default `None`.
+        hyperparameter_workers (Optional [int]): The number of processes used
+            to fit the hyperparameters. The `hyperparameter_searches` restarts
+            of the optimizer, each from random initial length scales and noise
+            level, are shared between a pool of this many processes and the
+            best result is kept. If `None`, the number of CPUs on the machine.
+            Default `1`, which fits them in the learner process.
+        hyperparameter_seed (Optional [int]): Seed for the random initial
+            values of the hyperparameter restarts, so that the fitted
+            hyperparameters are reproducible. If `None`, they are not seeded.
+            Default `None`.
+        update_hyperparameters_threshold (Optional [float]): If not `None`,
+            the length scales and noise estimate are also updated whenever the
+            log marginal likelihood per run of the Gaussian process fitted with
+            the last values of the hyperparameters has dropped by more than
+            this amount since they were last updated. Only has an effect if
+            `update_hyperparameters` is `True`. Default `None`.
         cost_has_noise (Optional [bool]): If `True` the learner assumes there is
             common additive white noise that corrupts the costs provided. This
             noise is assumed to be on top of the uncertainty in the costs (if it
@@ -1621,10 +1764,10 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
             use in the current optimization. If `None`, no past results will be
             used. Default `None`.
         gp_training_file_type (Optional [str]): File type of the training
-            archive. Can be `'txt'`, `'pkl'`, `'mat'`, or `None`. If set to
-            `None`, then the file type will be determined automatically. This
-            argument has no effect if `gp_training_filename` is set to `None`.
-            Default `None`.
+            archive. Can be `'txt'`, `'pkl'`, `'mat'`, `'h5'`, or `None`. If
+            set to `None`, then the file type will be determined
+            automatically. This argument has no effect if
+            `gp_training_filename` is set to `None`. Default `None`.
         trust_region (Optional [float or array]): The trust region defines the
             maximum distance the learner will travel from the current best set
             of parameters. If `None`, the learner will search everywhere. If a
@@ -1656,6 +1799,8 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         scaled_costs (array): Array contaning all the costs scaled to have zero
             mean and a standard deviation of 1. Needed for training the gaussian
             process.
+        fit_run_indexs (array): Indexes of the runs the gaussian process was
+            last fitted to. All runs unless `local_fit_runs` is set.
         bad_run_indexs (list): list of indexes to all runs that were marked as
             bad.
         best_cost (float): Minimum received cost, updated during execution.
@@ -1666,11 +1811,28 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         worst_index (int): index to run with worst cost.
         cost_range (float): Difference between `worst_cost` and `best_cost`.
         generation_num (int): Number of sets of parameters to generate each
-            generation. Set to `4`.
+            generation.
         length_scale_history (list): List of length scales found after each fit.
         noise_level_history (list): List of noise levels found after each fit.
         fit_count (int): Counter for the number of times the gaussian process
             has been fit.
+        fits_since_hyperparameter_update (int): Counter for the number of fits
+            of the gaussian process since the hyperparameters were last
+            updated.
+        hyperparameter_update_log_likelihood (float): The log marginal
+            likelihood per run of the last fit that updated the
+            hyperparameters.
+        hyperparameter_update_factor (float): The factor by which the number of
+            runs must grow between updates of the hyperparameters, if
+            `update_hyperparameters_schedule` is `'geometric'`. Set to `1.5`.
+        full_fit_needed (bool): Whether the gaussian process has to be fitted
+            from scratch the next time it is fitted, rather than updated with
+            the new costs. Set when the costs of bad runs are changed.
+        cost_scaling_tolerance (float): The largest relative change of the mean
+            or standard deviation of the costs, compared to those used to scale
+            the costs at the last full fit, for which the gaussian process is
+            updated with the new costs instead of being fitted from scratch.
+            Set to `0.1`.
         cost_count (int): Counter for the number of costs, parameters and
             uncertainties added to learner.
         params_count (int): Counter for the number of parameters asked to be
@@ -1687,6 +1849,13 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
                  length_scale = None,
                  length_scale_bounds=None,
                  update_hyperparameters = True,
+                 update_hyperparameters_schedule = 1,
+                 update_hyperparameters_threshold = None,
+                 batch_acquisition = False,
+                 generation_num = None,
+                 local_fit_runs = None,
+                 hyperparameter_workers = 1,
+                 hyperparameter_seed = None,
                  cost_has_noise=True,
                  noise_level=None,
                  noise_level_bounds=None,
@@ -1742,6 +1911,11 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
                 length_scale = mlu.safe_cast_to_array(training_dict['length_scale'])
             if noise_level is None:
                 noise_level = float(training_dict['noise_level'])
+            # Archives from earlier versions of M-LOOP fitted all runs.
+            if local_fit_runs is None and 'local_fit_runs' in training_dict:
+                local_fit_runs = float(training_dict['local_fit_runs'])
+                if np.isnan(local_fit_runs):
+                    local_fit_runs = None
             
             # Retrieve earlier history if the parameters are loaded from
             # a training archive that has invalid runs.
@@ -1766,6 +1940,7 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
 
         #Storage variables and counters
         self.scaled_uncers = None
+        self.fit_run_indexs = None
         self.scaled_noise_level = None
         self.scaled_noise_level_bounds = None
         self.cost_bias = None
@@ -1775,13 +1950,19 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         self.bias_func_cycle = 4
         self.bias_func_cost_factor = [1.0,1.0,1.0,1.0]
         self.bias_func_uncer_factor =[0.0,1.0,2.0,3.0]
-        self.generation_num = self.bias_func_cycle
+        self.batch_acquisition = bool(batch_acquisition)
+        if generation_num is None:
+            self.generation_num = self.bias_func_cycle
+        else:
+            self.generation_num = int(generation_num)
         if self.generation_num < 3:
             self.log.error('Number in generation must be larger than 2.')
             raise ValueError
 
         #Constants, limits and tolerances
         self.hyperparameter_searches = max(10,self.num_params)
+        self.hyperparameter_update_factor = 1.5
+        self.cost_scaling_tolerance = 0.1
 
         #Optional user set variables
         self.cost_has_noise = bool(cost_has_noise)
@@ -1798,6 +1979,25 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         else:
             self.noise_level = float(noise_level)
         self.update_hyperparameters = bool(update_hyperparameters)
+        if update_hyperparameters_schedule == 'geometric':
+            self.update_hyperparameters_schedule = update_hyperparameters_schedule
+        else:
+            self.update_hyperparameters_schedule = int(update_hyperparameters_schedule)
+        if hyperparameter_workers is None:
+            hyperparameter_workers = mp.cpu_count()
+        self.hyperparameter_workers = int(hyperparameter_workers)
+        self.hyperparameter_random_state = nr.RandomState(hyperparameter_seed)
+        self.hyperparameter_pool = None
+        if local_fit_runs is None:
+            # Use NaN rather than None so the archive can be saved as a .mat.
+            self.local_fit_runs = float('nan')
+        else:
+            self.local_fit_runs = int(local_fit_runs)
+        if update_hyperparameters_threshold is None:
+            # Use NaN rather than None so the archive can be saved as a .mat.
+            self.update_hyperparameters_threshold = float('nan')
+        else:
+            self.update_hyperparameters_threshold = float(update_hyperparameters_threshold)
         if length_scale_bounds is None:
             self.length_scale_bounds = np.array([1e-5, 1e5])
         else:
@@ -1821,12 +2021,27 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
             self.log.error('noise_level must be greater or equal to zero:' +repr(self.noise_level))
             raise ValueError
         self._check_noise_level_bounds()
+        if self.update_hyperparameters_schedule != 'geometric' and self.update_hyperparameters_schedule < 1:
+            self.log.error('update_hyperparameters_schedule must be a positive integer or \'geometric\':' + repr(self.update_hyperparameters_schedule))
+            raise ValueError
+        if self.local_fit_runs <= self.num_params:
+            self.log.error('local_fit_runs must be larger than the number of parameters or None:' + repr(self.local_fit_runs))
+            raise ValueError
+        if self.hyperparameter_workers <= 0:
+            self.log.error('Number of hyperparameter workers must be greater than zero:' + repr(self.hyperparameter_workers))
+            raise ValueError
+        if self.update_hyperparameters_threshold <= 0:
+            self.log.error('update_hyperparameters_threshold must be positive or None:' + repr(self.update_hyperparameters_threshold))
+            raise ValueError
         if self.default_bad_uncertainty is not None:
             if self.default_bad_uncertainty < 0:
                 self.log.error('Default bad uncertainty must be positive.')
                 raise ValueError
 
         self.gaussian_process = None
+        self.full_fit_needed = True
+        self.fits_since_hyperparameter_update = 0
+        self.hyperparameter_update_log_likelihood = float('nan')
 
         self.cost_scaler = skp.StandardScaler()
 
@@ -1837,10 +2052,14 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
                                   'noise_level_history':self.noise_level_history,
                                   'noise_level_bounds':self.noise_level_bounds,
                                   'update_hyperparameters_history':self.update_hyperparameters_history,
+                                  'update_hyperparameters_schedule':self.update_hyperparameters_schedule,
+                                  'update_hyperparameters_threshold':self.update_hyperparameters_threshold,
                                   'bias_func_cycle':self.bias_func_cycle,
                                   'bias_func_cost_factor':self.bias_func_cost_factor,
                                   'bias_func_uncer_factor':self.bias_func_uncer_factor,
                                   'generation_num':self.generation_num,
+                                  'batch_acquisition':self.batch_acquisition,
+                                  'local_fit_runs':self.local_fit_runs,
                                   'search_precision':self.search_precision,
                                   'parameter_searches':self.parameter_searches,
                                   'hyperparameter_searches':self.hyperparameter_searches,
@@ -1925,10 +2144,18 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
             self.log.error(message)
             raise ValueError(message)
 
-    def create_gaussian_process(self):
+    def create_gaussian_process(self, fit_hyperparameters=None):
         '''
         Create a Gaussian process.
+
+        Keyword Args:
+            fit_hyperparameters (Optional [bool]): Whether fitting the Gaussian
+                process should also fit its hyperparameters. If `None`, they
+                are fitted if `update_hyperparameters` is `True`. Default
+                `None`.
         '''
+        if fit_hyperparameters is None:
+            fit_hyperparameters = self.update_hyperparameters
         gp_kernel = skk.RBF(
             length_scale=self.length_scale,
             length_scale_bounds=self.length_scale_bounds,
@@ -1939,9 +2166,9 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
                 noise_level_bounds=self.scaled_noise_level_bounds,
             )
             gp_kernel = gp_kernel + white_kernel
-        alpha = self.scaled_uncers**2
-        if self.update_hyperparameters:
-            self.gaussian_process = skg.GaussianProcessRegressor(alpha=alpha, kernel=gp_kernel,n_restarts_optimizer=self.hyperparameter_searches)
+        alpha = self.scaled_uncers[self.fit_run_indexs]**2
+        if fit_hyperparameters:
+            self.gaussian_process = skg.GaussianProcessRegressor(alpha=alpha, kernel=gp_kernel,n_restarts_optimizer=self.hyperparameter_searches,random_state=self.hyperparameter_random_state)
         else:
             self.gaussian_process = skg.GaussianProcessRegressor(alpha=alpha, kernel=gp_kernel,optimizer=None)
 
@@ -1958,17 +2185,69 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         }
         self.archive_dict.update(new_values_dict)
 
+    def update_bads(self):
+        '''
+        Best and/or worst costs have changed, update the values associated with bad runs accordingly. The gaussian process is then fitted from scratch next time, as the costs it was fitted to have changed.
+        '''
+        super(GaussianProcessLearner, self).update_bads()
+        if self.bad_run_indexs:
+            self.full_fit_needed = True
+
     def fit_gaussian_process(self):
         '''
-        Fit the Gaussian process to the current data
+        Fit the Gaussian process to the current data.
+
+        If update_hyperparameters is True, the hyperparameters are also fitted when update_hyperparameters_schedule says they are due, or when the log marginal likelihood per run with the last hyperparameters has dropped by more than update_hyperparameters_threshold. Otherwise the last hyperparameters are kept.
         '''
-        self.log.debug('Fitting Gaussian process.')
         if self.all_params.size==0 or self.all_costs.size==0 or self.all_uncers.size==0:
             self.log.error('Asked to fit GP but no data is in all_costs, all_params or all_uncers.')
             raise ValueError
+        if not (self.update_hyperparameters and self._hyperparameter_update_due()):
+            self._fit_gaussian_process(fit_hyperparameters=False)
+            self.fits_since_hyperparameter_update += 1
+            if not (self.update_hyperparameters and self._log_likelihood_dropped()):
+                return
+            self.log.debug('Log marginal likelihood has dropped, updating hyperparameters.')
+        self._fit_gaussian_process(fit_hyperparameters=True)
+
+    def _hyperparameter_update_due(self):
+        '''
+        Check whether the hyperparameters should be fitted according to update_hyperparameters_schedule. They are always fitted at the first fit of the learner.
+        '''
+        if self.gaussian_process is None or not self.update_hyperparameters_history:
+            return True
+        if self.update_hyperparameters_schedule == 'geometric':
+            last_update_runs = self.update_hyperparameters_history[-1] + 1
+            return self.costs_count >= self.hyperparameter_update_factor * last_update_runs
+        return self.fits_since_hyperparameter_update + 1 >= self.update_hyperparameters_schedule
+
+    def _log_likelihood_dropped(self):
+        '''
+        Check whether the log marginal likelihood per run of the Gaussian process has dropped by more than update_hyperparameters_threshold since the hyperparameters were last fitted.
+        '''
+        if np.isnan(self.update_hyperparameters_threshold) or np.isnan(self.hyperparameter_update_log_likelihood):
+            return False
+        log_likelihood = self.gaussian_process.log_marginal_likelihood_value_ / self.fit_run_indexs.size
+        return self.hyperparameter_update_log_likelihood - log_likelihood > self.update_hyperparameters_threshold
+
+    def _fit_gaussian_process(self, fit_hyperparameters):
+        '''
+        Fit the Gaussian process to the current data, and record the hyperparameters if they were fitted.
+
+        If the hyperparameters are not being fitted, the costs of earlier runs have not changed and the scaling of the costs is still within cost_scaling_tolerance of that used for the last full fit, the Gaussian process is updated with the new costs by update_gaussian_process() instead of being fitted from scratch. Once there are more than local_fit_runs runs, the Gaussian process is always fitted from scratch, to the runs chosen by select_fit_runs().
+
+        Args:
+            fit_hyperparameters (bool): Whether to fit the hyperparameters.
+        '''
+        fit_all_runs = not self.all_costs.size > self.local_fit_runs
+        if not (self.full_fit_needed or fit_hyperparameters) and fit_all_runs and self._cost_scaling_in_tolerance():
+            if self.update_gaussian_process():
+                return
+        self.log.debug('Fitting Gaussian process.')
         self.scaled_costs = self.cost_scaler.fit_transform(self.all_costs[:,np.newaxis])[:,0]
         cost_scaling_factor = float(self.cost_scaler.scale_)
         self.scaled_uncers = self.all_uncers / cost_scaling_factor
+        self.fit_run_indexs = self.select_fit_runs()
         if self.cost_has_noise:
             # Ensure compatability with archives from M-LOOP versions <= 3.1.1.
             if self._scale_deprecated_noise_levels:
@@ -1988,12 +2267,17 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
             self.scaled_noise_level = self.noise_level / cost_scaling_factor**2
             self.scaled_noise_level_bounds = self.noise_level_bounds / cost_scaling_factor**2
 
-        self.create_gaussian_process()
-        self.gaussian_process.fit(self.all_params,self.scaled_costs)
+        self.create_gaussian_process(fit_hyperparameters=fit_hyperparameters)
+        if fit_hyperparameters and self.hyperparameter_workers > 1:
+            self._fit_hyperparameters_in_pool()
+        self.gaussian_process.fit(self.all_params[self.fit_run_indexs],self.scaled_costs[self.fit_run_indexs])
+        self.full_fit_needed = False
 
-        if self.update_hyperparameters:
+        if fit_hyperparameters:
 
             self.fit_count += 1
+            self.fits_since_hyperparameter_update = 0
+            self.hyperparameter_update_log_likelihood = self.gaussian_process.log_marginal_likelihood_value_ / self.fit_run_indexs.size
 
             last_hyperparameters = self.gaussian_process.kernel_.get_params()
 
@@ -2010,6 +2294,171 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
                 self.length_scale_history.append(self.length_scale)
             self.update_hyperparameters_history.append(self.costs_count-1)
 
+    def _fit_hyperparameters_in_pool(self):
+        '''
+        Fit the hyperparameters of the created Gaussian process, running the optimizer from its initial hyperparameters and from hyperparameter_searches random ones on a pool of hyperparameter_workers processes. The Gaussian process is replaced by one with the best hyperparameters found, which is then fitted without optimizing them again.
+        '''
+        kernel = self.gaussian_process.kernel
+        bounds = kernel.bounds
+        initial_thetas = [kernel.theta]
+        for _ in range(self.hyperparameter_searches):
+            initial_thetas.append(self.hyperparameter_random_state.uniform(bounds[:,0], bounds[:,1]))
+        if self.hyperparameter_pool is None:
+            self.hyperparameter_pool = mp.Pool(min(self.hyperparameter_workers, len(initial_thetas)))
+        fit_params = self.all_params[self.fit_run_indexs]
+        fit_costs = self.scaled_costs[self.fit_run_indexs]
+        fit_args = [(kernel.clone_with_theta(theta), self.gaussian_process.alpha, fit_params, fit_costs) for theta in initial_thetas]
+        results = self.hyperparameter_pool.map(_fit_gaussian_process_hyperparameters, fit_args)
+        best_theta = max(results, key=lambda result: result[0])[1]
+        self.gaussian_process = skg.GaussianProcessRegressor(alpha=self.gaussian_process.alpha, kernel=kernel.clone_with_theta(best_theta), optimizer=None)
+
+    def select_fit_runs(self):
+        '''
+        Select the runs to fit the Gaussian process to. These are all the runs, unless there are more than local_fit_runs of them, in which case they are the local_fit_runs runs closest to the best parameters, with the distance along each parameter measured in units of its length scale.
+
+        Returns:
+            array : The indexes of the runs to fit, in increasing order.
+        '''
+        num_runs = self.all_costs.size
+        if not num_runs > self.local_fit_runs:
+            return np.arange(num_runs)
+        distances = np.sum(((self.all_params - self.best_params) / self.length_scale)**2, axis=1)
+        return np.sort(np.argpartition(distances, self.local_fit_runs - 1)[:self.local_fit_runs])
+
+    def _stop_hyperparameter_pool(self):
+        '''
+        Stop the pool of processes for fitting hyperparameters, if it has been started.
+        '''
+        if self.hyperparameter_pool is not None:
+            self.hyperparameter_pool.close()
+            self.hyperparameter_pool.join()
+            self.hyperparameter_pool = None
+
+    def _shut_down(self):
+        '''
+        Stop the pool of processes for fitting hyperparameters, then shut down and perform one final save of the learner.
+        '''
+        self._stop_hyperparameter_pool()
+        super(GaussianProcessLearner, self)._shut_down()
+
+    def _cost_scaling_in_tolerance(self):
+        '''
+        Check whether the mean and standard deviation of the costs are within cost_scaling_tolerance of those used to scale the costs at the last full fit of the Gaussian process.
+        '''
+        if self.gaussian_process is None:
+            return False
+        scale = float(self.cost_scaler.scale_)
+        mean_change = abs(np.mean(self.all_costs) - float(self.cost_scaler.mean_))
+        scale_change = abs(np.std(self.all_costs) - scale)
+        return max(mean_change, scale_change) <= self.cost_scaling_tolerance * scale
+
+    def update_gaussian_process(self):
+        '''
+        Update the fitted Gaussian process with the costs received since it was last fitted or updated, without fitting it from scratch.
+
+        The new costs are scaled with the cost scaler of the last full fit, so the kernel matrix of the earlier runs is unchanged and its Cholesky factor is extended with the rows for the new runs. This takes a time proportional to the square of the number of runs, rather than the cube for a full fit. The kernel hyperparameters are not changed.
+
+        Returns:
+            bool : True if the Gaussian process was updated, False if it could not be, because the extended kernel matrix was not numerically positive definite, in which case it should be fitted from scratch.
+        '''
+        self.log.debug('Updating Gaussian process.')
+        num_fitted = self.gaussian_process.X_train_.shape[0]
+        scaled_costs = self.cost_scaler.transform(self.all_costs[:,np.newaxis])[:,0]
+        scaled_uncers = self.all_uncers / float(self.cost_scaler.scale_)
+        if self.all_params.shape[0] > num_fitted:
+            if not self._extend_gaussian_process(self.all_params[num_fitted:], scaled_uncers[num_fitted:]**2):
+                self.log.debug('Kernel matrix not positive definite, fitting Gaussian process from scratch.')
+                return False
+        self._set_gaussian_process_costs(scaled_costs, scaled_uncers**2)
+        self.scaled_costs = scaled_costs
+        self.scaled_uncers = scaled_uncers
+        self.fit_run_indexs = np.arange(self.all_costs.size)
+        return True
+
+    def _extend_gaussian_process(self, new_params, new_alpha):
+        '''
+        Add runs to the fitted Gaussian process by extending the Cholesky factor of its kernel matrix. The costs of the Gaussian process must then be set with _set_gaussian_process_costs().
+
+        Args:
+            new_params (array): The parameters of the new runs, one set of parameters per row.
+            new_alpha (array): The values added to the diagonal of the kernel matrix for the new runs, which are their scaled uncertainties squared.
+
+        Returns:
+            bool : True if the Gaussian process was extended, False if the extended kernel matrix was not numerically positive definite.
+        '''
+        gaussian_process = self.gaussian_process
+        fitted_params = gaussian_process.X_train_
+        num_fitted = fitted_params.shape[0]
+        num_runs = num_fitted + new_params.shape[0]
+        cross_kernel = gaussian_process.kernel_(fitted_params, new_params)
+        new_kernel = gaussian_process.kernel_(new_params)
+        new_kernel[np.diag_indices_from(new_kernel)] += new_alpha
+        cross_factor = sl.solve_triangular(gaussian_process.L_, cross_kernel, lower=True, check_finite=False)
+        try:
+            new_factor = np.linalg.cholesky(new_kernel - cross_factor.T.dot(cross_factor))
+        except np.linalg.LinAlgError:
+            return False
+        factor = np.zeros((num_runs, num_runs))
+        factor[:num_fitted,:num_fitted] = gaussian_process.L_
+        factor[num_fitted:,:num_fitted] = cross_factor.T
+        factor[num_fitted:,num_fitted:] = new_factor
+        gaussian_process.X_train_ = np.concatenate((fitted_params, new_params))
+        gaussian_process.L_ = factor
+        return True
+
+    def _set_gaussian_process_costs(self, scaled_costs, alpha):
+        '''
+        Set the scaled costs that the Gaussian process is fitted to and solve for its weights, using the existing Cholesky factor of its kernel matrix.
+
+        Args:
+            scaled_costs (array): The scaled costs of the runs of the Gaussian process.
+            alpha (array): The scaled uncertainties squared of the runs.
+        '''
+        gaussian_process = self.gaussian_process
+        gaussian_process.y_train_ = scaled_costs
+        gaussian_process.alpha = alpha
+        gaussian_process.alpha_ = sl.cho_solve((gaussian_process.L_, True), scaled_costs, check_finite=False)
+        gaussian_process.log_marginal_likelihood_value_ = (
+            -0.5 * scaled_costs.dot(gaussian_process.alpha_)
+            - np.log(np.diag(gaussian_process.L_)).sum()
+            - 0.5 * scaled_costs.size * np.log(2 * np.pi)
+        )
+        # Older versions of scikit-learn cache the inverse of the kernel matrix.
+        if hasattr(gaussian_process, '_K_inv'):
+            gaussian_process._K_inv = None
+
+    def add_lie_run(self, params):
+        '''
+        Add a run at params to the Gaussian process with a made up cost equal to the highest cost it has been fitted to, as in the pessimistic constant liar batch acquisition. This lowers the predicted uncertainty around params and raises the predicted cost there, so that the next parameters found in the same generation are spread out rather than clustered around params. The run is given the mean uncertainty of the runs.
+
+        Args:
+            params (array): The parameters of the run.
+
+        Returns:
+            bool : True if the run was added, False if the kernel matrix would no longer be numerically positive definite.
+        '''
+        gaussian_process = self.gaussian_process
+        lie_cost = np.max(gaussian_process.y_train_)
+        lie_alpha = np.mean(gaussian_process.alpha)
+        if not self._extend_gaussian_process(params[np.newaxis,:], lie_alpha):
+            return False
+        self._set_gaussian_process_costs(np.append(gaussian_process.y_train_, lie_cost),
+                                         np.append(gaussian_process.alpha, lie_alpha))
+        return True
+
+    def remove_lie_runs(self, num_runs):
+        '''
+        Remove the runs added by add_lie_run(), by keeping only the first num_runs runs of the Gaussian process. The leading block of the Cholesky factor is the factor for those runs, so nothing needs to be refactorized.
+
+        Args:
+            num_runs (int): The number of runs the Gaussian process had before the lie runs were added.
+        '''
+        gaussian_process = self.gaussian_process
+        if gaussian_process.X_train_.shape[0] == num_runs:
+            return
+        gaussian_process.X_train_ = gaussian_process.X_train_[:num_runs]
+        gaussian_process.L_ = np.ascontiguousarray(gaussian_process.L_[:num_runs,:num_runs])
+        self._set_gaussian_process_costs(gaussian_process.y_train_[:num_runs], gaussian_process.alpha[:num_runs])
 
     def update_bias_function(self):
         '''
@@ -2029,6 +2478,52 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         (pred_cost, pred_uncer) = self.gaussian_process.predict(params[np.newaxis,:], return_std=True)
         return self.cost_bias*pred_cost - self.uncer_bias*pred_uncer
 
+    def predict_biased_costs_and_gradients(self,params):
+        '''
+        Predicts the biased costs at an array of parameters and their gradients with respect to the parameters. See predict_biased_cost().
+
+        Args:
+            params (array): The parameters, one set of parameters per row.
+
+        Returns:
+            tuple : The array of biased costs and the array of their gradients.
+        '''
+        (pred_costs, pred_uncers, cost_gradients, uncer_gradients) = self.predict_costs_and_gradients(params, return_std=True)
+        return (self.cost_bias*pred_costs - self.uncer_bias*pred_uncers,
+                self.cost_bias*cost_gradients - self.uncer_bias*uncer_gradients)
+
+    def predict_costs_and_gradients(self,params,return_std=False):
+        '''
+        Predicts the costs at an array of parameters and their gradients with respect to the parameters, from the analytic derivatives of the RBF kernel. This is much faster than estimating the gradients with finite differences of gaussian_process.predict().
+
+        Args:
+            params (array): The parameters, one set of parameters per row.
+            return_std (Optional [bool]): Whether to also return the
+                uncertainties of the predicted costs and their gradients.
+                Default False.
+
+        Returns:
+            tuple : The arrays of predicted costs and their gradients, or if return_std is True the arrays of predicted costs, their uncertainties, and their gradients.
+        '''
+        gaussian_process = self.gaussian_process
+        rbf_kernel = gaussian_process.kernel_.k1 if self.cost_has_noise else gaussian_process.kernel_
+        length_scale_squared = np.square(rbf_kernel.length_scale)
+        param_diffs = params[:,np.newaxis,:] - gaussian_process.X_train_[np.newaxis,:,:]
+        cross_kernel = np.exp(-0.5 * np.sum(param_diffs**2 / length_scale_squared, axis=2))
+        cross_kernel_gradients = -cross_kernel[:,:,np.newaxis] * param_diffs / length_scale_squared
+        pred_costs = cross_kernel.dot(gaussian_process.alpha_)
+        cost_gradients = np.einsum('j,ijk->ik', gaussian_process.alpha_, cross_kernel_gradients)
+        if not return_std:
+            return (pred_costs, cost_gradients)
+        factor_solve = sl.solve_triangular(gaussian_process.L_, cross_kernel.T, lower=True, check_finite=False)
+        pred_vars = gaussian_process.kernel_.diag(params) - np.sum(factor_solve**2, axis=0)
+        pred_uncers = np.sqrt(np.maximum(pred_vars, 0))
+        kernel_solve = sl.solve_triangular(gaussian_process.L_, factor_solve, lower=True, trans='T', check_finite=False)
+        uncer_gradients = np.zeros_like(cost_gradients)
+        positive = pred_uncers > 0
+        uncer_gradients[positive] = -np.einsum('ji,ijk->ik', kernel_solve[:,positive], cross_kernel_gradients[positive]) / pred_uncers[positive,np.newaxis]
+        return (pred_costs, pred_uncers, cost_gradients, uncer_gradients)
+
     def find_next_parameters(self):
         '''
         Returns next parameters to find. Increments counters and bias function appropriately.
@@ -2039,14 +2534,8 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         self.params_count += 1
         self.update_bias_function()
         self.update_search_params()
-        next_params = None
-        next_cost = float('inf')
-        for start_params in self.search_params:
-            result = so.minimize(self.predict_biased_cost, start_params, bounds = self.search_region, tol=self.search_precision)
-            if result.fun < next_cost:
-                next_params = result.x
-                next_cost = result.fun
-        return next_params
+        (found_params, found_costs) = mlu.minimize_batch(self.predict_biased_costs_and_gradients, self.search_params, self.search_min, self.search_max, tol=self.search_precision)
+        return found_params[np.argmin(found_costs)]
 
     def run(self):
         '''
@@ -2057,33 +2546,43 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         self.log = mp.log_to_stderr(logging.WARNING)
 
         try:
-            while not self.end_event.is_set():
-                #self.log.debug('Learner waiting for new params event')
-                self.save_archive()
-                self.wait_for_new_params_event()
-                #self.log.debug('Gaussian process learner reading costs')
-                self.get_params_and_costs()
-                self.fit_gaussian_process()
-                for _ in range(self.generation_num):
-                    self.log.debug('Gaussian process learner generating parameter:'+ str(self.params_count+1))
-                    next_params = self.find_next_parameters()
-                    self.params_out_queue.put(next_params)
-                    if self.end_event.is_set():
-                        raise LearnerInterrupt()
-        except LearnerInterrupt:
-            pass
+            try:
+                while not self.end_event.is_set():
+                    #self.log.debug('Learner waiting for new params event')
+                    self.save_archive()
+                    self.wait_for_new_params_event()
+                    #self.log.debug('Gaussian process learner reading costs')
+                    self.get_params_and_costs()
+                    self.fit_gaussian_process()
+                    num_fitted = self.gaussian_process.X_train_.shape[0]
+                    try:
+                        for _ in range(self.generation_num):
+                            self.log.debug('Gaussian process learner generating parameter:'+ str(self.params_count+1))
+                            next_params = self.find_next_parameters()
+                            self.params_out_queue.put(next_params)
+                            if self.end_event.is_set():
+                                raise LearnerInterrupt()
+                            if self.batch_acquisition:
+                                self.add_lie_run(next_params)
+                    finally:
+                        self.remove_lie_runs(num_fitted)
+            except LearnerInterrupt:
+                pass
 
-        end_dict = {}
-        if self.predict_global_minima_at_end:
-            if not self.costs_in_queue.empty():
-                # There are new parameters, get them.
-                self.get_params_and_costs()
-            self.fit_gaussian_process()
-            self.find_global_minima()
-            end_dict.update({'predicted_best_parameters':self.predicted_best_parameters,
-                             'predicted_best_cost':self.predicted_best_cost,
-                             'predicted_best_uncertainty':self.predicted_best_uncertainty})
-        self.params_out_queue.put(end_dict)
+            end_dict = {}
+            if self.predict_global_minima_at_end:
+                if self.new_costs_available():
+                    # There are new parameters, get them.
+                    self.get_params_and_costs()
+                self.fit_gaussian_process()
+                self.find_global_minima()
+                end_dict.update({'predicted_best_parameters':self.predicted_best_parameters,
+                                 'predicted_best_cost':self.predicted_best_cost,
+                                 'predicted_best_uncertainty':self.predicted_best_uncertainty})
+            self.params_out_queue.put(end_dict)
+        finally:
+            # Never leave the pool's processes running, even if the learner fails.
+            self._stop_hyperparameter_pool()
         self._shut_down()
         self.log.debug('Ended Gaussian Process Learner')
 
@@ -2107,24 +2606,14 @@ class GaussianProcessLearner(MachineLearner, mp.Process):
         '''
         self.log.debug('Started search for predicted global minima.')
 
-        self.predicted_best_parameters = None
-        self.predicted_best_scaled_cost = float('inf')
-        self.predicted_best_scaled_uncertainty = None
-
         search_params = []
         search_params.append(self.best_params)
         for _ in range(self.parameter_searches):
             search_params.append(self.min_boundary + nr.uniform(size=self.num_params) * self.diff_boundary)
 
-        search_bounds = list(zip(self.min_boundary, self.max_boundary))
-        for start_params in search_params:
-            result = so.minimize(self.predict_cost, start_params, bounds = search_bounds, tol=self.search_precision)
-            curr_best_params = result.x
-            (curr_best_cost,curr_best_uncer) = self.gaussian_process.predict(curr_best_params[np.newaxis,:],return_std=True)
-            if curr_best_cost<self.predicted_best_scaled_cost:
-                self.predicted_best_parameters = curr_best_params
-                self.predicted_best_scaled_cost = curr_best_cost
-                self.predicted_best_scaled_uncertainty = curr_best_uncer
+        (found_params, found_costs) = mlu.minimize_batch(self.predict_costs_and_gradients, search_params, self.min_boundary, self.max_boundary, tol=self.search_precision)
+        self.predicted_best_parameters = found_params[np.argmin(found_costs)]
+        (self.predicted_best_scaled_cost, self.predicted_best_scaled_uncertainty) = self.gaussian_process.predict(self.predicted_best_parameters[np.newaxis,:],return_std=True)
 
         self.predicted_best_cost = self.cost_scaler.inverse_transform(self.predicted_best_scaled_cost)
         self.predicted_best_uncertainty = self.predicted_best_scaled_uncertainty * self.cost_scaler.scale_
@@ -2154,10 +2643,45 @@ class NeuralNetLearner(MachineLearner, mp.Process):
             use in the current optimization. If `None`, no past results will be
             used. Default `None`.
         nn_training_file_type (Optional [str]): File type of the training
-            archive. Can be `'txt'`, `'pkl'`, `'mat'`, or `None`. If set to
-            `None`, then the file type will be determined automatically. This
-            argument has no effect if `nn_training_filename` is set to `None`.
-            Default `None`.
+            archive. Can be `'txt'`, `'pkl'`, `'mat'`, `'h5'`, or `None`. If
+            set to `None`, then the file type will be determined
+            automatically. This argument has no effect if
+            `nn_training_filename` is set to `None`. Default `None`.
+        training_workers (Optional [int]): The number of neural nets trained
+            at the same time, each on its own thread with its own TensorFlow
+            session, which is limited to an equal share of the cores. The
+            parameters from each net are sent as soon as it is trained, without
+            waiting for the others. If `None`, set to the smaller of the number
+            of nets and the number of cores. Default `1`, which trains the nets
+            one after another.
+        update_hyperparameters (Optional [bool]): Whether the regularisation
+            coefficient of each neural net is fitted every 20 runs, by training
+            a candidate net for each of a few coefficients and switching to the
+            best one if it does significantly better on a cross validation set.
+            Default `False`.
+        hyperparameter_workers (Optional [int]): The number of candidate nets
+            trained at the same time when fitting the regularisation, each on
+            its own thread with its own TensorFlow session. If `None`, one per
+            candidate. Default `1`, which trains them one after another.
+        hyperparameter_fit_in_background (Optional [bool]): Whether to fit the
+            regularisation in the background while the current nets keep being
+            trained and used to pick parameters. The best candidate is swapped
+            in at the first fit after it is ready. Default `False`, which waits
+            for the candidates to be trained.
+        training_validation_fraction (Optional [float]): The fraction of the
+            runs, chosen at random for each fit, held out from training each
+            net to decide when to stop training it. The weights that do best on
+            the held out runs are kept. Default `0`, which stops when the loss
+            on the training runs stops improving.
+        max_training_time (Optional [float]): The maximum time in seconds
+            spent training the nets for each generation of parameters. It is
+            split evenly between the nets that each worker trains, and each
+            net's share starts when its own training starts, so nets that are
+            only trained when they are first used later in the generation get
+            the same time as the first. Training that is still running when its
+            time is up stops after its current block of 10 epochs. If `None`,
+            the nets are trained until their loss stops improving. Default
+            `None`.
         trust_region (Optional [float or array]): The trust region defines the maximum distance the learner will travel from the current best set of parameters. If None, the learner will search everywhere. If a float, this number must be between 0 and 1 and defines maximum distance the learner will venture as a percentage of the boundaries. If it is an array, it must have the same size as the number of parameters and the numbers define the maximum absolute distance that can be moved along each direction.
         default_bad_cost (Optional [float]): If a run is reported as bad and default_bad_cost is provided, the cost for the bad run is set to this default value. If default_bad_cost is None, then the worst cost received is set to all the bad runs. Default None.
         default_bad_uncertainty (Optional [float]): If a run is reported as bad and default_bad_uncertainty is provided, the uncertainty for the bad run is set to this default value. If default_bad_uncertainty is None, then the uncertainty is set to a tenth of the best to worst cost range. Default None.
@@ -2190,8 +2714,16 @@ class NeuralNetLearner(MachineLearner, mp.Process):
     def __init__(self,
                  nn_training_filename =None,
                  nn_training_file_type =None,
+                 training_workers = 1,
+                 update_hyperparameters = False,
+                 hyperparameter_workers = 1,
+                 hyperparameter_fit_in_background = False,
+                 training_validation_fraction = 0.,
+                 max_training_time = None,
                  **kwargs):
 
+        _import_neuralnet()
+
         if nn_training_filename is not None:
             super(NeuralNetLearner,self).__init__(
                 training_filename=nn_training_filename,
@@ -2223,8 +2755,42 @@ class NeuralNetLearner(MachineLearner, mp.Process):
         self.num_nets = 3
         self.generation_num = 3
 
+        if training_workers is None:
+            training_workers = min(self.num_nets, mp.cpu_count())
+        self.training_workers = int(training_workers)
+        if self.training_workers <= 0:
+            self.log.error('Number of training workers must be greater than zero:' + repr(self.training_workers))
+            raise ValueError
+        self.training_pool = None
+
+        self.update_hyperparameters = bool(update_hyperparameters)
+        if hyperparameter_workers is not None:
+            hyperparameter_workers = int(hyperparameter_workers)
+            if hyperparameter_workers <= 0:
+                self.log.error('Number of hyperparameter workers must be greater than zero:' + repr(hyperparameter_workers))
+                raise ValueError
+        self.hyperparameter_workers = hyperparameter_workers
+        self.hyperparameter_fit_in_background = bool(hyperparameter_fit_in_background)
+
+        self.training_validation_fraction = float(training_validation_fraction)
+        if not 0 <= self.training_validation_fraction < 1:
+            self.log.error('training_validation_fraction must be at least 0 and less than 1:' + repr(self.training_validation_fraction))
+            raise ValueError
+        if max_training_time is None:
+            self.max_training_time = None
+        else:
+            self.max_training_time = float(max_training_time)
+            if self.max_training_time <= 0:
+                self.log.error('max_training_time must be greater than zero:' + repr(self.max_training_time))
+                raise ValueError
+
         self.archive_dict.update({'archive_type':self._ARCHIVE_TYPE,
                                   'generation_num':self.generation_num,
+                                  'training_workers':self.training_workers,
+                                  'update_hyperparameters':self.update_hyperparameters,
+                                  'hyperparameter_fit_in_background':self.hyperparameter_fit_in_background,
+                                  'training_validation_fraction':self.training_validation_fraction,
+                                  'max_training_time':float('nan') if self.max_training_time is None else self.max_training_time,
                                   'search_precision':self.search_precision,
                                   'parameter_searches':self.parameter_searches,
                                   'bad_uncer_frac':self.bad_uncer_frac,
@@ -2236,11 +2802,21 @@ class NeuralNetLearner(MachineLearner, mp.Process):
         self.log = None
 
     def _construct_net(self):
+        mlnn = _import_neuralnet()
+        if self.training_workers > 1:
+            intra_op_threads = max(1, mp.cpu_count() // self.training_workers)
+        else:
+            intra_op_threads = None
         self.neural_net = [
             mlnn.NeuralNet(
                 num_params=self.num_params,
                 learner_archive_dir=self.learner_archive_dir,
-                start_datetime=self.start_datetime)
+                start_datetime=self.start_datetime,
+                intra_op_threads=intra_op_threads,
+                fit_hyperparameters=self.update_hyperparameters,
+                hyperparameter_workers=self.hyperparameter_workers,
+                hyperparameter_fit_in_background=self.hyperparameter_fit_in_background,
+                validation_fraction=self.training_validation_fraction)
             for _ in range(self.num_nets)
         ]
 
@@ -2270,15 +2846,66 @@ class NeuralNetLearner(MachineLearner, mp.Process):
             n.load(self.training_dict['net_' + str(i)],
                    extra_search_dirs=[self.nn_training_file_dir])
 
-    def _fit_neural_net(self,index):
+    def _fit_neural_net(self,index,deadline=None):
         '''
         Fits a neural net to the data.
 
         cost_scaler must have been fitted before calling this method.
+
+        Args:
+            index (int): The index of the net to fit.
+            deadline (Optional float): The time, as returned by time.time(), after which training stops early. If None, there is no deadline. Default None.
         '''
         self.scaled_costs = self.cost_scaler.transform(self.all_costs[:,np.newaxis])[:,0]
 
-        self.neural_net[index].fit_neural_net(self.all_params, self.scaled_costs)
+        self.neural_net[index].fit_neural_net(self.all_params, self.scaled_costs, deadline=deadline)
+
+    def _fit_neural_nets_in_pool(self, indexes):
+        '''
+        Start fitting neural nets to the data on the pool of training_workers threads. TensorFlow releases the GIL while it trains, so the nets are trained at the same time. Each net's deadline is set by _net_deadline() when its training starts.
+
+        cost_scaler must have been fitted before calling this method.
+
+        Args:
+            indexes (list): The indexes of the nets to fit.
+
+        Returns:
+            list : An AsyncResult for each net, in the order of indexes. Their get() methods wait for the net to be fitted.
+        '''
+        if self.training_pool is None:
+            self.training_pool = mpp.ThreadPool(self.training_workers)
+        self.scaled_costs = self.cost_scaler.transform(self.all_costs[:,np.newaxis])[:,0]
+        all_params = self.all_params
+        return [self.training_pool.apply_async(self._fit_pooled_neural_net, (index, all_params, self.scaled_costs))
+                for index in indexes]
+
+    def _fit_pooled_neural_net(self, index, all_params, scaled_costs):
+        '''
+        Fit a neural net on a thread of the training pool, with a deadline that starts when the thread picks it up.
+        '''
+        self.neural_net[index].fit_neural_net(all_params, scaled_costs, deadline=self._net_deadline())
+
+    def _net_deadline(self):
+        '''
+        Get the deadline for a net whose training starts now. Each net gets an equal share of max_training_time for the nets trained one after another on each of the training_workers.
+
+        Returns:
+            float : The time, as returned by time.time(), after which training stops early, or None if max_training_time is None.
+        '''
+        if self.max_training_time is None:
+            return None
+        nets_per_worker = self.num_nets / min(self.training_workers, self.num_nets)
+        return time.time() + self.max_training_time / nets_per_worker
+
+    def _shut_down(self):
+        '''
+        Stop the pool of threads for training the nets, then shut down and perform one final save of the learner.
+        '''
+        if self.training_pool is not None:
+            self.training_pool.close()
+            self.training_pool.join()
+            self.training_pool = None
+        super(NeuralNetLearner, self)._shut_down()
 
     def predict_cost(self,params,net_index=None):
         '''
@@ -2304,15 +2931,28 @@ class NeuralNetLearner(MachineLearner, mp.Process):
         return self.neural_net[net_index].predict_cost_gradient(params).astype(np.float64)
 
 
+    def predict_costs_and_gradients(self,params,net_index=None):
+        '''
+        Produces predictions of the cost and its gradient at each row of an array of params, from a single evaluation of the neural net.
+
+        Returns:
+            tuple : Array of predicted costs and array of predicted gradients
+        '''
+        if net_index is None:
+            net_index = nr.randint(self.num_nets)
+        (costs, gradients) = self.neural_net[net_index].predict_costs_and_gradients(np.asarray(params))
+        return (costs.astype(np.float64), gradients.astype(np.float64))
+
     def predict_costs_from_param_array(self,params,net_index=None):
         '''
-        Produces a prediction of costs from an array of params.
+        Produces a prediction of costs from an array of params, evaluating the neural net once for all of them. If net_index is None, the same randomly chosen net is used for all of the params.
 
         Returns:
-            float : Predicted cost at paramters
+            array : Predicted costs at paramters
         '''
-        # TODO: Can do this more efficiently.
-        return [self.predict_cost(param,net_index) for param in params]
+        if net_index is None:
+            net_index = nr.randint(self.num_nets)
+        return self.neural_net[net_index].predict_costs(np.asarray(params, dtype=float)).astype(np.float64)
 
     def update_archive(self):
         '''
@@ -2339,19 +2979,15 @@ class NeuralNetLearner(MachineLearner, mp.Process):
 
         self.params_count += 1
         self.update_search_params()
-        next_params = None
-        next_cost = float('inf')
         self.neural_net[net_index].start_opt()
-        for start_params in self.search_params:
-            result = so.minimize(fun = lambda x: self.predict_cost(x, net_index),
-                                 x0 = start_params,
-                                 jac = lambda x: self.predict_cost_gradient(x, net_index),
-                                 bounds = self.search_region,
-                                 tol = self.search_precision)
-            if result.fun < next_cost:
-                next_params = result.x
-                next_cost = result.fun
+        (found_params, found_costs) = mlu.minimize_batch(lambda params: self.predict_costs_and_gradients(params, net_index),
+                                                         self.search_params,
+                                                         self.search_min,
+                                                         self.search_max,
+                                                         tol = self.search_precision)
         self.neural_net[net_index].stop_opt()
+        next_params = found_params[np.argmin(found_costs)]
+        next_cost = np.min(found_costs)
         self.log.debug("Suggesting params " + str(next_params) + " with predicted cost: "
                 + str(next_cost))
         return next_params
@@ -2388,26 +3024,44 @@ class NeuralNetLearner(MachineLearner, mp.Process):
                 # trained exactly once, regardless of how many times it's used to generate new
                 # params.
                 num_nets_trained = 0
-                for _ in range(self.generation_num):
-                    if num_nets_trained < self.num_nets:
-                        self._fit_neural_net(net_index)
-                        num_nets_trained += 1
-
-                    self.log.debug('Neural network learner generating parameter:'+ str(self.params_count+1))
-                    next_params = self.find_next_parameters(net_index)
-                    net_index = (net_index + 1) % self.num_nets
-                    self.params_out_queue.put(next_params)
-                    if self.end_event.is_set():
-                        raise LearnerInterrupt()
+                fits = []
+                if self.training_workers > 1:
+                    # Train all of the nets at once, and use each as soon as
+                    # it is ready.
+                    fits = self._fit_neural_nets_in_pool(
+                        [(net_index + i) % self.num_nets for i in range(self.num_nets)])
+                try:
+                    for _ in range(self.generation_num):
+                        if num_nets_trained < self.num_nets:
+                            if fits:
+                                fits[num_nets_trained].get()
+                            else:
+                                self._fit_neural_net(net_index, deadline=self._net_deadline())
+                            num_nets_trained += 1
+
+                        self.log.debug('Neural network learner generating parameter:'+ str(self.params_count+1))
+                        next_params = self.find_next_parameters(net_index)
+                        net_index = (net_index + 1) % self.num_nets
+                        self.params_out_queue.put(next_params)
+                        if self.end_event.is_set():
+                            raise LearnerInterrupt()
+                finally:
+                    # Never leave a net training when the learner moves on.
+                    for fit in fits:
+                        fit.wait()
                 # Train any nets that haven't been trained yet.
-                for i in range(self.num_nets - num_nets_trained):
-                    self._fit_neural_net((net_index + i) % self.num_nets)
+                if fits:
+                    for fit in fits[num_nets_trained:]:
+                        fit.get()
+                else:
+                    for i in range(self.num_nets - num_nets_trained):
+                        self._fit_neural_net((net_index + i) % self.num_nets, deadline=self._net_deadline())
 
         except LearnerInterrupt:
             pass
         end_dict = {}
         if self.predict_global_minima_at_end:
-            if not self.costs_in_queue.empty():
+            if self.new_costs_available():
                 # There are new parameters, get them.
                 self.get_params_and_costs()
             # TODO: Somehow support predicting minima from all nets, rather than just net 0.
@@ -2433,26 +3087,18 @@ class NeuralNetLearner(MachineLearner, mp.Process):
             net_index = nr.randint(self.num_nets)
         self.log.debug('Started search for predicted global minima.')
 
-        self.predicted_best_parameters = None
-        self.predicted_best_scaled_cost = float('inf')
-
         search_params = []
         search_params.append(self.best_params)
         for _ in range(self.parameter_searches):
             search_params.append(self.min_boundary + nr.uniform(size=self.num_params) * self.diff_boundary)
 
-        search_bounds = list(zip(self.min_boundary, self.max_boundary))
-        for start_params in search_params:
-            result = so.minimize(fun = lambda x: self.predict_cost(x, net_index),
-                                 x0 = start_params,
-                                 jac = lambda x: self.predict_cost_gradient(x, net_index),
-                                 bounds = search_bounds,
-                                 tol = self.search_precision)
-            curr_best_params = result.x
-            curr_best_cost = result.fun
-            if curr_best_cost<self.predicted_best_scaled_cost:
-                self.predicted_best_parameters = curr_best_params
-                self.predicted_best_scaled_cost = curr_best_cost
+        (found_params, found_costs) = mlu.minimize_batch(lambda params: self.predict_costs_and_gradients(params, net_index),
+                                                         search_params,
+                                                         self.min_boundary,
+                                                         self.max_boundary,
+                                                         tol = self.search_precision)
+        self.predicted_best_parameters = found_params[np.argmin(found_costs)]
+        self.predicted_best_scaled_cost = np.min(found_costs)
 
         self.predicted_best_cost = float(self.cost_scaler.inverse_transform([self.predicted_best_scaled_cost]))
         self.archive_dict.update({'predicted_best_parameters':self.predicted_best_parameters,
@@ -1,6 +1,7 @@
 import datetime
 import logging
-import math
+import multiprocessing as mp
+import multiprocessing.pool as mpp
 import os
 import time
 import base64
@@ -18,6 +19,18 @@ else:
     import tensorflow.compat.v1 as tf
     tf.disable_v2_behavior()
 
+_gelu_coefficient = np.sqrt(2 / np.pi)
+
+def _gelu_fast(_x):
+    return 0.5 * _x * (1 + tf.tanh(_gelu_coefficient * (_x + 0.044715 * tf.pow(_x, 3))))
+
+def _gelu_fast_numpy(_x):
+    return 0.5 * _x * (1 + np.tanh(_gelu_coefficient * (_x + 0.044715 * _x**3)))
+
+def _gelu_fast_numpy_derivative(_x):
+    tanh = np.tanh(_gelu_coefficient * (_x + 0.044715 * _x**3))
+    return 0.5 * (1 + tanh) + 0.5 * _x * (1 - tanh**2) * _gelu_coefficient * (1 + 3 * 0.044715 * _x**2)
+
 class SingleNeuralNet():
     '''
     A single neural network with fixed hyperparameters/topology.
@@ -39,6 +52,22 @@ class SingleNeuralNet():
         keep_prob: The dropout keep probability.
         regularisation_coefficient: The regularisation coefficient.
         losses_list: A list to which this object will append training losses.
+        numpy_layer_activations (Optional list): For each layer, a tuple of NumPy functions giving
+            the activation function of layer_activations and its derivative. If provided, the
+            trained weights are copied into NumPy arrays after each fit, and predictions and
+            gradients are evaluated with NumPy, which avoids the overhead of a TensorFlow session
+            run for the small arrays evaluated during parameter searches. TensorFlow is then only
+            used for training. If set to None, TensorFlow is used for predictions. Default None.
+        intra_op_threads (Optional int): The number of threads the TensorFlow session may use
+            within each operation. Set when several nets are trained at the same time, so that
+            they do not compete for all of the cores. If set to None, TensorFlow chooses.
+            Default None.
+        validation_fraction (Optional float): The fraction of the data, chosen at random for each
+            fit, held out to decide when to stop training. If greater than zero, training stops
+            when the improvement in the loss on the held out data falls under
+            train_threshold_ratio, and the weights with the lowest loss on the held out data are
+            kept. If zero, the loss on all of the data, which is also used for training, is used
+            instead. Default 0.
         learner_archive_dir (Optional str): The path to a directory in which to
             save the neural net. If set to None, then the default value of
             archive_foldername in utilities.py will be used. Default None.
@@ -57,6 +86,9 @@ class SingleNeuralNet():
                  keep_prob,
                  regularisation_coefficient,
                  losses_list,
+                 numpy_layer_activations=None,
+                 intra_op_threads=None,
+                 validation_fraction=0.,
                  learner_archive_dir=None,
                  start_datetime=None):
         self.log = logging.getLogger(__name__)
@@ -75,11 +107,22 @@ class SingleNeuralNet():
 
         self.log.info("Constructing net")
         self.graph = tf.Graph()
-        self.tf_session = tf.Session(graph=self.graph)
+        if intra_op_threads is None:
+            self.tf_session = tf.Session(graph=self.graph)
+        else:
+            config = tf.ConfigProto(intra_op_parallelism_threads=int(intra_op_threads),
+                                    inter_op_parallelism_threads=1)
+            self.tf_session = tf.Session(graph=self.graph, config=config)
 
         if not len(layer_dims) == len(layer_activations):
             self.log.error('len(layer_dims) != len(layer_activations)')
             raise ValueError
+        if numpy_layer_activations is not None and not len(numpy_layer_activations) == len(layer_activations):
+            self.log.error('len(numpy_layer_activations) != len(layer_activations)')
+            raise ValueError
+        if not 0 <= validation_fraction < 1:
+            self.log.error('validation_fraction must be at least 0 and less than 1:' + repr(validation_fraction))
+            raise ValueError
 
         # Hyperparameters for the net. These are all constant.
         self.num_params = num_params
@@ -87,15 +130,24 @@ class SingleNeuralNet():
         self.batch_size = batch_size
         self.keep_prob = keep_prob
         self.regularisation_coefficient = regularisation_coefficient
+        self.validation_fraction = float(validation_fraction)
 
         self.losses_list = losses_list
 
+        # NumPy copies of the trained weights and biases, used for predictions if
+        # numpy_layer_activations is provided.
+        self.numpy_layer_activations = numpy_layer_activations
+        self.numpy_inference = numpy_layer_activations is not None
+        self.numpy_weights = None
+        self.numpy_biases = None
+
         with self.graph.as_default():
             ## Inputs
             self.input_placeholder = tf.placeholder(tf.float32, shape=[None, self.num_params])
             self.output_placeholder = tf.placeholder(tf.float32, shape=[None, 1])
             self.keep_prob_placeholder = tf.placeholder_with_default(1., shape=[])
             self.regularisation_coefficient_placeholder = tf.placeholder_with_default(0., shape=[])
+            self.epochs_placeholder = tf.placeholder(tf.int32, shape=[])
 
             ## Initialise the network
 
@@ -121,9 +173,11 @@ class SingleNeuralNet():
             biases.append(tf.Variable(
                 tf.random_normal([1], stddev=bias_stddev),
                 name="bias_out"))
+            self.weights = weights
+            self.biases = biases
 
             # Get the output var given an input var
-            def get_output_var(input_var):
+            def get_output_var(input_var, weights=weights, biases=biases):
                 prev_h = input_var
                 for w, b, act in zip(weights[:-1], biases[:-1], layer_activations):
                     prev_h = tf.nn.dropout(
@@ -144,15 +198,50 @@ class SingleNeuralNet():
                     reduction_indices=[1]))
 
             # Regularisation component of the loss.
-            loss_reg = (self.regularisation_coefficient_placeholder
-                * tf.reduce_mean([tf.nn.l2_loss(W) for W in weights]))
+            def get_loss_reg(weights):
+                return (self.regularisation_coefficient_placeholder
+                    * tf.reduce_mean([tf.nn.l2_loss(W) for W in weights]))
 
             ## Define tensors for evaluating the loss on the full input
             self.loss_raw = get_loss_raw(self.output_placeholder, self.output_var)
-            self.loss_total = self.loss_raw + loss_reg
+            self.loss_total = self.loss_raw + get_loss_reg(weights)
 
             ## Training
-            self.train_step = tf.train.AdamOptimizer().minimize(self.loss_total)
+
+            # Train for epochs_placeholder epochs on the full input in a single run of the session,
+            # shuffling the input at the start of each epoch and taking a step of the optimizer for
+            # each batch. Running one step at a time from Python spends most of the time in the
+            # overhead of the session runs, since the batches are so small.
+            optimizer = tf.train.AdamOptimizer()
+            data_size = tf.shape(self.input_placeholder)[0]
+            batches_per_epoch = (data_size + self.batch_size - 1) // self.batch_size
+
+            def train_step(step, indices):
+                batch = step % batches_per_epoch
+                indices = tf.cond(tf.equal(batch, 0),
+                                  lambda: tf.random_shuffle(tf.range(data_size)),
+                                  lambda: indices)
+                batch_indices = indices[batch * self.batch_size : (batch + 1) * self.batch_size]
+                # Read the variables only after the previous step has updated them.
+                with tf.control_dependencies([step, indices]):
+                    step_weights = [tf.identity(w) for w in weights]
+                    step_biases = [tf.identity(b) for b in biases]
+                batch_output_var = get_output_var(
+                    tf.gather(self.input_placeholder, batch_indices), step_weights, step_biases)
+                batch_loss = (get_loss_raw(tf.gather(self.output_placeholder, batch_indices), batch_output_var)
+                              + get_loss_reg(step_weights))
+                gradients = tf.gradients(batch_loss, step_weights + step_biases)
+                apply_step = optimizer.apply_gradients(list(zip(gradients, weights + biases)))
+                with tf.control_dependencies([apply_step]):
+                    return (step + 1, tf.identity(indices))
+
+            self.train_epochs = tf.while_loop(
+                lambda step, _: step < self.epochs_placeholder * batches_per_epoch,
+                train_step,
+                [tf.constant(0), tf.range(data_size)],
+                shape_invariants=[tf.TensorShape([]), tf.TensorShape([None])],
+                parallel_iterations=1,
+                back_prop=False)
 
             # Initialiser for ... initialising
             self.initialiser = tf.global_variables_initializer()
@@ -164,11 +253,42 @@ class SingleNeuralNet():
     def destroy(self):
         self.tf_session.close()
 
+    def _export_weights(self):
+        '''
+        Copy the current weights and biases of the net into NumPy arrays for predictions.
+        '''
+        if self.numpy_inference:
+            (weights, biases) = self.tf_session.run([self.weights, self.biases])
+            self.numpy_weights = [w.astype(np.float64) for w in weights]
+            self.numpy_biases = [b.astype(np.float64) for b in biases]
+
+    def _numpy_costs_and_gradients(self, params, with_gradients):
+        '''
+        Evaluate the net and optionally the gradient of its output with respect to its input at each row of params with NumPy, using the exported weights.
+        '''
+        layer_input = np.asarray(params, dtype=np.float64)
+        layers = list(zip(self.numpy_weights[:-1], self.numpy_biases[:-1], self.numpy_layer_activations))
+        derivatives = []
+        for (w, b, (activation, derivative)) in layers:
+            pre_activation = layer_input.dot(w) + b
+            if with_gradients:
+                derivatives.append(derivative(pre_activation))
+            layer_input = activation(pre_activation)
+        costs = layer_input.dot(self.numpy_weights[-1][:,0]) + self.numpy_biases[-1][0]
+        if not with_gradients:
+            return costs
+        gradients = np.broadcast_to(self.numpy_weights[-1][:,0], layer_input.shape)
+        for ((w, _, _), layer_derivative) in zip(reversed(layers), reversed(derivatives)):
+            gradients = (gradients * layer_derivative).dot(w.T)
+        return (costs, gradients)
+
     def init(self):
         '''
-        Initializes the net.
+        Initializes the net. Calling this again re-initializes all the variables, so the graph can be
+        reused for a new net.
         '''
         self.tf_session.run(self.initialiser)
+        self._export_weights()
 
     def load(self, archive, extra_search_dirs=None):
         '''
@@ -202,6 +322,7 @@ class SingleNeuralNet():
             try:
                 full_path = os.path.join(dirname, filename)
                 self.saver.restore(self.tf_session, full_path)
+                self._export_weights()
                 return
             except ValueError:
                 pass
@@ -227,17 +348,22 @@ class SingleNeuralNet():
         return self.tf_session.run(
             [self.loss_total, self.loss_raw],
             feed_dict={self.input_placeholder: params,
-                       self.output_placeholder: [[c] for c in costs],
+                       self.output_placeholder: np.reshape(costs, (-1, 1)),
                        self.regularisation_coefficient_placeholder: self.regularisation_coefficient,
                        })
 
-    def fit(self, params, costs, epochs):
+    def fit(self, params, costs, epochs, deadline=None):
         '''
         Fit the neural net to the provided data
 
         Args:
             params (array): array of parameter arrays
             costs (array): array of costs (associated with the corresponding parameters)
+            epochs (int): The number of epochs to train for before checking whether the loss is
+                still improving.
+            deadline (Optional float): A time, as returned by time.time(), after which training
+                stops as soon as the current block of 10 epochs has finished. If None, training
+                only stops when the loss stops improving. Default None.
         '''
         self.log.info('Fitting neural network')
         if len(params) == 0:
@@ -247,47 +373,69 @@ class SingleNeuralNet():
             self.log.error("Params and costs must have the same length")
             raise ValueError
 
-        lparams = np.array(params)
-        lcosts = np.expand_dims(np.array(costs), axis=1)
+        # Convert the data to the type used by the graph once, rather than on every session run.
+        lparams = np.array(params, dtype=np.float32)
+        lcosts = np.array(costs, dtype=np.float32).reshape(-1, 1)
+
+        # Hold out some of the data to decide when to stop.
+        num_validation = int(self.validation_fraction * len(lparams))
+        if num_validation > 0 and num_validation < len(lparams):
+            indices = np.random.permutation(len(lparams))
+            validation_params = lparams[indices[:num_validation]]
+            validation_costs = lcosts[indices[:num_validation]]
+            lparams = lparams[indices[num_validation:]]
+            lcosts = lcosts[indices[num_validation:]]
+            stopping_loss = lambda: self._loss(validation_params, validation_costs)[1]
+        else:
+            stopping_loss = lambda: self._loss(lparams, lcosts)[0]
+
+        train_feed_dict = {self.input_placeholder: lparams,
+                           self.output_placeholder: lcosts,
+                           self.regularisation_coefficient_placeholder: self.regularisation_coefficient,
+                           self.keep_prob_placeholder: self.keep_prob,
+                           }
 
         # The general training procedure is as follows:
         # - set a threshold based on the current loss
         # - train for train_epochs epochs
         # - if the new loss is greater than the threshold then we haven't improved much, so stop
         # - else start from the top
+        # The loss is on the held out data if there is any, in which case the weights with the lowest
+        # loss are kept. Training also stops once the deadline has passed.
         start = time.time()
-        while True:
-            threshold = (1 - self.train_threshold_ratio) * self._loss(params, costs)[0]
+        l = best_loss = stopping_loss()
+        best_weights = self.tf_session.run(self.weights + self.biases) if num_validation > 0 else None
+        out_of_time = False
+        while not out_of_time:
+            threshold = (1 - self.train_threshold_ratio) * l
             self.log.debug("Training with threshold " + str(threshold))
             if threshold == 0:
                 break
-            tot = 0
             run_start = time.time()
-            for i in range(epochs):
-                # Split the data into random batches, and train on each batch
-                indices = np.random.permutation(len(params))
-                for j in range(int(math.ceil(len(params) / self.batch_size))):
-                    batch_indices = indices[j * self.batch_size : (j + 1) * self.batch_size]
-                    batch_input = lparams[batch_indices]
-                    batch_output = lcosts[batch_indices]
-                    self.tf_session.run(self.train_step,
-                                        feed_dict={self.input_placeholder: batch_input,
-                                                   self.output_placeholder: batch_output,
-                                                   self.regularisation_coefficient_placeholder: self.regularisation_coefficient,
-                                                   self.keep_prob_placeholder: self.keep_prob,
-                                                   })
-                if i % 10 == 0:
-                    (l, ul) = self._loss(params, costs)
-                    self.losses_list.append(l)
-                    self.log.info('Fit neural network with total training cost ' + str(l)
-                            + ', with unregularized cost ' + str(ul))
+            for i in range(0, epochs, 10):
+                train_feed_dict[self.epochs_placeholder] = min(10, epochs - i)
+                self.tf_session.run(self.train_epochs, feed_dict=train_feed_dict)
+                (l, ul) = self._loss(lparams, lcosts)
+                self.losses_list.append(l)
+                self.log.info('Fit neural network with total training cost ' + str(l)
+                        + ', with unregularized cost ' + str(ul))
+                if deadline is not None and time.time() > deadline:
+                    self.log.debug("Training stopped at deadline")
+                    out_of_time = True
+                    break
             self.log.debug("Run trained for: " + str(time.time() - run_start))
 
-            (l, ul) = self._loss(params, costs)
-            al = tot / float(epochs)
-            self.log.debug('Loss ' + str(l) + ', average loss ' + str(al))
+            l = stopping_loss()
+            self.log.debug('Loss ' + str(l))
+            if num_validation > 0 and l < best_loss:
+                best_loss = l
+                best_weights = self.tf_session.run(self.weights + self.biases)
             if l > threshold:
                 break
+        if best_weights is not None and l > best_loss:
+            for (variable, value) in zip(self.weights + self.biases, best_weights):
+                variable.load(value, self.tf_session)
+        self._export_weights()
         self.log.debug("Total trained for: " + str(time.time() - start))
 
     def cross_validation_loss(self, params, costs):
@@ -310,6 +458,8 @@ class SingleNeuralNet():
         Returns:
             float : Predicted cost at parameters
         '''
+        if self.numpy_inference:
+            return self._numpy_costs_and_gradients([params], False)[0]
         return self.tf_session.run(self.output_var, feed_dict={self.input_placeholder: [params]})[0][0]
         #runs = 100
         ## Do some runs with dropout, and return the smallest. This is kind of LCB.
@@ -326,8 +476,33 @@ class SingleNeuralNet():
         Returns:
             float : Predicted gradient at parameters
         '''
+        if self.numpy_inference:
+            return self._numpy_costs_and_gradients([params], True)[1][0]
         return self.tf_session.run(self.output_var_gradient, feed_dict={self.input_placeholder: [params]})[0][0]
 
+    def predict_costs(self,params):
+        '''
+        Produces predictions of the cost at each row of an array of params, with a single run of the session.
+
+        Returns:
+            array : Predicted costs at parameters
+        '''
+        if self.numpy_inference:
+            return self._numpy_costs_and_gradients(params, False)
+        return self.tf_session.run(self.output_var, feed_dict={self.input_placeholder: params})[:,0]
+
+    def predict_costs_and_gradients(self,params):
+        '''
+        Produces predictions of the cost and its gradient at each row of an array of params, with a single run of the session.
+
+        Returns:
+            tuple : Array of predicted costs and array of predicted gradients
+        '''
+        if self.numpy_inference:
+            return self._numpy_costs_and_gradients(params, True)
+        (costs, gradients) = self.tf_session.run([self.output_var, self.output_var_gradient], feed_dict={self.input_placeholder: params})
+        return (costs[:,0], gradients[0])
+
 
 class SampledNeuralNet():
     '''
@@ -363,6 +538,11 @@ class SampledNeuralNet():
         for n in self.nets:
             n.init()
 
+    def set_regularisation_coefficient(self, reg):
+        # The coefficient is fed to the graph when training, so changing it doesn't need a new graph.
+        for n in self.nets:
+            n.regularisation_coefficient = reg
+
     def load(self, archive, extra_search_dirs=None):
         for i, n in enumerate(self.nets):
             #n.load(archive[str(i)])
@@ -375,7 +555,7 @@ class SampledNeuralNet():
         #    ret[str(i)] = n.save()
         #return ret
 
-    def fit(self, params, costs, epochs):
+    def fit(self, params, costs, epochs, deadline=None):
         self.fit_count += 1
         # Every per'th fit we clear out a net and re-train it.
         #per = 2
@@ -387,7 +567,7 @@ class SampledNeuralNet():
         #    self.nets[index].init()
 
         for n in self.nets:
-            n.fit(params, costs, epochs)
+            n.fit(params, costs, epochs, deadline=deadline)
 
     def cross_validation_loss(self, params, costs):
         return np.mean([n.cross_validation_loss(params, costs) for n in self.nets])
@@ -406,6 +586,18 @@ class SampledNeuralNet():
             return self._random_net().predict_cost_gradient(params)
         #return np.mean([n.predict_cost_gradient(params) for n in self.nets])
 
+    def predict_costs(self,params):
+        if self.opt_net:
+            return self.opt_net.predict_costs(params)
+        else:
+            return self._random_net().predict_costs(params)
+
+    def predict_costs_and_gradients(self,params):
+        if self.opt_net:
+            return self.opt_net.predict_costs_and_gradients(params)
+        else:
+            return self._random_net().predict_costs_and_gradients(params)
+
     def start_opt(self):
         self.opt_net = self._random_net()
 
@@ -435,13 +627,34 @@ class NeuralNet():
             filenames when saving the neural nets. If set to None, then the
             default value for the SingleNeuralNet class will be used. Default
             None.
+        intra_op_threads (Optional int): The number of threads each TensorFlow
+            session may use within an operation. If set to None, TensorFlow
+            chooses. Default None.
+        hyperparameter_workers (Optional int): The number of candidate nets
+            trained at the same time when fitting the regularisation, each on
+            its own thread with its own TensorFlow session, which is limited to
+            an equal share of the cores. If set to None, one per candidate.
+            Default 1, which trains them one after another.
+        hyperparameter_fit_in_background (Optional bool): Whether to fit the
+            regularisation in the background. If True, the candidate nets are
+            trained on the data available when the fit is due while the current
+            net keeps being fitted and used for predictions, and the best
+            candidate is swapped in by the first call to fit_neural_net() after
+            they are all trained. Default False.
+        validation_fraction (Optional float): The fraction of the data held out
+            to decide when to stop training the net. If set to 0, the loss on
+            the training data is used. Default 0.
     '''
 
     def __init__(self,
                  num_params = None,
                  fit_hyperparameters = False,
                  learner_archive_dir = None,
-                 start_datetime = None):
+                 start_datetime = None,
+                 intra_op_threads = None,
+                 hyperparameter_workers = 1,
+                 hyperparameter_fit_in_background = False,
+                 validation_fraction = 0.):
 
         self.log = logging.getLogger(__name__)
         self.log.info('Initialising neural network impl')
@@ -454,13 +667,29 @@ class NeuralNet():
         self.fit_hyperparameters = fit_hyperparameters
         self.learner_archive_dir = learner_archive_dir
         self.start_datetime = start_datetime
+        self.intra_op_threads = intra_op_threads
+        self.hyperparameter_fit_in_background = bool(hyperparameter_fit_in_background)
+        self.validation_fraction = validation_fraction
 
         self.initial_epochs = 100
         self.subsequent_epochs = 20
+        self.regularisation_candidates = [0.001, 0.01, 0.1, 1, 10]
+
+        if hyperparameter_workers is None:
+            hyperparameter_workers = len(self.regularisation_candidates)
+        self.hyperparameter_workers = int(hyperparameter_workers)
+        if self.hyperparameter_workers <= 0:
+            self.log.error('Number of hyperparameter workers must be greater than zero:' + repr(self.hyperparameter_workers))
+            raise ValueError
 
         # Variables for tracking the current state of hyperparameter fitting.
         self.last_hyperfit = 0
         self.last_net_reg = 1e-8
+        # Nets whose graphs are kept to be re-initialised as regularisation candidates, the pool of
+        # threads that trains them, and the result of a fit that is still running in the background.
+        self.spare_nets = []
+        self.hyperparameter_pool = None
+        self.pending_hyperfit = None
 
         # The samples used to fit the scalers. When set, this will be a tuple of
         # (params samples, cost samples).
@@ -474,28 +703,109 @@ class NeuralNet():
 
     # Private helper methods.
 
-    def _make_net(self, reg):
+    def _make_net(self, reg, intra_op_threads=None):
         '''
         Helper method to create a new net with a specified regularisation coefficient. The net is not
         initialised, so you must call init() or load() on it before any other method.
 
         Args:
             reg (float): Regularisation coefficient.
+            intra_op_threads (Optional int): The number of threads the session may use within an
+                operation. If set to None, intra_op_threads of this NeuralNet is used. Default None.
         '''
-        def gelu_fast(_x):
-            return 0.5 * _x * (1 + tf.tanh(tf.sqrt(2 / np.pi) * (_x + 0.044715 * tf.pow(_x, 3))))
+        if intra_op_threads is None:
+            intra_op_threads = self.intra_op_threads
         creator = lambda: SingleNeuralNet(
                     self.num_params,
-                    [64]*5, [gelu_fast]*5,
+                    [64]*5, [_gelu_fast]*5,
                     0.2, # train_threshold_ratio
                     16, # batch_size
                     1., # keep_prob
                     reg,
                     self.losses_list,
+                    numpy_layer_activations=[(_gelu_fast_numpy, _gelu_fast_numpy_derivative)]*5,
+                    intra_op_threads=intra_op_threads,
+                    validation_fraction=self.validation_fraction,
                     learner_archive_dir=self.learner_archive_dir,
                     start_datetime=self.start_datetime)
         return SampledNeuralNet(creator, 1)
 
+    def _take_spare_nets(self, count):
+        '''
+        Helper method to get count nets for regularisation candidates, reusing the graphs of spare
+        nets and creating new nets only when there aren't enough. The nets must be re-initialised
+        before they are trained.
+        '''
+        nets = self.spare_nets[:count]
+        self.spare_nets = self.spare_nets[count:]
+        if len(nets) < count:
+            if self.hyperparameter_workers > 1:
+                intra_op_threads = max(1, mp.cpu_count() // self.hyperparameter_workers)
+            else:
+                intra_op_threads = None
+            nets += [self._make_net(self.last_net_reg, intra_op_threads=intra_op_threads)
+                     for _ in range(count - len(nets))]
+        return nets
+
+    def _fit_candidate(self, net, reg, train_params, train_costs, cv_params, cv_costs):
+        '''
+        Helper method to re-initialise a candidate net with a regularisation coefficient, train it
+        and return its cross validation loss.
+        '''
+        net.set_regularisation_coefficient(reg)
+        net.init()
+        net.fit(train_params, train_costs, self.initial_epochs)
+        return net.cross_validation_loss(cv_params, cv_costs)
+
+    def _start_hyperfit(self, all_params, all_costs):
+        '''
+        Helper method to start training a candidate net for each regularisation coefficient on the
+        pool of hyperparameter_workers threads, using 90% of the scaled data for training and the rest
+        for cross validation.
+        '''
+        # Split the data into training and cross validation
+        training_fraction = 0.9
+        split_index = int(training_fraction * len(all_params))
+        train_params = all_params[:split_index]
+        train_costs = all_costs[:split_index]
+        cv_params = all_params[split_index:]
+        cv_costs = all_costs[split_index:]
+
+        orig_cv_loss = self.net.cross_validation_loss(cv_params, cv_costs)
+
+        self.log.debug("Fitting regularisation, current cv loss=" + str(orig_cv_loss))
+
+        if self.hyperparameter_pool is None:
+            self.hyperparameter_pool = mpp.ThreadPool(self.hyperparameter_workers)
+        nets = self._take_spare_nets(len(self.regularisation_candidates))
+        cv_losses = self.hyperparameter_pool.map_async(
+                lambda net_and_reg: self._fit_candidate(*(net_and_reg + (train_params, train_costs, cv_params, cv_costs))),
+                list(zip(nets, self.regularisation_candidates)))
+        self.pending_hyperfit = (nets, cv_losses, orig_cv_loss)
+
+    def _finish_hyperfit(self):
+        '''
+        Helper method to wait for the candidate nets to be trained, then swap in the candidate with the
+        lowest cross validation loss if it does significantly better than the current net. The graphs
+        of the other nets are kept for the next fit.
+        '''
+        (nets, cv_losses, orig_cv_loss) = self.pending_hyperfit
+        self.pending_hyperfit = None
+        try:
+            cv_losses = cv_losses.get()
+        except Exception:
+            self.spare_nets += nets
+            raise
+        # Switch to a new regularisation coefficient if it does significantly better on the cross
+        # validation set than the old one.
+        best_index = int(np.argmin(cv_losses))
+        best_cv_loss = cv_losses[best_index]
+        if best_cv_loss < orig_cv_loss and best_cv_loss < 0.1 * orig_cv_loss:
+            self.last_net_reg = self.regularisation_candidates[best_index]
+            self.log.debug("Switching to reg=" + str(self.last_net_reg) + ", cv loss=" + str(best_cv_loss))
+            (self.net, nets[best_index]) = (nets[best_index], self.net)
+        self.spare_nets += nets
+
     def _fit_scaler(self):
         '''
         Fits the cost and param scalers based on the scaler_samples member variable.
@@ -542,6 +852,9 @@ class NeuralNet():
     def _unscale_cost(self, cost_scaled):
         return self._cost_scaler.inverse_transform([[cost_scaled - self._mean_offset]])[0][0]
 
+    def _unscale_costs(self, costs_scaled):
+        return self._cost_scaler.inverse_transform((costs_scaled - self._mean_offset).reshape(-1,1))[:,0]
+
     def _unscale_gradient(self, gradient_scaled):
         return np.multiply(gradient_scaled, self._gradient_unscale)
 
@@ -607,18 +920,32 @@ class NeuralNet():
 
     def destroy(self):
         '''
-        Destroys the net.
+        Destroys the net, after waiting for any regularisation fit running in the background.
         '''
+        if self.pending_hyperfit is not None:
+            self.pending_hyperfit[1].wait()
+            self.spare_nets += self.pending_hyperfit[0]
+            self.pending_hyperfit = None
+        if self.hyperparameter_pool is not None:
+            self.hyperparameter_pool.close()
+            self.hyperparameter_pool.join()
+            self.hyperparameter_pool = None
+        for net in self.spare_nets:
+            net.destroy()
+        self.spare_nets = []
         if not self.net is None:
             self.net.destroy()
 
-    def fit_neural_net(self, all_params, all_costs):
+    def fit_neural_net(self, all_params, all_costs, deadline=None):
         '''
         Fits the neural net to the data.
 
         Args:
             all_params (array): array of all parameter arrays
             all_costs (array): array of costs (associated with the corresponding parameters)
+            deadline (Optional float): A time, as returned by time.time(), after which training of
+                the net stops early. It does not apply to fitting the regularisation. If None, the
+                net is trained until the loss stops improving. Default None.
         '''
         if len(all_params) == 0:
             self.log.error('No data provided.')
@@ -637,48 +964,27 @@ class NeuralNet():
 
         all_params, all_costs = self._scale_params_and_cost_list(all_params, all_costs)
 
+        # Swap in the result of a regularisation fit that has finished in the background.
+        if self.pending_hyperfit is not None and self.pending_hyperfit[1].ready():
+            self._finish_hyperfit()
+
         if self.fit_hyperparameters:
             # Every 20 runs, re-fit the hyperparameters.
             n_fits = len(all_params)
             n_hyperfit = int(n_fits / 20.0)  # int() rounds down.
-            if n_hyperfit > self.last_hyperfit:
+            if n_hyperfit > self.last_hyperfit and self.pending_hyperfit is None:
                 self.last_hyperfit = n_hyperfit
 
                 # Fit regularisation
-
-                # Split the data into training and cross validation
-                training_fraction = 0.9
-                split_index = int(training_fraction * len(all_params))
-                train_params = all_params[:split_index]
-                train_costs = all_costs[:split_index]
-                cv_params = all_params[split_index:]
-                cv_costs = all_costs[split_index:]
-
-                orig_cv_loss = self.net.cross_validation_loss(cv_params, cv_costs)
-                best_cv_loss = orig_cv_loss
-
-                self.log.debug("Fitting regularisation, current cv loss=" + str(orig_cv_loss))
-
-                # Try a bunch of different regularisation parameters, switching to a new one if it
-                # does significantly better on the cross validation set than the old one.
-                for r in [0.001, 0.01, 0.1, 1, 10]:
-                    net = self._make_net(r)
-                    net.init()
-                    net.fit(train_params, train_costs, self.initial_epochs)
-                    this_cv_loss = net.cross_validation_loss(cv_params, cv_costs)
-                    if this_cv_loss < best_cv_loss and this_cv_loss < 0.1 * orig_cv_loss:
-                        best_cv_loss = this_cv_loss
-                        self.log.debug("Switching to reg=" + str(r) + ", cv loss=" + str(best_cv_loss))
-                        self.last_net_reg = r
-                        self.net.destroy()
-                        self.net = net
-                    else:
-                        net.destroy()
+                self._start_hyperfit(all_params, all_costs)
+                if not self.hyperparameter_fit_in_background:
+                    self._finish_hyperfit()
 
         self.net.fit(
                 all_params,
                 all_costs,
-                self.initial_epochs if first_fit else self.subsequent_epochs)
+                self.initial_epochs if first_fit else self.subsequent_epochs,
+                deadline=deadline)
 
     def predict_cost(self,params):
         '''
@@ -702,6 +1008,29 @@ class NeuralNet():
         '''
         return self._unscale_gradient(self.net.predict_cost_gradient(self._scale_params(params)))
 
+    def predict_costs(self,params):
+        '''
+        Produces predictions of the cost at each row of an array of params, scaling all of them at once and evaluating the net once.
+
+        Must not be called before fit_neural_net().
+
+        Returns:
+            array : Predicted costs at parameters
+        '''
+        return self._unscale_costs(self.net.predict_costs(self._param_scaler.transform(params)))
+
+    def predict_costs_and_gradients(self,params):
+        '''
+        Produces predictions of the cost and its gradient at each row of an array of params.
+
+        Must not be called before fit_neural_net().
+
+        Returns:
+            tuple : Array of predicted costs and array of predicted gradients
+        '''
+        (costs_scaled, gradients_scaled) = self.net.predict_costs_and_gradients(self._param_scaler.transform(params))
+        return (self._unscale_costs(costs_scaled), self._unscale_gradient(gradients_scaled))
+
     def start_opt(self):
         '''
         Starts an optimisation run. Until stop_opt() is called, predict_cost() and
@@ -156,6 +156,7 @@ class FakeExperiment(threading.Thread):
     Keyword Args:
         test_landscape (Optional TestLandscape): landscape to generate costs from.
         experiment_file_type (Optional [string]): currently supports: 'txt' where the output is a text file with the parameters as a list of numbers, and 'mat' a matlab file with variable parameters with the next_parameters. Default is 'txt'. 
+        atomic_file_handoff (Optional [bool]): If True the costs are written under a temporary name and then renamed, and the parameters are read as soon as their file appears. Should match the option of the FileInterface. Default False.
         
     Attributes
         self.end_event (Event): Used to trigger end of experiment. 
@@ -166,6 +167,7 @@ class FakeExperiment(threading.Thread):
                  experiment_file_type=mlu.default_interface_file_type,
                  exp_wait = 0,
                  poll_wait = 1,
+                 atomic_file_handoff = False,
                  **kwargs):
         
         super(FakeExperiment,self).__init__()
@@ -178,6 +180,7 @@ class FakeExperiment(threading.Thread):
         self.log = logging.getLogger(__name__)
         self.exp_wait = float(exp_wait)
         self.poll_wait = float(poll_wait)
+        self.atomic_file_handoff = bool(atomic_file_handoff)
         self.out_file_type = str(experiment_file_type)
         self.in_file_type = str(experiment_file_type)
         
@@ -203,7 +206,8 @@ class FakeExperiment(threading.Thread):
         self.log.debug('Entering FakeExperiment loop')
         while not self.end_event.is_set():
             if os.path.isfile(self.total_in_filename):
-                time.sleep(mlu.filewrite_wait) #wait for file to be written
+                if not self.atomic_file_handoff:
+                    time.sleep(mlu.filewrite_wait) #wait for file to be written
                 try:
                     in_dict = mlu.get_dict_from_file(self.total_in_filename, self.in_file_type)
                 except IOError:
@@ -223,7 +227,7 @@ class FakeExperiment(threading.Thread):
                     raise
                 cost_dict = self.test_landscape.get_cost_dict(params)
                 time.sleep(self.exp_wait)
-                mlu.save_dict_to_file(cost_dict, self.total_out_filename, self.out_file_type)
+                mlu.save_dict_to_file(cost_dict, self.total_out_filename, self.out_file_type, atomic=self.atomic_file_handoff)
                 
             else:
                 time.sleep(self.poll_wait)
@@ -13,6 +13,14 @@ import os
 import numpy as np
 import numpy.random as nr
 import base64
+import ast
+import re
+import time
+import threading
+import select
+import struct
+import ctypes
+import ctypes.util
 import mloop
 
 python_version = sys.version_info[0]
@@ -21,9 +29,17 @@ python_version = sys.version_info[0]
 if python_version < 3:
     import Queue #@UnresolvedImport @UnusedImport
     empty_exception = Queue.Empty
+    from collections import MutableMapping #@UnusedImport
 else:
     import queue
     empty_exception = queue.Empty
+    from collections.abc import MutableMapping #@UnusedImport
+
+#Shared memory is only available from python 3.8
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 
 default_interface_in_filename = 'exp_output'
@@ -36,6 +52,11 @@ default_log_filename = 'M-LOOP'
 
 filewrite_wait = 0.1
 
+#Archive values that only ever have items appended, which are appended to in place in 'h5' files
+h5_append_keys = ['out_params','out_type','out_extras','in_costs','in_uncers','in_bads','in_extras','in_run_indexs',
+                  'all_params','all_costs','all_uncers','bad_run_indexs']
+temp_file_prefix = '.tmp_'
+
 mloop_path = os.path.dirname(mloop.__file__)
 
 #Set numpy to have no limit on printing to ensure all values are saved
@@ -141,13 +162,25 @@ def dict_to_txt_file(tdict,filename):
         for key in tdict:
             out_file.write(str(key) + '=' + repr(tdict[key]).replace('\n', '').replace('\r', '') + '\n')
 
+def dict_to_txt_line(tdict):
+    '''
+    Method for writing a dict as a single line, with syntax similar to how files are input. Each entry is written as [key]=[value] and the entries are separated by commas. The line can be read back with txt_string_to_dict.
+    
+    Args:
+        tdict (dict): Dictionary to be written.
+    
+    Returns:
+        str : The line, without a new line character.
+    '''
+    return ', '.join(str(key) + '=' + repr(tdict[key]).replace('\n', '').replace('\r', '') for key in tdict)
+
 def txt_file_to_dict(filename):
     '''
     Method for taking a file and changing it to a dict. Every line in file is a new entry for the dictionary and each element should be written as::
     
         [key] = [value]
     
-    White space does not matter.
+    White space does not matter. The values are parsed by txt_string_to_dict.
     
     Args:
         filename (string): Filename of file.
@@ -156,19 +189,200 @@ def txt_file_to_dict(filename):
         dict : Dictionary of values in file. 
     '''
     with open(filename,'r') as in_file:
-        tdict_string = ''
-        for line in in_file:
-            temp = (line.partition('#')[0]).strip('\n').strip()
-            if temp != '':
-                tdict_string += temp+','    
-    #Setting up words for parsing a dict, ignore eclipse warnings
-    array = np.array    #@UnusedVariable
-    inf = float('inf')  #@UnusedVariable
-    nan = float('nan')  #@UnusedVariable
-    tdict = eval('dict('+tdict_string+')')
-    return tdict
-    
-def save_dict_to_file(dictionary,filename,file_type=None):
+        txt_string = in_file.read()
+    return txt_string_to_dict(txt_string)
+
+def txt_string_to_dict(txt_string):
+    '''
+    Method for parsing a string of lines in the format::
+    
+        [key] = [value]
+    
+    into a dict, without using eval. Comments start with #. Entries can also be separated with commas, and values in brackets can span several lines.
+    
+    Values can be python literals (numbers, strings, True, False, None, lists, tuples and dicts), inf and nan, attributes of numpy and logging such as logging.INFO, arithmetic on these, and the reprs of numpy arrays and scalars such as array([1., 2.]) or np.float64(0.5). Arrays of numbers are converted straight to numpy arrays, so large archives can be read quickly.
+    
+    Args:
+        txt_string (string): The lines to be parsed.
+        
+    Returns:
+        dict : Dictionary of values in the string. 
+    '''
+    return _TxtParser(txt_string).parse_dict()
+
+def _import_h5py():
+    '''
+    Import h5py, which is only needed for the 'h5' file type.
+    '''
+    try:
+        import h5py
+    except ImportError:
+        logging.getLogger(__name__).error('The h5py package must be installed to use the h5 file type.')
+        raise
+    return h5py
+
+def _h5_value_type(value):
+    '''
+    Get how a value is stored in an h5 file, see dict_to_h5_file.
+    '''
+    if value is None:
+        return 'none', None
+    if isinstance(value, str):
+        return 'str', None
+    if isinstance(value, (np.ndarray, np.generic)) and value.dtype.kind in 'biufc':
+        return 'array', np.asarray(value)
+    if isinstance(value, (bool, int, float, complex)):
+        return 'scalar', np.asarray(value)
+    if isinstance(value, list):
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            array = None
+        if array is not None and array.dtype.kind in 'biufc' and array.size > 0:
+            return 'list', array
+        return 'pickle_list', None
+    return 'pickle', None
+
+def _pickled_items(items):
+    '''
+    Pickle each of the items to an array of bytes.
+    '''
+    return [np.frombuffer(pickle.dumps(item, protocol=2), dtype=np.uint8) for item in items]
+
+def dict_to_h5_file(tdict,filename):
+    '''
+    Method for saving a dict to an HDF5 file, with the h5py package.
+    
+    Numbers and numeric arrays are saved as datasets, and lists of numbers or of equally sized numeric arrays are saved as numeric arrays. Other lists are saved with each item pickled separately, and any other values are pickled. 
+    
+    If the file already exists it is updated in place. The values of h5_append_keys, which hold the history of the runs, are saved in resizable datasets and only the items appended since the last save are written, so saving an archive after every run does not rewrite the whole history. 
+    
+    Args:
+        tdict (dict): Dictionary to be written to file.
+        filename (string): Filename for file. 
+    '''
+    h5py = _import_h5py()
+    with h5py.File(filename,'a') as out_file:
+        for key in list(out_file.keys()):
+            if key not in tdict:
+                del out_file[key]
+        for key, value in tdict.items():
+            key = str(key)
+            value_type, array = _h5_value_type(value)
+            if key in out_file and key in h5_append_keys and _append_to_h5_dataset(out_file[key], value_type, value, array):
+                continue
+            if key in out_file:
+                del out_file[key]
+            if value_type == 'none':
+                dataset = out_file.create_dataset(key, data=h5py.Empty('f'))
+            elif value_type == 'str':
+                dataset = out_file.create_dataset(key, data=value, dtype=h5py.string_dtype())
+            elif value_type in ('scalar', 'array', 'list'):
+                if array.ndim > 0 and key in h5_append_keys:
+                    dataset = out_file.create_dataset(key, data=array, maxshape=(None,)+array.shape[1:], chunks=True)
+                else:
+                    dataset = out_file.create_dataset(key, data=array)
+            elif value_type == 'pickle_list':
+                dataset = out_file.create_dataset(key, shape=(len(value),), maxshape=(None,), dtype=h5py.vlen_dtype(np.uint8))
+                for ind, item in enumerate(_pickled_items(value)):
+                    dataset[ind] = item
+            else:
+                dataset = out_file.create_dataset(key, data=np.void(pickle.dumps(value, protocol=2)))
+            dataset.attrs['mloop_type'] = value_type
+
+def _append_to_h5_dataset(dataset, value_type, value, array):
+    '''
+    Append the new items of a value to the resizable dataset that holds its earlier items.
+    
+    Returns:
+        bool : True if the value was appended, False if the dataset has to be rewritten because the type or shape of the value changed, or because it does not start with the items already in the dataset.
+    '''
+    if dataset.attrs.get('mloop_type') != value_type or len(dataset.maxshape) == 0 or dataset.maxshape[0] is not None:
+        return False
+    num_saved = dataset.shape[0]
+    if value_type == 'pickle_list':
+        if len(value) < num_saved:
+            return False
+        new_items = _pickled_items(value[max(num_saved-1, 0):])
+        if num_saved > 0 and dataset[num_saved-1].tobytes() != new_items.pop(0).tobytes():
+            return False
+        dataset.resize((len(value),))
+        for ind, item in enumerate(new_items):
+            dataset[num_saved+ind] = item
+        return True
+    if value_type not in ('array', 'list') or array.ndim == 0 or array.dtype != dataset.dtype or array.shape[1:] != dataset.shape[1:] or array.shape[0] < num_saved:
+        return False
+    if num_saved > 0 and np.asarray(dataset[num_saved-1]).tobytes() != array[num_saved-1].tobytes():
+        return False
+    dataset.resize(array.shape[0], axis=0)
+    dataset[num_saved:] = array[num_saved:]
+    return True
+
+def _h5_dataset_to_value(dataset):
+    '''
+    Read a value saved by dict_to_h5_file.
+    '''
+    value_type = dataset.attrs.get('mloop_type', 'array')
+    if value_type == 'none':
+        return None
+    if value_type == 'str':
+        value = dataset[()]
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+    if value_type == 'scalar':
+        return dataset[()].item()
+    if value_type == 'array':
+        return dataset[()]
+    if value_type == 'list':
+        array = dataset[()]
+        return array.tolist() if array.ndim == 1 else list(array)
+    if value_type == 'pickle_list':
+        return [pickle.loads(item.tobytes()) for item in dataset[()]]
+    return pickle.loads(dataset[()].tobytes())
+
+class H5Dict(MutableMapping):
+    '''
+    Dictionary of the values in an HDF5 file saved by dict_to_h5_file. Each value is only read from the file when it is first accessed, so large archives can be opened quickly. Values can also be set or deleted, which does not change the file.
+    
+    Args:
+        filename (string): Filename of file.
+    '''
+    
+    def __init__(self, filename):
+        h5py = _import_h5py()
+        self.filename = str(filename)
+        with h5py.File(self.filename,'r') as in_file:
+            self._keys = list(in_file.keys())
+        self._values = {}
+    
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            h5py = _import_h5py()
+            with h5py.File(self.filename,'r') as in_file:
+                self._values[key] = _h5_dataset_to_value(in_file[key])
+        return self._values[key]
+    
+    def __contains__(self, key):
+        # Checking for a key does not read its value.
+        return key in self._keys
+    
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            self._keys.append(key)
+        self._values[key] = value
+    
+    def __delitem__(self, key):
+        self._keys.remove(key)
+        self._values.pop(key, None)
+    
+    def __iter__(self):
+        return iter(list(self._keys))
+    
+    def __len__(self):
+        return len(self._keys)
+
+def save_dict_to_file(dictionary,filename,file_type=None,atomic=False):
     '''
     Method for saving a dictionary to a file, of a given format. 
     
@@ -178,13 +392,29 @@ def save_dict_to_file(dictionary,filename,file_type=None):
 
     Keyword Args:
         file_type (Optional str): The file_type for the file. Can be 'mat' for
-            matlab, 'txt' for text, or 'pkl' for pickle. If set to None, then
-            file_type will be automatically determined from the file extension.
-            Default None.
+            matlab, 'txt' for text, 'pkl' for pickle or 'h5' for HDF5. If set
+            to None, then file_type will be automatically determined from the
+            file extension. Default None.
+        atomic (Optional bool): If True the dictionary is first saved to a
+            temporary file in the same folder, which is then renamed to
+            filename. Another program watching for filename will then never
+            see a partially written file. Default False.
     '''
     # Automatically determine file_type if necessary.
     if file_type is None:
         file_type = get_file_type(filename)
+    
+    if atomic:
+        dirname, basename = os.path.split(filename)
+        temp_filename = os.path.join(dirname, temp_file_prefix + basename)
+        save_dict_to_file(dictionary,temp_filename,file_type)
+        if python_version < 3:
+            if os.path.isfile(filename):
+                os.remove(filename)
+            os.rename(temp_filename,filename)
+        else:
+            os.replace(temp_filename,filename)
+        return
 
     if file_type=='mat':
         si.savemat(filename,dictionary)
@@ -193,6 +423,8 @@ def save_dict_to_file(dictionary,filename,file_type=None):
     elif file_type=='pkl':
         with open(filename,'wb') as out_file:
             pickle.dump(dictionary,out_file) 
+    elif file_type=='h5':
+        dict_to_h5_file(dictionary,filename)
     else:
         raise ValueError 
     
@@ -205,12 +437,14 @@ def get_dict_from_file(filename,file_type=None):
     
     Keyword Args:
         file_type (Optional str): The file_type for the file. Can be 'mat' for
-            matlab, 'txt' for text, or 'pkl' for pickle. If set to None, then
-            file_type will be automatically determined from the file extension.
-            Default None.
+            matlab, 'txt' for text, 'pkl' for pickle or 'h5' for HDF5. If set
+            to None, then file_type will be automatically determined from the
+            file extension. Default None.
     
     Returns:
-        dict : Dictionary of values in file.
+        dict : Dictionary of values in file. For 'h5' files this is an
+            H5Dict, which only reads each value from the file when it is first
+            accessed.
     '''
     # Automatically determine file_type if necessary.
     if file_type is None:
@@ -223,10 +457,79 @@ def get_dict_from_file(filename,file_type=None):
     elif file_type=='pkl':
         with open(filename,'rb') as in_file:
             dictionary = pickle.load(in_file) 
+    elif file_type=='h5':
+        dictionary = H5Dict(filename)
     else:
         raise ValueError
     return dictionary
 
+def get_controller_archive_dict(filename, file_type=None):
+    '''
+    Method for getting the dictionary of a controller archive. If the archive is the summary of a journaled archive, because the optimization is still running or did not end cleanly, the history of the runs is rebuilt from the journal.
+    
+    Args:    
+        filename (str): The filename of the controller archive.
+    
+    Keyword Args:
+        file_type (Optional str): The file_type for the file. If set to None, then file_type will be automatically determined from the file extension. Default None.
+    
+    Returns:
+        dict : Dictionary of values in the archive, in the same format as a complete controller archive.
+    '''
+    archive_dict = get_dict_from_file(filename, file_type)
+    if 'archive_is_summary' in archive_dict and bool(np.squeeze(archive_dict['archive_is_summary'])):
+        journal_filename = os.path.join(os.path.dirname(filename), str(np.squeeze(archive_dict['journal_filename'])))
+        archive_dict.update(get_dict_from_controller_journal(journal_filename))
+        archive_dict['archive_is_summary'] = False
+    return archive_dict
+
+def get_dict_from_controller_journal(filename):
+    '''
+    Method for rebuilding the history of the runs from the journal of a controller archive. The journal has one line for each set of parameters sent to the experiment and for each cost received, written with dict_to_txt_line, after a line for the type of the learner of controllers that only record it once. An incomplete last line, from an optimization that did not end cleanly, is ignored.
+    
+    Args:
+        filename (str): The filename of the journal.
+    
+    Returns:
+        dict : The run history (out_params, out_type, out_extras, in_costs, in_uncers, in_bads, in_extras and in_run_indexs), the number of runs and the best run, with the same keys as a controller archive.
+    '''
+    log = logging.getLogger(__name__)
+    history = {'out_params':[], 'out_type':[], 'out_extras':[], 
+               'in_costs':[], 'in_uncers':[], 'in_bads':[], 'in_extras':[], 'in_run_indexs':[]}
+    best = {'best_cost':float('inf'), 'best_uncer':float('nan'), 'best_index':float('nan'), 'best_params':float('nan')}
+    with open(filename, 'r') as in_file:
+        lines = in_file.read().split('\n')
+    for line_num, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            record = txt_string_to_dict(line)
+        except ValueError:
+            if line_num >= len(lines) - 2:
+                log.warning('Ignoring incomplete last line of journal ' + filename)
+                break
+            raise
+        if record['record'] == 'type':
+            history['out_type'].append(record['param_type'])
+        elif record['record'] == 'out':
+            history['out_params'].append(record['params'])
+            if record['param_type'] is not None:
+                history['out_type'].append(record['param_type'])
+            history['out_extras'].append(record['extras'])
+        else:
+            history['in_costs'].append(record['cost'])
+            history['in_uncers'].append(record['uncer'])
+            history['in_bads'].append(record['bad'])
+            history['in_extras'].append(record['extras'])
+            history['in_run_indexs'].append(record['run_index'])
+            if record['cost'] < best['best_cost']:
+                best = {'best_cost':record['cost'], 'best_uncer':record['uncer'], 
+                        'best_index':len(history['in_costs']), 'best_params':history['out_params'][record['run_index']]}
+    history.update(best)
+    history['num_out_params'] = len(history['out_params'])
+    history['num_in_costs'] = len(history['in_costs'])
+    return history
+
 def get_file_type(filename):
     '''
     Get the file type of a file from the extension in its filename.
@@ -385,6 +688,75 @@ def chunk_list(list_, chunk_size):
     
     return [list_[i:(i+chunk_size)] for i in range(0, len(list_), chunk_size)]
 
+def minimize_batch(func, start_params, min_boundary, max_boundary, tol=1e-6, max_iterations=1000):
+    '''
+    Minimize a function within boundaries from several starting parameters at once.
+    
+    All the starts are advanced together by projected gradient descent, with a Barzilai-Borwein step size and a backtracking line search for each start, so each iteration evaluates the function once for the whole stack of parameters. Starts are dropped from the stack as they converge.
+    
+    Args:
+        func (function): Function that takes an array of parameters, with one set of parameters per row, and returns a tuple of the array of costs and the array of their gradients with respect to the parameters.
+        start_params (array): The starting parameters, one set of parameters per row.
+        min_boundary (array): The minimum value of each parameter.
+        max_boundary (array): The maximum value of each parameter.
+    
+    Keyword Args:
+        tol (Optional float): A start has converged when an iteration reduces its cost by less than tol times the magnitude of the cost (or one if that is smaller), or when no component of its projected gradient is larger than tol. Default 1e-6.
+        max_iterations (Optional int): The maximum number of iterations. Default 1000.
+    
+    Returns:
+        tuple : The array of the parameters found from each start and the array of their costs.
+    '''
+    min_boundary = np.asarray(min_boundary, dtype=float)
+    max_boundary = np.asarray(max_boundary, dtype=float)
+    params = np.clip(np.array(start_params, dtype=float), min_boundary, max_boundary)
+    costs, gradients = func(params)
+    costs = np.array(costs, dtype=float)
+    gradients = np.array(gradients, dtype=float)
+    # The first step moves each start by at most a hundredth of the range of the boundaries.
+    largest_gradients = np.max(np.abs(gradients), axis=1)
+    step_sizes = 0.01 * np.max(max_boundary - min_boundary) / np.maximum(largest_gradients, np.finfo(float).tiny)
+    min_move = np.finfo(float).eps * (1 + np.max(np.abs(max_boundary - min_boundary)))
+    active = np.arange(params.shape[0])
+    for _ in range(max_iterations):
+        if active.size == 0:
+            break
+        active_params = params[active]
+        active_costs = costs[active]
+        active_gradients = gradients[active]
+        trial_params = np.clip(active_params - step_sizes[active,np.newaxis] * active_gradients, min_boundary, max_boundary)
+        moves = trial_params - active_params
+        trial_costs, trial_gradients = func(trial_params)
+        trial_costs = np.asarray(trial_costs, dtype=float)
+        trial_gradients = np.asarray(trial_gradients, dtype=float)
+        accepted = trial_costs <= active_costs + 1e-4 * np.sum(active_gradients * moves, axis=1)
+        
+        # Move the starts whose step reduced the cost enough, and set their next steps with the Barzilai-Borwein formula.
+        accepted_moves = moves[accepted]
+        gradient_changes = trial_gradients[accepted] - active_gradients[accepted]
+        curvatures = np.sum(accepted_moves * gradient_changes, axis=1)
+        squared_moves = np.sum(accepted_moves**2, axis=1)
+        accepted_steps = step_sizes[active[accepted]]
+        positive = curvatures > 0
+        accepted_steps[positive] = squared_moves[positive] / curvatures[positive]
+        accepted_steps[~positive] *= 2
+        accepted_indexs = active[accepted]
+        params[accepted_indexs] = trial_params[accepted]
+        costs[accepted_indexs] = trial_costs[accepted]
+        gradients[accepted_indexs] = trial_gradients[accepted]
+        step_sizes[accepted_indexs] = accepted_steps
+        # Shorten the steps of the other starts.
+        step_sizes[active[~accepted]] *= 0.5
+        
+        decreases = active_costs - trial_costs
+        cost_scales = np.maximum(np.maximum(np.abs(active_costs), np.abs(trial_costs)), 1)
+        projected_gradients = np.clip(trial_params - trial_gradients, min_boundary, max_boundary) - trial_params
+        converged = np.where(accepted,
+                             (decreases <= tol * cost_scales) | (np.max(np.abs(projected_gradients), axis=1) <= tol),
+                             np.max(np.abs(moves), axis=1) <= min_move)
+        active = active[~converged]
+    return params, costs
+
 def _param_names_from_file_dict(file_dict):
     '''
     Extract the value for 'param_names' from a training dictionary.
@@ -466,4 +838,789 @@ class NullQueueListener():
 
 
 
-    
\ No newline at end of file
+    
+
+class ArchiveWriter(threading.Thread):
+    '''
+    Saves snapshots of an archive dict to a file on a background thread, so saving an archive does not delay the caller. If several snapshots are submitted while a file is being written only the latest is written next.
+    
+    The writer is owned by the thread that creates it. Any pending snapshot is written when close is called, or when the owning thread ends, for example because of an exception.
+    
+    Args:
+        filename (str): The filename for the saved file.
+        file_type (str): The file_type for the file, see save_dict_to_file.
+    '''
+    
+    def __init__(self, filename, file_type):
+        super(ArchiveWriter,self).__init__()
+        self.log = logging.getLogger(__name__)
+        self.filename = filename
+        self.file_type = file_type
+        self.owner_thread = threading.current_thread()
+        self.condition = threading.Condition()
+        self.pending_dict = None
+        self.closed = False
+        self.write_error = None
+        self.start()
+    
+    def save(self, dictionary):
+        '''
+        Submit a snapshot of the dictionary to be saved. Lists and arrays in the dictionary are copied so the caller can keep changing them. If the writer has been closed the dictionary is saved immediately.
+        
+        Args:
+            dictionary (dict): The dictionary to be saved.
+        '''
+        self._raise_write_error()
+        snapshot = {}
+        for key, value in dictionary.items():
+            if isinstance(value, list):
+                value = list(value)
+            elif isinstance(value, np.ndarray):
+                value = value.copy()
+            snapshot[key] = value
+        with self.condition:
+            if not self.closed:
+                self.pending_dict = snapshot
+                self.condition.notify()
+                return
+        save_dict_to_file(snapshot, self.filename, self.file_type)
+    
+    def close(self):
+        '''
+        Write any pending snapshot and stop the writer thread. Raises any error that occurred while writing.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.is_alive():
+            self.join()
+        self._raise_write_error()
+    
+    def _raise_write_error(self):
+        '''
+        Raise the error from the last failed write in the calling thread.
+        '''
+        if self.write_error is not None:
+            write_error, self.write_error = self.write_error, None
+            self.log.error('Failed to save archive ' + self.filename)
+            raise write_error
+    
+    def run(self):
+        '''
+        Write snapshots as they are submitted until the writer is closed or its owning thread has ended.
+        '''
+        while True:
+            with self.condition:
+                while self.pending_dict is None and not self.closed and self.owner_thread.is_alive():
+                    self.condition.wait(0.1)
+                snapshot = self.pending_dict
+                self.pending_dict = None
+                if snapshot is None:
+                    self.closed = True
+                    return
+            try:
+                save_dict_to_file(snapshot, self.filename, self.file_type)
+            except Exception as e:
+                self.log.error('Error while saving archive ' + self.filename + ':' + repr(e))
+                self.write_error = e
+
+class GrowableArray():
+    '''
+    An array that rows can be added to in amortized constant time. The rows are stored in a larger array whose capacity is doubled whenever it is full, so each row is only copied a constant number of times on average, rather than the whole array being copied every time a row is added.
+
+    Args:
+        row_shape (tuple): The shape of each row. An empty tuple for a one dimensional array of scalars.
+
+    Keyword Args:
+        initial_capacity (Optional int): The number of rows that can be added before the capacity is first doubled. Default 16.
+        dtype (Optional dtype): The data type of the array. Default float.
+    '''
+
+    def __init__(self, row_shape, initial_capacity=16, dtype=float):
+        self._data = np.empty((max(int(initial_capacity), 1),) + tuple(row_shape), dtype=dtype)
+        self._size = 0
+
+    @classmethod
+    def from_array(cls, array, dtype=float):
+        '''
+        Create a growable array that starts with the rows of array, which are copied.
+
+        Args:
+            array (array): The initial rows.
+
+        Keyword Args:
+            dtype (Optional dtype): The data type of the array. Default float.
+
+        Returns:
+            GrowableArray : The growable array.
+        '''
+        array = np.asarray(array, dtype=dtype)
+        growable = cls(array.shape[1:], initial_capacity=max(16, 2*len(array)), dtype=dtype)
+        growable.extend(array)
+        return growable
+
+    @property
+    def view(self):
+        '''
+        The rows added so far, as a view of the underlying storage, so no data is copied. The view stays valid when more rows are added, but it does not include them.
+        '''
+        return self._data[:self._size]
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        '''
+        Double the capacity until it is at least size.
+        '''
+        capacity = self._data.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        data = np.empty((capacity,) + self._data.shape[1:], dtype=self._data.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+
+    def append(self, row):
+        '''
+        Add a row.
+
+        Args:
+            row (array): The row to add, of shape row_shape.
+        '''
+        self._reserve(self._size + 1)
+        self._data[self._size] = row
+        self._size += 1
+
+    def extend(self, rows):
+        '''
+        Add several rows.
+
+        Args:
+            rows (array): The rows to add, one per entry along the first axis.
+        '''
+        rows = np.asarray(rows, dtype=self._data.dtype)
+        num_rows = len(rows)
+        if num_rows == 0:
+            return
+        self._reserve(self._size + num_rows)
+        self._data[self._size:self._size + num_rows] = rows
+        self._size += num_rows
+
+class SharedRunStore():
+    '''
+    Stores the parameters, costs, uncertainties and bad flags of runs in shared memory, so that a controller can pass runs to a learner in another process without pickling them. Each is stored in its own column, with one row per run.
+
+    The process that creates the store is the only one that appends to it. The columns are doubled in size when they are full, by copying them into a new block of shared memory. A store that is pickled, for example when the learner process is started, is reattached to the same shared memory in the new process and can then read the runs as views of the shared memory, starting from a cursor.
+
+    Args:
+        num_params (int): The number of parameters of each run.
+
+    Keyword Args:
+        initial_capacity (Optional int): The number of runs that can be stored before the columns are first doubled in size. Default 64.
+
+    Attributes:
+        name (str): The name of the shared memory block holding the number of runs and the generation of the columns.
+    '''
+
+    def __init__(self, num_params, initial_capacity=64):
+        if shared_memory is None:
+            raise NotImplementedError('Shared memory requires python 3.8 or later.')
+        self.num_params = int(num_params)
+        self.initial_capacity = int(initial_capacity)
+        if self.initial_capacity <= 0:
+            raise ValueError('Initial capacity must be greater than zero:' + repr(initial_capacity))
+        self.name = 'mloop_' + base64.b16encode(os.urandom(8)).decode().lower()
+        self.owner_pid = os.getpid()
+        self._header_memory = shared_memory.SharedMemory(name=self.name, create=True, size=16)
+        self._header = np.ndarray((2,), dtype=np.int64, buffer=self._header_memory.buf)
+        self._header[:] = 0
+        self._generation = None
+        self._columns_memory = None
+        self._retired_memories = []
+        self._allocate_columns(0)
+
+    def __getstate__(self):
+        return {'name':self.name,
+                'num_params':self.num_params,
+                'initial_capacity':self.initial_capacity,
+                'owner_pid':self.owner_pid}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._header_memory = shared_memory.SharedMemory(name=self.name)
+        self._header = np.ndarray((2,), dtype=np.int64, buffer=self._header_memory.buf)
+        self._generation = None
+        self._columns_memory = None
+        self._retired_memories = []
+
+    @property
+    def num_runs(self):
+        '''
+        The number of runs in the store.
+        '''
+        return int(self._header[0])
+
+    def _capacity(self, generation):
+        return self.initial_capacity * 2**generation
+
+    def _columns_name(self, generation):
+        return self.name + '_' + str(generation)
+
+    def _map_columns(self, memory, generation):
+        '''
+        Set the column arrays to views of a block of shared memory.
+        '''
+        capacity = self._capacity(generation)
+        self.params = np.ndarray((capacity, self.num_params), dtype=float, buffer=memory.buf)
+        offset = self.params.nbytes
+        (self.costs, self.uncers, self.bads) = [
+            np.ndarray((capacity,), dtype=float, buffer=memory.buf, offset=offset + index*capacity*8)
+            for index in range(3)]
+        if self._columns_memory is not None:
+            self._retire(self._columns_memory)
+        self._columns_memory = memory
+        self._generation = generation
+
+    def _retire(self, memory):
+        '''
+        Close a block of shared memory that is no longer used, unless views of it are still held elsewhere, in which case it is closed with the store.
+        '''
+        self._retired_memories.append(memory)
+        still_open = []
+        for old_memory in self._retired_memories:
+            try:
+                old_memory.close()
+            except BufferError:
+                still_open.append(old_memory)
+        self._retired_memories = still_open
+
+    def _allocate_columns(self, generation):
+        '''
+        Create the columns for a generation, copy the runs in the old columns into them and publish the new generation. Only called by the owner.
+        '''
+        capacity = self._capacity(generation)
+        memory = shared_memory.SharedMemory(name=self._columns_name(generation), create=True, size=capacity*(self.num_params+3)*8)
+        old_memory = self._columns_memory
+        num_runs = self.num_runs
+        if old_memory is not None:
+            old_columns = (self.params[:num_runs], self.costs[:num_runs], self.uncers[:num_runs], self.bads[:num_runs])
+        self._columns_memory = None
+        self._map_columns(memory, generation)
+        if old_memory is not None:
+            for (column, old_column) in zip((self.params, self.costs, self.uncers, self.bads), old_columns):
+                column[:num_runs] = old_column
+            del old_columns, column, old_column
+            self._header[1] = generation
+            old_memory.close()
+            old_memory.unlink()
+
+    def _attach_columns(self):
+        '''
+        Attach to the latest columns, if the owner has grown them since they were last attached.
+        '''
+        while self._generation != int(self._header[1]):
+            generation = int(self._header[1])
+            try:
+                memory = shared_memory.SharedMemory(name=self._columns_name(generation))
+            except FileNotFoundError:
+                if generation == int(self._header[1]):
+                    raise
+                # The columns have been grown again since the header was read.
+                continue
+            self._map_columns(memory, generation)
+
+    def append(self, params, cost, uncer, bad):
+        '''
+        Add a run to the store. Only the process that created the store can add runs.
+
+        Args:
+            params (array): The parameters of the run.
+            cost (float): The cost of the run.
+            uncer (float): The uncertainty of the cost.
+            bad (bool): Whether the run was bad.
+        '''
+        if os.getpid() != self.owner_pid:
+            raise RuntimeError('Runs can only be added to a shared run store by the process that created it.')
+        num_runs = self.num_runs
+        if num_runs == self._capacity(self._generation):
+            self._allocate_columns(self._generation + 1)
+        self.params[num_runs] = params
+        self.costs[num_runs] = cost
+        self.uncers[num_runs] = uncer
+        self.bads[num_runs] = bad
+        # Publish the run only once it has been written.
+        self._header[0] = num_runs + 1
+
+    def read(self, cursor):
+        '''
+        Get the runs added since cursor. The returned arrays are views of the shared memory, so no data is copied. They should not be kept, as they are only guaranteed to be up to date until more runs are added.
+
+        Args:
+            cursor (int): The number of runs that have already been read.
+
+        Returns:
+            tuple : The parameters, costs, uncertainties and bad flags of the new runs, as arrays with one row per run. The bad flags are 1.0 for bad runs and 0.0 otherwise. The new cursor is cursor plus the number of rows.
+        '''
+        num_runs = self.num_runs
+        self._attach_columns()
+        return (self.params[cursor:num_runs], self.costs[cursor:num_runs], self.uncers[cursor:num_runs], self.bads[cursor:num_runs])
+
+    def close(self):
+        '''
+        Close the store in this process. The shared memory is also freed if this is the process that created the store, after which no process can read from it.
+        '''
+        if self._header_memory is None:
+            return
+        for attribute in ('params', 'costs', 'uncers', 'bads', '_header'):
+            self.__dict__.pop(attribute, None)
+        if self._columns_memory is not None:
+            self._retire(self._columns_memory)
+            if os.getpid() == self.owner_pid:
+                self._columns_memory.unlink()
+            self._columns_memory = None
+        for memory in self._retired_memories:
+            try:
+                memory.close()
+            except BufferError:
+                pass
+        self._retired_memories = []
+        self._header_memory.close()
+        if os.getpid() == self.owner_pid:
+            self._header_memory.unlink()
+        self._header_memory = None
+
+class FileWatcher():
+    '''
+    Waits for a file to be written by another program. On Linux inotify is used to wake as soon as the file has been closed after writing or moved into place. If inotify is not available the watcher falls back to polling for the file, and then waits write_wait for it to be written.
+    
+    The watcher only sees files written after it was created, so it should be created before the other program is asked to write the file. A file that already exists when the watcher is created is treated as ready.
+    
+    Args:
+        filename (str): The file to watch for.
+    
+    Keyword Args:
+        write_wait (Optional float): Time in seconds to wait for the file to be written once it has been found when polling. Can be 0 if the file is moved into place once it is complete. If None, filewrite_wait. Default None.
+    
+    Attributes:
+        inotify (bool): True if inotify is being used, False if polling.
+    '''
+    
+    #Flags from sys/inotify.h
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _event_header = struct.Struct('iIII')
+    
+    def __init__(self, filename, write_wait=None):
+        self.log = logging.getLogger(__name__)
+        self.filename = str(filename)
+        if write_wait is None:
+            write_wait = filewrite_wait
+        self.write_wait = float(write_wait)
+        self.basename = os.path.basename(self.filename)
+        self.fd = None
+        try:
+            self._start_inotify()
+        except (OSError, AttributeError, TypeError) as e:
+            self.log.debug('inotify not available, polling for ' + self.filename + ' instead. Reason:' + repr(e))
+            self.close()
+        self.inotify = self.fd is not None
+        self.ready = self.inotify and os.path.isfile(self.filename)
+    
+    def _start_inotify(self):
+        '''
+        Create the inotify instance and watch the directory of the file.
+        '''
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.fd = fd
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if libc.inotify_add_watch(self.fd, dirname.encode(), self._IN_CLOSE_WRITE | self._IN_MOVED_TO) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for ' + dirname)
+    
+    def wait(self, timeout):
+        '''
+        Wait for the file to be written.
+        
+        The events that arrived since the last wait are read first. An event for the file only counts if the file exists, so events left over from a file that has already been read and removed, or from a file that was closed several times while it was written, do not wake the watcher again.
+        
+        Args:
+            timeout (float): The maximum time to wait in seconds.
+        
+        Returns:
+            bool : True if the file has been written and can be read, False if the timeout was reached first.
+        '''
+        if not self.inotify:
+            if os.path.isfile(self.filename):
+                time.sleep(self.write_wait) #wait for file to be written to disk
+                return True
+            time.sleep(timeout)
+            return False
+        found = self.ready
+        self.ready = False
+        while select.select([self.fd], [], [], 0)[0]:
+            found = self._read_events() or found
+        end_time = time.time() + timeout
+        while True:
+            if found and os.path.isfile(self.filename):
+                return True
+            readable = select.select([self.fd], [], [], max(end_time - time.time(), 0))[0]
+            if not readable:
+                return False
+            found = self._read_events()
+    
+    def _read_events(self):
+        '''
+        Read the pending inotify events.
+        
+        Returns:
+            bool : True if one of the events was for the watched file.
+        '''
+        data = os.read(self.fd, 65536)
+        found = False
+        offset = 0
+        while offset + self._event_header.size <= len(data):
+            _, _, _, name_len = self._event_header.unpack_from(data, offset)
+            offset += self._event_header.size
+            name = data[offset:offset + name_len].rstrip(b'\0').decode()
+            offset += name_len
+            if name == self.basename:
+                found = True
+        return found
+    
+    def close(self):
+        '''
+        Stop watching and release the inotify instance.
+        '''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.inotify = False
+
+class _TxtParser():
+    '''
+    Recursive descent parser for the key = value format used by txt files. See txt_string_to_dict.
+    
+    Number and string literals are read as python reads them, including complex numbers such as 1.+2.j, hexadecimal, octal and binary integers, underscores in numbers and adjacent strings, which are concatenated. Other python expressions are deliberately not supported, because the text is not evaluated: lambdas, comprehensions, comparison, boolean and bitwise operators, conditional expressions, subscripts, f-strings and calls to anything other than the callables listed below.
+    
+    Args:
+        text (str): The text to be parsed.
+    '''
+    
+    _whitespace = re.compile(r'[ \t\r\f\v]*(?:#[^\n]*)?')
+    _number = re.compile(r'0[xX](?:_?[0-9a-fA-F])+|0[oO](?:_?[0-7])+|0[bB](?:_?[01])+'
+                         r'|(?:\d(?:_?\d)*(?:\.(?:\d(?:_?\d)*)?)?|\.\d(?:_?\d)*)(?:[eE][-+]?\d(?:_?\d)*)?[jJ]?')
+    _name = re.compile(r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*')
+    _string = re.compile(r'''[uUbBrR]{0,2}(?:'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")''')
+    _brackets = re.compile(r'[\[\]]')
+    _separators = re.compile(r'[\[\],]\s*(.?)')
+    _numeric_block = re.compile(r'[-+0-9.eEinfa,\s\[\]]*\Z')
+    _float_chars = re.compile(r'[.eEn]')
+    
+    _constants = {'True':True, 'False':False, 'None':None, 'inf':float('inf'), 'nan':float('nan'),
+                  'infj':complex(0, float('inf')), 'nanj':complex(0, float('nan'))}
+    _callables = {'array':np.array, 'dict':dict, 'list':list, 'tuple':tuple, 'set':set, 
+                  'float':float, 'int':int, 'complex':complex, 'bool':bool, 'str':str}
+    _modules = {'np':np, 'numpy':np, 'logging':logging}
+    _array_callables = ('array', 'np.array', 'numpy.array')
+    
+    #Binary operators, from lowest to highest precedence
+    _operators = [{'+':lambda a,b: a+b, '-':lambda a,b: a-b},
+                  {'*':lambda a,b: a*b, '/':lambda a,b: a/b, '//':lambda a,b: a//b, '%':lambda a,b: a%b}]
+    
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.depth = 0
+    
+    def error(self, message):
+        '''
+        Raise a ValueError describing where the text could not be parsed.
+        '''
+        line_num = self.text.count('\n', 0, self.pos) + 1
+        raise ValueError(message + ' on line ' + str(line_num) + ' near: ' + repr(self.text[self.pos:self.pos+40]))
+    
+    def skip(self):
+        '''
+        Move past white space and comments. New lines are only skipped inside brackets.
+        '''
+        while True:
+            self.pos = self._whitespace.match(self.text, self.pos).end()
+            if self.depth > 0 and self.text.startswith('\n', self.pos):
+                self.pos += 1
+            else:
+                return
+    
+    def peek(self, length=1):
+        '''
+        Return the next characters after any white space.
+        '''
+        self.skip()
+        return self.text[self.pos:self.pos+length]
+    
+    def expect(self, char):
+        '''
+        Move past the character expected next.
+        '''
+        if self.peek() != char:
+            self.error('Expected ' + repr(char))
+        self.pos += 1
+    
+    def parse_dict(self):
+        '''
+        Parse all the key = value entries in the text.
+        '''
+        tdict = {}
+        while True:
+            while self.peek() in ('\n', ','):
+                self.pos += 1
+            if self.pos >= len(self.text):
+                return tdict
+            match = self._name.match(self.text, self.pos)
+            if match is None or '.' in match.group():
+                self.error('Expected a key')
+            key = match.group()
+            self.pos = match.end()
+            self.expect('=')
+            if key in tdict:
+                self.error('Repeated key ' + repr(key))
+            tdict[key] = self.parse_value()
+            if self.peek() not in ('\n', ',', ''):
+                self.error('Expected a new line after the value of ' + repr(key))
+    
+    def parse_value(self, precedence=0):
+        '''
+        Parse a value, including any arithmetic with operators of at least the precedence given.
+        '''
+        if precedence == len(self._operators):
+            return self.parse_power()
+        value = self.parse_value(precedence+1)
+        operators = self._operators[precedence]
+        while True:
+            op = self.peek(2)
+            if op not in operators:
+                op = op[:1]
+            if op not in operators or self.text.startswith('**', self.pos):
+                return value
+            self.pos += len(op)
+            value = operators[op](value, self.parse_value(precedence+1))
+    
+    def parse_power(self):
+        '''
+        Parse a unary operator or a power.
+        '''
+        char = self.peek()
+        if char == '-':
+            self.pos += 1
+            return -self.parse_power()
+        if char == '+':
+            self.pos += 1
+            return +self.parse_power()
+        value = self.parse_atom()
+        if self.peek(2) == '**':
+            self.pos += 2
+            value = value ** self.parse_power()
+        return value
+    
+    def parse_atom(self):
+        '''
+        Parse a single value.
+        '''
+        char = self.peek()
+        if char == '[':
+            return list(self.parse_sequence('[', ']')[0])
+        if char == '(':
+            items, trailing_comma = self.parse_sequence('(', ')')
+            if len(items) == 1 and not trailing_comma:
+                return items[0]
+            return tuple(items)
+        if char == '{':
+            return self.parse_dict_literal()
+        match = self._number.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            token = match.group().replace('_', '')
+            if token[-1] in 'jJ':
+                return complex(0, float(token[:-1]))
+            if token[:2] in ('0x', '0X', '0o', '0O', '0b', '0B'):
+                return int(token, 0)
+            if self._float_chars.search(token) is None:
+                return int(token)
+            return float(token)
+        match = self._string.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            value = ast.literal_eval(match.group())
+            #Adjacent strings are concatenated
+            while True:
+                self.skip()
+                match = self._string.match(self.text, self.pos)
+                if match is None:
+                    return value
+                self.pos = match.end()
+                value += ast.literal_eval(match.group())
+        match = self._name.match(self.text, self.pos)
+        if match is not None:
+            self.pos = match.end()
+            return self.parse_name(match.group())
+        self.error('Unable to parse value')
+    
+    def parse_name(self, name):
+        '''
+        Parse a constant, an attribute of a module, a dtype name or a call.
+        '''
+        if self.peek() == '(':
+            return self.parse_call(name)
+        if name in self._constants:
+            return self._constants[name]
+        module_name, _, attribute = name.partition('.')
+        if module_name in self._modules and attribute and '.' not in attribute:
+            try:
+                return getattr(self._modules[module_name], attribute)
+            except AttributeError:
+                pass
+        else:
+            #Bare dtype names appear in the reprs of numpy arrays, e.g. dtype=float32
+            try:
+                return np.dtype(name)
+            except TypeError:
+                pass
+        self.error('Unknown name ' + repr(name))
+    
+    def parse_call(self, name):
+        '''
+        Parse a call to one of the allowed callables, such as array([1., 2.]).
+        '''
+        module_name, _, attribute = name.partition('.')
+        numpy_attribute = getattr(np, attribute, None) if self._modules.get(module_name) is np else None
+        if name in self._callables:
+            func = self._callables[name]
+        elif name in self._array_callables:
+            func = np.array
+        elif isinstance(numpy_attribute, type) and issubclass(numpy_attribute, np.generic):
+            func = numpy_attribute
+        else:
+            self.error('Unknown function ' + repr(name))
+        self.expect('(')
+        self.depth += 1
+        args = []
+        kwargs = {}
+        if name in self._array_callables and self.peek() == '[':
+            array = self.parse_numeric_block()
+            if array is not None:
+                args.append(array)
+                if self.peek() == ',':
+                    self.pos += 1
+        while self.peek() != ')':
+            match = self._name.match(self.text, self.pos)
+            if match is not None:
+                after_name = self._whitespace.match(self.text, match.end()).end()
+            if match is not None and self.text.startswith('=', after_name) and not self.text.startswith('==', after_name):
+                self.pos = after_name + 1
+                kwargs[match.group()] = self.parse_value()
+            else:
+                args.append(self.parse_value())
+            if self.peek() != ')':
+                self.expect(',')
+        self.pos += 1
+        self.depth -= 1
+        if name in self._array_callables and 'shape' in kwargs:
+            #Empty arrays with more than one dimension are written as array([], shape=(0, 2), dtype=float64)
+            shape = kwargs.pop('shape')
+            return func(*args, **kwargs).reshape(shape)
+        return func(*args, **kwargs)
+    
+    def parse_numeric_block(self):
+        '''
+        Parse nested lists of numbers straight into a numpy array. Returns None, without moving, if the lists contain anything else or have an irregular shape.
+        '''
+        start = self.pos
+        depth = 0
+        counts = []
+        for match in self._brackets.finditer(self.text, start):
+            if match.group() == '[':
+                depth += 1
+                if depth > len(counts):
+                    counts.append(0)
+                counts[depth-1] += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    end = match.end()
+                    break
+        else:
+            return None
+        block = self.text[start:end]
+        if self._numeric_block.match(block) is None:
+            return None
+        tokens = block.replace('[', ' ').replace(']', ' ').split(',')
+        if any(not token.strip() for token in tokens):
+            return None
+        shape = [counts[ind+1]//counts[ind] for ind in range(len(counts)-1)] + [len(tokens)//counts[-1]]
+        if int(np.prod(shape)) != len(tokens) or any(counts[ind+1] % counts[ind] for ind in range(len(counts)-1)):
+            return None
+        #The counts only give the shape if the lists are regular, so check the length of each list and that numbers only appear in the innermost lists
+        lengths = []
+        for match in self._separators.finditer(block):
+            if match.group()[0] == ']':
+                if lengths.pop() != shape[len(lengths)]:
+                    return None
+                continue
+            if match.group()[0] == '[':
+                lengths.append(1)
+            else:
+                lengths[-1] += 1
+            if (match.group(1) == '[') != (len(lengths) < len(shape)):
+                return None
+        try:
+            if self._float_chars.search(block) is None:
+                array = np.array(tokens).astype(np.int64)
+            else:
+                array = np.array(tokens).astype(float)
+        except ValueError:
+            return None
+        self.pos = end
+        return array.reshape(shape)
+    
+    def parse_sequence(self, open_char, close_char):
+        '''
+        Parse the comma separated values in a list or tuple.
+        
+        Returns:
+            items (list): The values.
+            trailing_comma (bool): True if the last value was followed by a comma.
+        '''
+        self.expect(open_char)
+        self.depth += 1
+        items = []
+        trailing_comma = False
+        while self.peek() != close_char:
+            items.append(self.parse_value())
+            trailing_comma = self.peek() == ','
+            if trailing_comma:
+                self.pos += 1
+            elif self.peek() != close_char:
+                self.error('Expected ' + repr(close_char))
+        self.pos += 1
+        self.depth -= 1
+        return items, trailing_comma
+    
+    def parse_dict_literal(self):
+        '''
+        Parse a dict written as {key: value, ...}.
+        '''
+        self.expect('{')
+        self.depth += 1
+        tdict = {}
+        while self.peek() != '}':
+            key = self.parse_value()
+            self.expect(':')
+            tdict[key] = self.parse_value()
+            if self.peek() != '}':
+                self.expect(',')
+        self.pos += 1
+        self.depth -= 1
+        return tdict
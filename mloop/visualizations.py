@@ -9,12 +9,14 @@ import mloop.learners as mll
 import mloop.controllers as mlc
 import numpy as np
 import logging
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 import warnings
 
+# matplotlib is only imported by _import_matplotlib() when plots are made.
+plt = None
+mpl = None
+cmap = None
+
 figure_counter = 0
-cmap = plt.get_cmap('hsv')
 run_label = 'Run number'
 fit_label = 'Fit number'
 cost_label = 'Cost'
@@ -26,6 +28,16 @@ noise_label = 'Noise level'
 _DEFAULT_LEGEND_LOC = 2
 legend_loc = _DEFAULT_LEGEND_LOC
 
+def _import_matplotlib():
+    '''
+    Import matplotlib as mpl and matplotlib.pyplot as plt, and set up cmap.
+    '''
+    global plt, mpl, cmap
+    if plt is None:
+        import matplotlib as mpl
+        import matplotlib.pyplot as plt
+        cmap = plt.get_cmap('hsv')
+
 def set_legend_location(loc=None):
     '''
     Set the location of the legend in future figures.
@@ -265,6 +277,7 @@ def _color_from_controller_name(controller_name):
     '''
     Gives a color (as a number between zero an one) corresponding to each controller name string.
     '''
+    _import_matplotlib()
     global cmap
     return cmap(float(mlc.controller_dict[controller_name])/float(mlc.number_of_controllers))
 
@@ -272,6 +285,7 @@ def _color_list_from_num_of_params(num_of_params):
     '''
     Gives a list of colors based on the number of parameters.
     '''
+    _import_matplotlib()
     global cmap
     return [cmap(float(x)/num_of_params) for x in range(num_of_params)]
 
@@ -299,6 +313,7 @@ def configure_plots():
     '''
     Configure the setting for the plots.
     '''
+    _import_matplotlib()
     mpl.rcParams['lines.linewidth'] = 2.0
     mpl.rcParams['lines.markersize'] = 6.0
     mpl.rcParams['font.size'] = 16.0
@@ -350,6 +365,7 @@ class ControllerVisualizer():
                  file_type=None,
                  **kwargs):
 
+        _import_matplotlib()
         self.log = logging.getLogger(__name__)
 
         self.filename = str(filename)
@@ -359,7 +375,7 @@ class ControllerVisualizer():
         self.file_type = str(file_type)
         if not mlu.check_file_type_supported(self.file_type):
             self.log.error('File type not supported: ' + repr(self.file_type))
-        controller_dict = mlu.get_dict_from_file(self.filename, self.file_type)
+        controller_dict = mlu.get_controller_archive_dict(self.filename, self.file_type)
 
         self.archive_type = controller_dict['archive_type']
         if 'archive_type' in controller_dict and not (controller_dict['archive_type'] == 'controller'):
@@ -373,6 +389,13 @@ class ControllerVisualizer():
         self.in_costs = np.squeeze(np.array(controller_dict['in_costs']))
         self.in_uncers = np.squeeze(np.array(controller_dict['in_uncers']))
         self.in_bads = np.squeeze(list(controller_dict['in_bads']))
+        # Archives from controllers with several runs in flight record which
+        # parameters each cost belongs to. Older archives received the costs in
+        # the same order as the parameters were sent.
+        if 'in_run_indexs' in controller_dict:
+            self.in_run_indexs = np.array(mlu.safe_cast_to_list(controller_dict['in_run_indexs']), dtype=int)[:self.num_in_costs]
+        else:
+            self.in_run_indexs = np.arange(self.num_in_costs)
         self.best_index = int(controller_dict['best_index'])
         self.num_params = int(controller_dict['num_params'])
         self.min_boundary = np.squeeze(np.array(controller_dict['min_boundary']))
@@ -387,7 +410,13 @@ class ControllerVisualizer():
             self.finite_flag = False
 
         self.unique_types = set(self.out_type)
-        self.cost_colors = [_color_from_controller_name(x) for x in self.out_type]
+        # Controllers with a single learner record its type once rather than
+        # for every run.
+        if len(self.out_type) == 1:
+            run_types = self.out_type * self.num_out_params
+        else:
+            run_types = self.out_type
+        self.cost_colors = [_color_from_controller_name(x) for x in run_types]
         self.in_numbers = np.arange(1,self.num_in_costs+1)
         self.out_numbers = np.arange(1,self.num_out_params+1)
         self.param_numbers = np.arange(self.num_params)
@@ -448,7 +477,9 @@ class ControllerVisualizer():
         in_numbers = self.in_numbers[:self.num_in_costs]
         in_costs = self.in_costs[:self.num_in_costs]
         in_uncers = self.in_uncers[:self.num_in_costs]
-        cost_colors = self.cost_colors[:self.num_in_costs]
+        # The costs may have arrived in a different order from the parameters,
+        # so colour each one by the learner that sent its parameters.
+        cost_colors = [self.cost_colors[i] for i in self.in_run_indexs]
 
         plt.scatter(in_numbers, in_costs+in_uncers, marker='_', color='k')
         plt.scatter(in_numbers, in_costs-in_uncers, marker='_', color='k')
@@ -556,7 +587,7 @@ class ControllerVisualizer():
         plt.figure(figure_counter)
 
         if self.finite_flag:
-            scaled_params = self.scaled_params[:self.num_in_costs,:]
+            scaled_params = self.scaled_params[self.in_run_indexs,:]
             for ind in range(num_params):
                 param_index = parameter_subset[ind]
                 color = param_colors[ind]
@@ -566,7 +597,7 @@ class ControllerVisualizer():
                 plt.xlabel(scale_param_label)
                 plt.xlim((0,1))
         else:
-            out_params = self.out_params[:self.num_in_costs, :]
+            out_params = self.out_params[self.in_run_indexs, :]
             for ind in range(num_params):
                 param_index = parameter_subset[ind]
                 color = param_colors[ind]
@@ -623,6 +654,7 @@ class DifferentialEvolutionVisualizer():
                  file_type=None,
                  **kwargs):
 
+        _import_matplotlib()
         self.log = logging.getLogger(__name__)
 
         self.filename = str(filename)
@@ -800,6 +832,7 @@ class GaussianProcessVisualizer(mll.GaussianProcessLearner):
 
     def __init__(self, filename, file_type=None, **kwargs):
 
+        _import_matplotlib()
         super(GaussianProcessVisualizer, self).__init__(gp_training_filename = filename,
                                                         gp_training_file_type = file_type,
                                                         gp_training_override_kwargs=True,
@@ -1216,8 +1249,7 @@ class NeuralNetVisualizer(mll.NeuralNetLearner):
 
     def __init__(self, filename, file_type = None, **kwargs):
 
-
-
+        _import_matplotlib()
         super(NeuralNetVisualizer, self).__init__(nn_training_filename = filename,
                                                   nn_training_file_type = file_type,
                                                   update_hyperparameters = False,
@@ -1315,16 +1347,16 @@ class NeuralNetVisualizer(mll.NeuralNetLearner):
                 raise ValueError
 
         res = []
+        cross_parameter_arrays = np.array([ np.linspace(min_p, max_p, points) for (min_p,max_p) in zip(self.min_boundary,self.max_boundary)])
+        # Evaluate the cross sections along all of the parameters together.
+        sample_parameters = np.tile(np.asarray(cross_section_center, dtype=float), (self.num_params, points, 1))
+        for ind in range(self.num_params):
+            sample_parameters[ind, :, ind] = cross_parameter_arrays[ind]
+        sample_parameters = sample_parameters.reshape(-1, self.num_params)
         for net_index in range(self.num_nets):
-            cross_parameter_arrays = [ np.linspace(min_p, max_p, points) for (min_p,max_p) in zip(self.min_boundary,self.max_boundary)]
-            scaled_cost_arrays = []
-            for ind in range(self.num_params):
-                sample_parameters = np.array([cross_section_center for _ in range(points)])
-                sample_parameters[:, ind] = cross_parameter_arrays[ind]
-                costs = self.predict_costs_from_param_array(sample_parameters, net_index)
-                scaled_cost_arrays.append(costs)
-            cross_parameter_arrays = np.array(cross_parameter_arrays)
-            cost_arrays = self.cost_scaler.inverse_transform(np.array(scaled_cost_arrays))
+            costs = self.predict_costs_from_param_array(sample_parameters, net_index)
+            scaled_cost_arrays = costs.reshape(self.num_params, points)
+            cost_arrays = self.cost_scaler.inverse_transform(scaled_cost_arrays)
             res.append((cross_parameter_arrays, cost_arrays))
         return res
 
@@ -17,5 +17,15 @@ def main(argv):
     print('cost = '+str(cost_dict['cost']))
     print('M-LOOP_end')
     
+def persistent_main():
+    
+    #Run as a persistent worker, reading the parameters of each run from a line on stdin
+    for line in sys.stdin:
+        main(line.split())
+        sys.stdout.flush()
+    
 if __name__ == '__main__':
-    main(sys.argv[1:])
\ No newline at end of file
+    if sys.argv[1:] == ['--persistent']:
+        persistent_main()
+    else:
+        main(sys.argv[1:])
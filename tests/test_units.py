@@ -4,11 +4,22 @@ Unit test for all of the example scripts provided in the examples folder.
 from __future__ import absolute_import, division, print_function
 
 import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import math
 import mloop.interfaces as mli
 import mloop.controllers as mlc
+import mloop.learners as mll
+import mloop.utilities as mlu
+import mloop.testing as mlt
+import logging
 import numpy as np
+import sklearn.gaussian_process as skg
 import multiprocessing as mp
 
 class CostListInterface(mli.Interface):
@@ -24,6 +35,55 @@ class CostListInterface(mli.Interface):
         self.call_count += 1
         return cost_dict
 
+class ReversingInterface(mli.Interface):
+    '''
+    Interface that evaluates the parameters in batches and returns the costs of each batch in reverse order, like an experiment with several runs in flight that complete out of order.
+    '''
+    def __init__(self, batch_size, **kwargs):
+        super(ReversingInterface,self).__init__(**kwargs)
+        self.max_parallel_runs = batch_size
+        self.test_landscape = mlt.TestLandscape(num_params=2)
+    def run(self):
+        while not self.end_event.is_set():
+            try:
+                params_dicts = [self.params_out_queue.get(True, 0.1)]
+            except mlu.empty_exception:
+                continue
+            while len(params_dicts) < self.max_parallel_runs:
+                try:
+                    params_dicts.append(self.params_out_queue.get(True, 0.2))
+                except mlu.empty_exception:
+                    break
+            for params_dict in reversed(params_dicts):
+                cost_dict = self.test_landscape.get_cost_dict(params_dict['params'])
+                cost_dict[mli.run_index_key] = params_dict[mli.run_index_key]
+                self.costs_in_queue.put(cost_dict)
+
+class LandscapeBatchInterface(mli.BatchInterface):
+    '''
+    Batch interface that evaluates the test landscape and records the size of each batch.
+    '''
+    def __init__(self, **kwargs):
+        super(LandscapeBatchInterface,self).__init__(**kwargs)
+        self.test_landscape = mlt.TestLandscape(num_params=2)
+        self.batch_sizes = []
+    def get_next_cost_dicts(self, params_dicts):
+        self.batch_sizes.append(len(params_dicts))
+        return [self.test_landscape.get_cost_dict(params_dict['params']) for params_dict in params_dicts]
+
+def _read_run_store(run_store, runs_queue, grown_event):
+    '''
+    Read the runs in a SharedRunStore before and after the store is grown, in another process.
+    '''
+    cursor = 0
+    for _ in range(2):
+        (params, costs, uncers, bads) = run_store.read(cursor)
+        cursor += costs.size
+        runs_queue.put((params.tolist(), costs.tolist(), uncers.tolist(), bads.tolist()))
+        del params, costs, uncers, bads
+        grown_event.wait(60)
+    run_store.close()
+
 class TestUnits(unittest.TestCase):
     
     def test_max_num_runs(self):
@@ -63,6 +123,83 @@ class TestUnits(unittest.TestCase):
         self.assertTrue(np.array_equiv(np.array(controller.in_costs),
                                         np.array(cost_list)))
     
+    def test_max_in_flight(self):
+        num_runs = 24
+        interface = ReversingInterface(4)
+        controller = mlc.create_controller(interface,
+                                           controller_type='gaussian_process',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=num_runs,
+                                           target_cost=-1,
+                                           predict_global_minima_at_end=False,
+                                           controller_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        self.assertEqual(controller.max_in_flight, 4)
+        controller.optimize()
+        self.assertEqual(controller.num_in_costs, num_runs)
+        self.assertEqual(controller.num_out_params, num_runs)
+        self.assertEqual(len(controller.in_costs), num_runs)
+        # Every run has a cost, and some arrived out of order.
+        self.assertEqual(sorted(controller.in_run_indexs), list(range(num_runs)))
+        self.assertNotEqual(list(controller.in_run_indexs), list(range(num_runs)))
+        # Each cost is paired with the parameters that produced it.
+        for cost, run_index in zip(controller.in_costs, controller.in_run_indexs):
+            self.assertEqual(cost, interface.test_landscape.get_cost_dict(controller.out_params[run_index])['cost'])
+        best_cost = min(controller.in_costs)
+        self.assertEqual(controller.best_cost, best_cost)
+        self.assertEqual(controller.in_costs[controller.best_index-1], best_cost)
+    
+    def test_batch_interface_machine_learner(self):
+        num_runs = 24
+        interface = LandscapeBatchInterface(batch_size=4)
+        controller = mlc.create_controller(interface,
+                                           controller_type='gaussian_process',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=num_runs,
+                                           target_cost=-1,
+                                           predict_global_minima_at_end=False,
+                                           controller_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        controller.optimize()
+        self.assertEqual(controller.num_in_costs, num_runs)
+        self.assertEqual(sum(interface.batch_sizes), num_runs)
+        # The machine learner runs are evaluated in batches.
+        self.assertLessEqual(max(interface.batch_sizes), 4)
+        self.assertGreater(max(interface.batch_sizes), 1)
+        for cost, run_index in zip(controller.in_costs, controller.in_run_indexs):
+            self.assertEqual(cost, interface.test_landscape.get_cost_dict(controller.out_params[run_index])['cost'])
+    
+    def test_batch_interface_random(self):
+        num_runs = 5
+        batch_wait = 2.
+        interface = LandscapeBatchInterface(batch_size=4, batch_wait=batch_wait)
+        controller = mlc.create_controller(interface,
+                                           controller_type='random',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=num_runs,
+                                           target_cost=-1,
+                                           controller_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        start_time = time.time()
+        controller.optimize()
+        elapsed_time = time.time() - start_time
+        self.assertEqual(controller.num_in_costs, num_runs)
+        # The random controller only has one run in flight, so each batch has
+        # a single run and the interface does not wait for more.
+        self.assertEqual(interface.batch_sizes, [1] * num_runs)
+        self.assertLess(elapsed_time, num_runs * batch_wait / 2)
+        np.testing.assert_array_equal(controller.best_params,
+                                      controller.out_params[controller.in_run_indexs[controller.best_index-1]])
+    
     def test_bad(self):
         cost_list = [1., float('nan'),2.,float('nan'),-1.]
         interface = CostListInterface(cost_list)
@@ -75,6 +212,1094 @@ class TestUnits(unittest.TestCase):
         for x,y in zip(controller.in_costs,cost_list):
             self.assertTrue(x==y or (math.isnan(x) and math.isnan(y)))
     
+    def test_lazy_imports(self):
+        # TensorFlow and matplotlib are slow to import, so they should only be
+        # imported when a neural net or a plot is needed.
+        package_dir = os.path.dirname(os.path.abspath(mlu.mloop_path))
+        code = ("import sys, mloop.controllers, mloop.learners\n"
+                "print(','.join(name for name in ('tensorflow', 'matplotlib') if name in sys.modules))")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = package_dir + os.pathsep + env.get('PYTHONPATH', '')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=tempfile.gettempdir())
+        self.assertEqual(output.decode().strip(), '')
+    
+def _tensorflow_installed():
+    try:
+        import tensorflow
+    except ImportError:
+        return False
+    return True
+
+class TestShellInterfaces(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        # The shell script imports mloop, so make sure the commands can find it.
+        cls.pythonpath = os.environ.get('PYTHONPATH')
+        package_dir = os.path.dirname(os.path.abspath(mlu.mloop_path))
+        os.environ['PYTHONPATH'] = package_dir + os.pathsep + (cls.pythonpath or '')
+        cls.script = os.path.join(package_dir, 'tests', 'shell_script.py')
+        cls.test_landscape = mlt.TestLandscape()
+    
+    @classmethod
+    def tearDownClass(cls):
+        if cls.pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = cls.pythonpath
+    
+    def evaluate(self, interface, all_params):
+        '''
+        Run the interface on each set of parameters, tagged with its run index, and return the cost dicts by run index.
+        '''
+        for run_index, params in enumerate(all_params):
+            interface.params_out_queue.put({'params':params, mli.run_index_key:run_index})
+        interface.start()
+        cost_dicts = {}
+        try:
+            for _ in all_params:
+                cost_dict = interface.costs_in_queue.get(True, 60)
+                cost_dicts[cost_dict.pop(mli.run_index_key)] = cost_dict
+        finally:
+            interface.end_event.set()
+            interface.join()
+        return cost_dicts
+    
+    def assert_costs_correct(self, cost_dicts, all_params):
+        self.assertEqual(sorted(cost_dicts), list(range(len(all_params))))
+        for run_index, params in enumerate(all_params):
+            self.assertAlmostEqual(cost_dicts[run_index]['cost'], self.test_landscape.get_cost_dict(params)['cost'])
+    
+    def test_parallel_shell_interface(self):
+        all_params = [np.array([0.1*i, -0.2*i]) for i in range(6)]
+        interface = mli.ParallelShellInterface(command=sys.executable + ' ' + self.script, num_workers=3, interface_wait=0.1, log_filename=None)
+        self.assertEqual(interface.max_parallel_runs, 3)
+        self.assert_costs_correct(self.evaluate(interface, all_params), all_params)
+    
+    def test_parallel_shell_interface_failed_command(self):
+        all_params = [np.array([0.1*i, -0.2*i]) for i in range(4)]
+        interface = mli.ParallelShellInterface(command=sys.executable + ' -c exit(1)', num_workers=2, interface_wait=0.1, log_filename=None)
+        cost_dicts = self.evaluate(interface, all_params)
+        self.assertEqual(sorted(cost_dicts), list(range(len(all_params))))
+        for cost_dict in cost_dicts.values():
+            self.assertEqual(cost_dict, {'bad':True})
+    
+    def test_persistent_worker(self):
+        all_params = [np.array([0.1*i, -0.2*i]) for i in range(4)]
+        interface = mli.ShellInterface(command=sys.executable + ' ' + self.script + ' --persistent', persistent_worker=True, interface_wait=0.1, log_filename=None)
+        workers = []
+        run_worker = interface._run_worker
+        def recording_run_worker(params):
+            cli_return = run_worker(params)
+            workers.append(interface.thread_workers.worker)
+            return cli_return
+        interface._run_worker = recording_run_worker
+        self.assert_costs_correct(self.evaluate(interface, all_params), all_params)
+        # A single worker evaluated every run, and was stopped with the interface.
+        self.assertEqual(len(set(workers)), 1)
+        self.assertEqual(workers[0].returncode, 0)
+    
+    def test_parallel_persistent_workers(self):
+        all_params = [np.array([0.1*i, -0.2*i]) for i in range(8)]
+        interface = mli.ParallelShellInterface(command=sys.executable + ' ' + self.script + ' --persistent', persistent_worker=True, num_workers=2, interface_wait=0.1, log_filename=None)
+        self.assert_costs_correct(self.evaluate(interface, all_params), all_params)
+        self.assertEqual(interface.workers, [])
+    
+    def test_persistent_worker_restarted(self):
+        # The worker ends without returning a cost, so every run is bad and a new worker is started for the next one.
+        all_params = [np.array([0.1*i, -0.2*i]) for i in range(3)]
+        interface = mli.ParallelShellInterface(command=sys.executable + ' -c pass', persistent_worker=True, num_workers=1, interface_wait=0.1, log_filename=None)
+        popen = mli.sp.Popen
+        started = []
+        def recording_popen(*args, **kwargs):
+            started.append(popen(*args, **kwargs))
+            return started[-1]
+        mli.sp.Popen = recording_popen
+        try:
+            cost_dicts = self.evaluate(interface, all_params)
+        finally:
+            mli.sp.Popen = popen
+        self.assertEqual(cost_dicts, {0:{'bad':True}, 1:{'bad':True}, 2:{'bad':True}})
+        self.assertEqual(len(started), 3)
+    
+class TestFileWatcher(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'exp_output.txt')
+        self.start_inotify = mlu.FileWatcher._start_inotify
+    
+    def tearDown(self):
+        mlu.FileWatcher._start_inotify = self.start_inotify
+        shutil.rmtree(self.dirname)
+    
+    def write_file(self, text='cost = 1.'):
+        with open(self.filename, 'w') as in_file:
+            in_file.write(text)
+    
+    def disable_inotify(self):
+        def start_inotify(watcher):
+            raise OSError('inotify disabled for testing')
+        mlu.FileWatcher._start_inotify = start_inotify
+    
+    def test_old_events_ignored(self):
+        watcher = mlu.FileWatcher(self.filename, write_wait=0)
+        if not watcher.inotify:
+            self.skipTest('inotify is not available')
+        try:
+            self.assertFalse(watcher.wait(0.05))
+            # A file that is closed twice while it is written gives two events.
+            # The second is still pending once the file has been read and
+            # removed, and must not wake the watcher for the next file.
+            self.write_file('cost = ')
+            self.assertTrue(watcher.wait(1))
+            with open(self.filename, 'a') as in_file:
+                in_file.write('1.')
+            os.remove(self.filename)
+            self.assertFalse(watcher.wait(0.05))
+            self.write_file()
+            self.assertTrue(watcher.wait(1))
+        finally:
+            watcher.close()
+    
+    def test_polling_fallback(self):
+        self.disable_inotify()
+        watcher = mlu.FileWatcher(self.filename, write_wait=0)
+        self.assertFalse(watcher.inotify)
+        self.assertFalse(watcher.wait(0.05))
+        self.write_file()
+        self.assertTrue(watcher.wait(0.05))
+    
+    def test_interface_polls_without_inotify(self):
+        self.disable_inotify()
+        interface = mli.FileInterface(interface_out_filename=os.path.join(self.dirname, 'exp_input'),
+                                      interface_in_filename=os.path.join(self.dirname, 'exp_output'),
+                                      watch_in_file=True,
+                                      interface_wait=0.05,
+                                      log_filename=None,
+                                      console_log_level=logging.WARNING)
+        self.assertFalse(interface.in_file_watcher.inotify)
+        def experiment():
+            time.sleep(0.2)
+            self.write_file('cost = 2.5\nuncer = 0.1')
+        writer = threading.Thread(target=experiment)
+        writer.start()
+        cost_dict = interface.get_next_cost_dict({'params':np.array([0.5])})
+        writer.join()
+        self.assertEqual(cost_dict, {'cost':2.5, 'uncer':0.1})
+        self.assertFalse(os.path.isfile(self.filename))
+        np.testing.assert_array_equal(mlu.get_dict_from_file(os.path.join(self.dirname, 'exp_input.txt'))['params'], [0.5])
+    
+class TestAtomicFileHandoff(unittest.TestCase):
+    
+    def setUp(self):
+        # The fake experiment uses the default file names in the working directory.
+        self.cwd = os.getcwd()
+        self.dirname = tempfile.mkdtemp()
+        os.chdir(self.dirname)
+        self.dict_to_txt_file = mlu.dict_to_txt_file
+        self.get_dict_from_file = mlu.get_dict_from_file
+    
+    def tearDown(self):
+        mlu.dict_to_txt_file = self.dict_to_txt_file
+        mlu.get_dict_from_file = self.get_dict_from_file
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dirname)
+    
+    def test_fake_experiment(self):
+        written_keys = {}
+        read_dicts = []
+        lock = threading.Lock()
+        def slow_dict_to_txt_file(tdict, filename):
+            # Write one entry at a time, so a file read while it is being
+            # written is missing entries.
+            name = os.path.basename(filename)
+            if name.startswith(mlu.temp_file_prefix):
+                name = name[len(mlu.temp_file_prefix):]
+            with lock:
+                written_keys[name] = sorted(tdict)
+            with open(filename, 'w') as out_file:
+                for key in tdict:
+                    out_file.write(str(key) + '=' + repr(tdict[key]).replace('\n', '') + '\n')
+                    out_file.flush()
+                    time.sleep(0.1)
+        def recording_get_dict_from_file(filename, file_type=None):
+            tdict = self.get_dict_from_file(filename, file_type)
+            with lock:
+                read_dicts.append((os.path.basename(filename), sorted(tdict), written_keys.get(os.path.basename(filename))))
+            return tdict
+        mlu.dict_to_txt_file = slow_dict_to_txt_file
+        mlu.get_dict_from_file = recording_get_dict_from_file
+        experiment = mlt.FakeExperiment(poll_wait=0.01, atomic_file_handoff=True)
+        interface = mli.FileInterface(interface_wait=0.01,
+                                      atomic_file_handoff=True,
+                                      log_filename=None,
+                                      console_log_level=logging.WARNING)
+        controller = mlc.create_controller(interface,
+                                           controller_type='random',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=4,
+                                           target_cost=-1,
+                                           controller_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        experiment.start()
+        try:
+            controller.optimize()
+        finally:
+            experiment.end_event.set()
+            experiment.join()
+        self.assertEqual(controller.num_in_costs, 4)
+        for cost, params in zip(controller.in_costs, controller.out_params):
+            # The params are rounded when they are written to the text file.
+            self.assertAlmostEqual(cost, experiment.test_landscape.get_cost_dict(params)['cost'], places=6)
+        # Each file was complete when it was read, and no temporary files are left.
+        self.assertEqual(len(read_dicts), 8)
+        for (name, keys, expected_keys) in read_dicts:
+            self.assertEqual(keys, expected_keys, msg=name)
+        self.assertEqual([name for name in os.listdir(self.dirname) if name.startswith(mlu.temp_file_prefix)], [])
+    
+class TestControllerArchive(unittest.TestCase):
+    
+    def optimize(self, controller_type, **kwargs):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type=controller_type,
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           target_cost=-1,
+                                           controller_archive_file_type='txt',
+                                           controller_archive_journal=True,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING,
+                                           **kwargs)
+        controller.optimize()
+        return controller
+    
+    def assert_journal_matches_archive(self, controller):
+        archive_dict = mlu.get_dict_from_file(controller.total_archive_filename)
+        self.assertFalse(archive_dict['archive_is_summary'])
+        journal_dict = mlu.get_dict_from_controller_journal(controller.total_journal_filename)
+        for key in journal_dict:
+            np.testing.assert_equal(journal_dict[key], archive_dict[key], err_msg=key)
+    
+    def test_journal_for_each_controller_type(self):
+        for controller_type in ['random', 'nelder_mead', 'differential_evolution']:
+            controller = self.optimize(controller_type, max_num_runs=10)
+            self.assertEqual(controller.out_type, [controller_type])
+            self.assert_journal_matches_archive(controller)
+        controller = self.optimize('gaussian_process', max_num_runs=15, no_delay=False,
+                                   predict_global_minima_at_end=False)
+        self.assertEqual(len(controller.out_type), 15)
+        self.assert_journal_matches_archive(controller)
+    
+    def test_journal_round_trip(self):
+        controller = self.optimize('random', max_num_runs=10)
+        full_dict = mlu.get_dict_from_file(controller.total_archive_filename)
+        # Replace the archive with its summary and cut the last line of the
+        # journal short, as if the controller had not ended cleanly.
+        summary_dict = {key:value for key,value in full_dict.items() if key not in mlc.journal_keys}
+        summary_dict['archive_is_summary'] = True
+        mlu.save_dict_to_file(summary_dict, controller.total_archive_filename)
+        with open(controller.total_journal_filename, 'a') as journal_file:
+            journal_file.write("record='in', run_index=10, cost=")
+        archive_dict = mlu.get_controller_archive_dict(controller.total_archive_filename)
+        self.assertFalse(archive_dict['archive_is_summary'])
+        self.assertEqual(set(archive_dict), set(full_dict))
+        for key in full_dict:
+            np.testing.assert_equal(archive_dict[key], full_dict[key], err_msg=key)
+    
+    def test_journal_summary_interval(self):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type='random',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           controller_archive_file_type='txt',
+                                           controller_archive_journal=True,
+                                           controller_archive_summary_interval=3,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        summaries = []
+        for num_in_costs in range(1,11):
+            controller.num_in_costs = num_in_costs
+            controller.save_archive()
+            summaries.append(controller.num_in_costs_at_summary)
+        controller.archive_writer.close()
+        self.assertEqual(summaries, [1,1,1,4,4,4,7,7,7,10])
+        summary_dict = mlu.get_dict_from_file(controller.total_archive_filename)
+        self.assertTrue(summary_dict['archive_is_summary'])
+        self.assertEqual(summary_dict['num_in_costs'], 10)
+        for key in mlc.journal_keys:
+            self.assertNotIn(key, summary_dict)
+    
+    @unittest.skipUnless(_tensorflow_installed(), 'TensorFlow is not installed')
+    def test_journal_for_neural_net(self):
+        controller = self.optimize('neural_net', max_num_runs=45, no_delay=False,
+                                   predict_global_minima_at_end=False)
+        self.assert_journal_matches_archive(controller)
+    
+class TestGrowableArray(unittest.TestCase):
+    
+    def test_append_past_capacity(self):
+        growable = mlu.GrowableArray((2,), initial_capacity=2)
+        self.assertEqual(growable.view.shape, (0, 2))
+        for row in range(11):
+            growable.append([row, -row])
+        self.assertEqual(len(growable), 11)
+        np.testing.assert_array_equal(growable.view, [[row, -row] for row in range(11)])
+        growable.extend(np.zeros((0, 2)))
+        growable.extend([[11, -11], [12, -12]])
+        np.testing.assert_array_equal(growable.view, [[row, -row] for row in range(13)])
+        self.assertEqual(growable.view.dtype, float)
+    
+    def test_views_after_growth(self):
+        growable = mlu.GrowableArray.from_array([1., 2.])
+        view = growable.view
+        # Growing the storage copies the rows, so the old view is not changed
+        # and only sees the rows it was taken with.
+        growable.extend(np.arange(3., 100.))
+        growable.append(100.)
+        np.testing.assert_array_equal(view, [1., 2.])
+        np.testing.assert_array_equal(growable.view, np.arange(1., 101.))
+        # A view taken without growth shares the storage.
+        growable = mlu.GrowableArray((), initial_capacity=4)
+        growable.extend([1., 2.])
+        view = growable.view
+        growable.append(3.)
+        self.assertTrue(np.shares_memory(view, growable.view))
+        np.testing.assert_array_equal(view, [1., 2.])
+    
+    def test_learner_run_arrays(self):
+        learner = mll.RandomLearner(num_params=2,
+                                    min_boundary=[-1.,-1.],
+                                    max_boundary=[1.,1.],
+                                    learner_archive_filename=None)
+        self.assertEqual(learner.all_params.shape, (0, 2))
+        self.assertEqual(learner.all_costs.shape, (0,))
+        self.assertEqual(learner.all_uncers.shape, (0,))
+        num_runs = 40
+        for run in range(num_runs):
+            learner._update_run_data_attributes(np.array([run, -run]), run**2, 0.1*run, False)
+        for (array, shape) in [(learner.all_params, (num_runs, 2)),
+                               (learner.all_costs, (num_runs,)),
+                               (learner.all_uncers, (num_runs,))]:
+            self.assertIsInstance(array, np.ndarray)
+            self.assertEqual(array.shape, shape)
+            self.assertEqual(array.dtype, float)
+        np.testing.assert_array_equal(learner.all_params, [[run, -run] for run in range(num_runs)])
+        np.testing.assert_array_equal(learner.all_costs, [run**2 for run in range(num_runs)])
+        np.testing.assert_array_equal(learner.all_uncers, [0.1*run for run in range(num_runs)])
+        learner.all_params = [[1, 2], [3, 4]]
+        learner.all_costs = [[5], [6]]
+        self.assertEqual(learner.all_params.shape, (2, 2))
+        self.assertEqual(learner.all_params.dtype, float)
+        self.assertEqual(learner.all_costs.shape, (2,))
+    
+@unittest.skipIf(mlu.shared_memory is None, 'Shared memory requires python 3.8 or later')
+class TestSharedRunStore(unittest.TestCase):
+    
+    def append_runs(self, run_store, first, last):
+        for run in range(first, last):
+            run_store.append([run, -run], run**2, 0.1*run, run % 3 == 0)
+    
+    def assert_runs_equal(self, runs, first, last):
+        expected = list(range(first, last))
+        self.assertEqual(runs[0], [[run, -run] for run in expected])
+        self.assertEqual(runs[1], [run**2 for run in expected])
+        self.assertEqual(runs[2], [0.1*run for run in expected])
+        self.assertEqual(runs[3], [float(run % 3 == 0) for run in expected])
+    
+    def read_in_process(self, start_method):
+        context = mp.get_context(start_method)
+        run_store = mlu.SharedRunStore(2, initial_capacity=2)
+        try:
+            self.append_runs(run_store, 0, 3)
+            runs_queue = context.Queue()
+            grown_event = context.Event()
+            reader = context.Process(target=_read_run_store, args=(run_store, runs_queue, grown_event))
+            reader.start()
+            self.assert_runs_equal(runs_queue.get(timeout=60), 0, 3)
+            # Grow the columns twice while the reader is attached to the old ones.
+            self.append_runs(run_store, 3, 10)
+            grown_event.set()
+            self.assert_runs_equal(runs_queue.get(timeout=60), 3, 10)
+            reader.join(60)
+            self.assertEqual(reader.exitcode, 0)
+            self.assertEqual(run_store.num_runs, 10)
+        finally:
+            run_store.close()
+        with self.assertRaises(FileNotFoundError):
+            mlu.shared_memory.SharedMemory(name=run_store.name)
+    
+    def test_spawn(self):
+        self.read_in_process('spawn')
+    
+    @unittest.skipUnless('fork' in mp.get_all_start_methods(), 'fork is not available')
+    def test_fork(self):
+        self.read_in_process('fork')
+    
+    def test_controller_frees_store(self):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type='gaussian_process',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=14,
+                                           target_cost=-1,
+                                           predict_global_minima_at_end=False,
+                                           controller_archive_filename=None,
+                                           learner_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        run_store = controller.run_store
+        self.assertIsNotNone(run_store)
+        controller.optimize()
+        for name in [run_store.name, run_store.name + '_0']:
+            with self.assertRaises(FileNotFoundError):
+                mlu.shared_memory.SharedMemory(name=name)
+    
+class TestGaussianProcess(unittest.TestCase):
+    
+    def make_learner(self, num_runs, num_params=2, min_boundary=None, max_boundary=None, fit=True, **kwargs):
+        np.random.seed(0)
+        kwargs.setdefault('update_hyperparameters', False)
+        learner = mll.GaussianProcessLearner(num_params=num_params,
+                                             min_boundary=-np.ones(num_params) if min_boundary is None else min_boundary,
+                                             max_boundary=np.ones(num_params) if max_boundary is None else max_boundary,
+                                             learner_archive_filename=None,
+                                             **kwargs)
+        learner.log = logging.getLogger(__name__)
+        self.set_runs(learner, np.random.uniform(-1, 1, size=(num_runs, num_params)))
+        if fit:
+            learner.fit_gaussian_process()
+        return learner
+    
+    def set_runs(self, learner, params):
+        learner.all_params = params
+        learner.all_costs = np.sum(params**2, axis=1) + 0.1 * np.sin(5 * params[:,0])
+        learner.all_uncers = 0.01 * np.ones(params.shape[0])
+        learner.costs_count = params.shape[0]
+        learner.best_params = params[np.argmin(learner.all_costs)]
+    
+    def test_update_matches_full_fit(self):
+        learner = self.make_learner(20)
+        new_params = np.random.uniform(-1, 1, size=(5, 2))
+        self.set_runs(learner, np.concatenate((learner.all_params, new_params)))
+        self.assertTrue(learner.update_gaussian_process())
+        updated = learner.gaussian_process
+        refitted = skg.GaussianProcessRegressor(alpha=updated.alpha, kernel=updated.kernel_, optimizer=None)
+        refitted.fit(updated.X_train_, updated.y_train_)
+        np.testing.assert_allclose(updated.L_, refitted.L_, rtol=0, atol=1e-10)
+        np.testing.assert_allclose(updated.alpha_, refitted.alpha_, rtol=0, atol=1e-10)
+        self.assertAlmostEqual(updated.log_marginal_likelihood_value_, refitted.log_marginal_likelihood_value_, places=8)
+        test_params = np.random.uniform(-1, 1, size=(10, 2))
+        for (updated_values, refitted_values) in zip(updated.predict(test_params, return_std=True),
+                                                     refitted.predict(test_params, return_std=True)):
+            np.testing.assert_allclose(updated_values, refitted_values, rtol=0, atol=1e-10)
+    
+    def test_gradients_match_finite_differences(self):
+        learner = self.make_learner(20)
+        learner.update_bias_function()
+        params = np.random.uniform(-1, 1, size=(10, 2))
+        (pred_costs, pred_uncers, cost_gradients, uncer_gradients) = learner.predict_costs_and_gradients(params, return_std=True)
+        (expected_costs, expected_uncers) = learner.gaussian_process.predict(params, return_std=True)
+        np.testing.assert_allclose(pred_costs, expected_costs, rtol=0, atol=1e-10)
+        np.testing.assert_allclose(pred_uncers, expected_uncers, rtol=0, atol=1e-10)
+        biased_gradients = learner.predict_biased_costs_and_gradients(params)[1]
+        step = 1e-6
+        for k in range(params.shape[1]):
+            shift = np.zeros(params.shape[1])
+            shift[k] = step
+            (upper_costs, upper_uncers) = learner.gaussian_process.predict(params + shift, return_std=True)
+            (lower_costs, lower_uncers) = learner.gaussian_process.predict(params - shift, return_std=True)
+            np.testing.assert_allclose(cost_gradients[:,k], (upper_costs - lower_costs) / (2 * step), rtol=0, atol=1e-8)
+            np.testing.assert_allclose(uncer_gradients[:,k], (upper_uncers - lower_uncers) / (2 * step), rtol=0, atol=1e-8)
+            upper_biased = learner.cost_bias * upper_costs - learner.uncer_bias * upper_uncers
+            lower_biased = learner.cost_bias * lower_costs - learner.uncer_bias * lower_uncers
+            np.testing.assert_allclose(biased_gradients[:,k], (upper_biased - lower_biased) / (2 * step), rtol=0, atol=1e-8)
+    
+    def test_minimize_batch_respects_boundaries(self):
+        # The minimum of the function is outside the boundaries, and some starts are too.
+        min_boundary = np.array([-1., 0.])
+        max_boundary = np.array([1., 0.5])
+        minimum = np.array([3., -2.])
+        func = lambda params: (np.sum((params - minimum)**2, axis=1), 2 * (params - minimum))
+        start_params = np.array([[0., 0.25], [-5., 5.], [0.9, 0.1], [2., -1.]])
+        (found_params, found_costs) = mlu.minimize_batch(func, start_params, min_boundary, max_boundary)
+        self.assertEqual(found_params.shape, start_params.shape)
+        self.assertTrue(np.all(found_params >= min_boundary))
+        self.assertTrue(np.all(found_params <= max_boundary))
+        np.testing.assert_allclose(found_params, np.tile([1., 0.], (4, 1)), atol=1e-6)
+        np.testing.assert_allclose(found_costs, func(found_params)[0])
+    
+    def test_next_parameters_within_boundaries(self):
+        # The best runs are outside the boundaries.
+        min_boundary = np.array([0.2, -1.])
+        max_boundary = np.array([1., -0.5])
+        learner = self.make_learner(20, min_boundary=min_boundary, max_boundary=max_boundary)
+        for _ in range(4):
+            next_params = learner.find_next_parameters()
+            self.assertTrue(np.all(next_params >= min_boundary))
+            self.assertTrue(np.all(next_params <= max_boundary))
+    
+    def test_local_fit_runs(self):
+        learner = self.make_learner(30, local_fit_runs=10)
+        distances = np.sum(((learner.all_params - learner.best_params) / learner.length_scale)**2, axis=1)
+        nearest = np.sort(np.argsort(distances)[:10])
+        np.testing.assert_array_equal(learner.fit_run_indexs, nearest)
+        np.testing.assert_array_equal(learner.gaussian_process.X_train_, learner.all_params[nearest])
+        self.assertIn(np.argmin(learner.all_costs), nearest)
+        # Adding a run fits from scratch to the nearest runs again.
+        self.set_runs(learner, np.concatenate((learner.all_params, [[0.01, 0.01]])))
+        learner.fit_gaussian_process()
+        self.assertEqual(learner.gaussian_process.X_train_.shape, (10, 2))
+        self.assertIn(30, learner.fit_run_indexs)
+    
+    def test_local_fit_runs_with_fewer_runs(self):
+        learner = self.make_learner(6, local_fit_runs=10)
+        np.testing.assert_array_equal(learner.fit_run_indexs, np.arange(6))
+        np.testing.assert_array_equal(learner.gaussian_process.X_train_, learner.all_params)
+        learner.update_bias_function()
+        params = np.random.uniform(-1, 1, size=(3, 2))
+        (pred_costs, cost_gradients) = learner.predict_costs_and_gradients(params)
+        np.testing.assert_allclose(pred_costs, learner.gaussian_process.predict(params), rtol=0, atol=1e-10)
+        self.assertEqual(cost_gradients.shape, (3, 2))
+        next_params = learner.find_next_parameters()
+        self.assertEqual(next_params.shape, (2,))
+        self.assertTrue(np.all(np.isfinite(next_params)))
+    
+    def test_lie_runs_removed_after_batch(self):
+        learner = self.make_learner(20, fit=False, batch_acquisition=True, generation_num=4,
+                                    predict_global_minima_at_end=False)
+        for (params, cost, uncer) in zip(learner.all_params, learner.all_costs, learner.all_uncers):
+            learner.costs_in_queue.put((params, cost, uncer, False))
+        learner.all_params = []
+        learner.all_costs = []
+        learner.all_uncers = []
+        learner.costs_count = 0
+        before_batch = {}
+        find_next_parameters = learner.find_next_parameters
+        def record_and_find_next_parameters():
+            if not before_batch:
+                gaussian_process = learner.gaussian_process
+                before_batch.update({'all_params':learner.all_params.copy(),
+                                     'all_costs':learner.all_costs.copy(),
+                                     'X_train_':gaussian_process.X_train_.copy(),
+                                     'y_train_':gaussian_process.y_train_.copy(),
+                                     'alpha':gaussian_process.alpha.copy(),
+                                     'L_':gaussian_process.L_.copy(),
+                                     'alpha_':gaussian_process.alpha_.copy()})
+            return find_next_parameters()
+        learner.find_next_parameters = record_and_find_next_parameters
+        learner.new_params_event.set()
+        runner = threading.Thread(target=learner.run)
+        runner.start()
+        batch = np.array([learner.params_out_queue.get(timeout=60) for _ in range(4)])
+        learner.end_event.set()
+        runner.join(60)
+        self.assertFalse(runner.is_alive())
+        gaussian_process = learner.gaussian_process
+        after_batch = {'all_params':learner.all_params,
+                       'all_costs':learner.all_costs,
+                       'X_train_':gaussian_process.X_train_,
+                       'y_train_':gaussian_process.y_train_,
+                       'alpha':gaussian_process.alpha,
+                       'L_':gaussian_process.L_,
+                       'alpha_':gaussian_process.alpha_}
+        for (key, value) in before_batch.items():
+            self.assertEqual(after_batch[key].shape, value.shape, msg=key)
+            np.testing.assert_array_equal(after_batch[key], value, err_msg=key)
+        # The lie runs push the parameters in a batch apart.
+        distances = np.sqrt(np.sum((batch[:,np.newaxis,:] - batch[np.newaxis,:,:])**2, axis=2))
+        self.assertGreater(np.min(distances[np.triu_indices(4, 1)]), 0.15)
+    
+    def hyperparameter_update_runs(self, **kwargs):
+        # Add one run at a time and record the numbers of runs at which the
+        # hyperparameters were fitted.
+        learner = self.make_learner(20, fit=False, update_hyperparameters=True, **kwargs)
+        all_params = learner.all_params.copy()
+        for num_runs in range(5, 21):
+            self.set_runs(learner, all_params[:num_runs])
+            learner.fit_gaussian_process()
+        return [index + 1 for index in learner.update_hyperparameters_history]
+    
+    def test_hyperparameter_update_schedule(self):
+        for (schedule, update_runs) in [(1, list(range(5, 21))),
+                                        (3, [5, 8, 11, 14, 17, 20]),
+                                        (7, [5, 12, 19]),
+                                        ('geometric', [5, 8, 12, 18])]:
+            self.assertEqual(self.hyperparameter_update_runs(update_hyperparameters_schedule=schedule),
+                             update_runs, msg=repr(schedule))
+    
+    def test_hyperparameter_update_threshold(self):
+        for (threshold, update_runs) in [(None, [10]), (1000., [10]), (0.5, [10, 20])]:
+            learner = self.make_learner(10,
+                                        update_hyperparameters=True,
+                                        update_hyperparameters_schedule=1000,
+                                        update_hyperparameters_threshold=threshold)
+            # Costs that do not follow the landscape of the first runs lower
+            # the log marginal likelihood per run with the old hyperparameters.
+            new_params = np.random.uniform(-1, 1, size=(10, 2))
+            self.set_runs(learner, np.concatenate((learner.all_params, new_params)))
+            learner.all_costs = np.concatenate((learner.all_costs[:10], np.random.uniform(0, 2, size=10)))
+            learner.fit_gaussian_process()
+            self.assertEqual([index + 1 for index in learner.update_hyperparameters_history], update_runs)
+    
+    def test_hyperparameter_seed(self):
+        fitted = []
+        for _ in range(2):
+            learner = self.make_learner(20,
+                                        update_hyperparameters=True,
+                                        hyperparameter_workers=2,
+                                        hyperparameter_searches=3,
+                                        hyperparameter_seed=5)
+            pool = learner.hyperparameter_pool
+            self.assertIsNotNone(pool)
+            fitted.append((learner.length_scale, learner.noise_level))
+            learner._shut_down()
+            self.assertIsNone(learner.hyperparameter_pool)
+            for worker in pool._pool:
+                worker.join(10)
+                self.assertFalse(worker.is_alive())
+        np.testing.assert_array_equal(fitted[0][0], fitted[1][0])
+        self.assertEqual(fitted[0][1], fitted[1][1])
+    
+    def test_pool_stopped_when_learner_fails(self):
+        learner = self.make_learner(20,
+                                    fit=False,
+                                    update_hyperparameters=True,
+                                    hyperparameter_workers=2,
+                                    predict_global_minima_at_end=False)
+        for (params, cost, uncer) in zip(learner.all_params, learner.all_costs, learner.all_uncers):
+            learner.costs_in_queue.put((params, cost, uncer, False))
+        learner.all_params = []
+        learner.all_costs = []
+        learner.all_uncers = []
+        learner.costs_count = 0
+        learner.new_params_event.set()
+        pools = []
+        def find_next_parameters():
+            pools.append(learner.hyperparameter_pool)
+            raise RuntimeError('Failed to find the next parameters')
+        learner.find_next_parameters = find_next_parameters
+        with self.assertRaises(RuntimeError):
+            learner.run()
+        self.assertIsNotNone(pools[0])
+        self.assertIsNone(learner.hyperparameter_pool)
+        for worker in pools[0]._pool:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+    
+@unittest.skipUnless(_tensorflow_installed(), 'TensorFlow is not installed')
+class TestNeuralNetLearner(unittest.TestCase):
+    # TensorFlow cannot be used in a forked process once it has run a session,
+    # so these tests, which fork the learner, run before TestNeuralNetTraining.
+    
+    def make_learner(self, **kwargs):
+        return mll.NeuralNetLearner(num_params=2,
+                                    min_boundary=[-1.,-1.],
+                                    max_boundary=[1.,1.],
+                                    learner_archive_filename=None,
+                                    **kwargs)
+    
+    def test_training_time_split_between_nets(self):
+        self.assertIsNone(self.make_learner()._net_deadline())
+        for (training_workers, net_training_time) in [(1, 2.), (2, 4.), (5, 6.)]:
+            learner = self.make_learner(training_workers=training_workers, max_training_time=6.)
+            self.assertEqual(learner.num_nets, 3)
+            start = time.time()
+            deadline = learner._net_deadline()
+            self.assertGreaterEqual(deadline, start + net_training_time)
+            self.assertLess(deadline, time.time() + net_training_time + 1e-3)
+    
+    def test_several_training_workers(self):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type='neural_net',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=45,
+                                           target_cost=-1,
+                                           no_delay=False,
+                                           training_workers=2,
+                                           max_training_time=5.,
+                                           predict_global_minima_at_end=False,
+                                           controller_archive_filename=None,
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        controller.optimize()
+        self.assertEqual(controller.num_in_costs, 45)
+        self.assertIn('neural_net', controller.out_type)
+        self.assertEqual(controller.best_cost, min(controller.in_costs))
+    
+@unittest.skipUnless(_tensorflow_installed(), 'TensorFlow is not installed')
+class TestNeuralNetTraining(unittest.TestCase):
+    
+    def make_net(self, train_threshold_ratio=0.1, validation_fraction=0.):
+        import mloop.neuralnet as mlnn
+        return mlnn.SingleNeuralNet(2, [16]*2, [mlnn._gelu_fast]*2,
+                                    train_threshold_ratio,
+                                    8, # batch_size
+                                    1., # keep_prob
+                                    0.01, # regularisation_coefficient
+                                    [],
+                                    validation_fraction=validation_fraction)
+    
+    def setUp(self):
+        np.random.seed(0)
+        self.params = np.random.uniform(-1, 1, size=(40, 2))
+        self.costs = np.sum(self.params**2, axis=1)
+    
+    def test_fit_reduces_loss(self):
+        for validation_fraction in [0., 0.25]:
+            net = self.make_net(validation_fraction=validation_fraction)
+            net.init()
+            initial_loss = net._loss(self.params, self.costs)[1]
+            net.fit(self.params, self.costs, 20)
+            self.assertLess(net._loss(self.params, self.costs)[1], 0.2 * initial_loss)
+            self.assertGreater(len(net.losses_list), 0)
+            net.destroy()
+    
+    def test_fit_steps_once_per_batch(self):
+        net = self.make_net()
+        net.init()
+        net.tf_session.run(net.train_epochs, feed_dict={net.input_placeholder: self.params,
+                                                        net.output_placeholder: self.costs[:,np.newaxis],
+                                                        net.epochs_placeholder: 3})
+        with net.graph.as_default():
+            import mloop.neuralnet as mlnn
+            beta1_power = [v for v in mlnn.tf.global_variables() if 'beta1_power' in v.name][0]
+        # Adam multiplies beta1_power by 0.9, starting from 0.9, for each of the 3*5 steps.
+        self.assertAlmostEqual(net.tf_session.run(beta1_power), 0.9**16, places=5)
+        net.destroy()
+    
+    def test_fit_without_improvement_threshold(self):
+        # With a ratio of 1 the threshold is zero, so training stops before the first block of epochs.
+        net = self.make_net(train_threshold_ratio=1., validation_fraction=0.25)
+        net.init()
+        net.fit(self.params, self.costs, 20)
+        self.assertEqual(net.losses_list, [])
+        net.destroy()
+    
+    def test_numpy_predictions_match_tensorflow(self):
+        import mloop.neuralnet as mlnn
+        # Use the layout and activations of the nets the learner trains.
+        net = mlnn.NeuralNet(num_params=2)
+        net.init()
+        net.fit_neural_net(self.params, self.costs)
+        test_params = np.random.uniform(-1, 1, size=(50, 2))
+        for single_net in net.net.nets:
+            self.assertTrue(single_net.numpy_inference)
+            numpy_costs, numpy_gradients = single_net.predict_costs_and_gradients(test_params)
+            numpy_cost = single_net.predict_cost(test_params[0])
+            numpy_gradient = single_net.predict_cost_gradient(test_params[0])
+            single_net.numpy_inference = False
+            tf_costs, tf_gradients = single_net.predict_costs_and_gradients(test_params)
+            np.testing.assert_allclose(numpy_costs, tf_costs, rtol=0, atol=1e-5)
+            np.testing.assert_allclose(numpy_gradients, tf_gradients, rtol=0, atol=1e-4)
+            np.testing.assert_allclose(numpy_costs, single_net.predict_costs(test_params), rtol=0, atol=1e-5)
+            self.assertAlmostEqual(numpy_cost, single_net.predict_cost(test_params[0]), places=5)
+            np.testing.assert_allclose(numpy_gradient, single_net.predict_cost_gradient(test_params[0]), rtol=0, atol=1e-4)
+            # The gradients are not all zero, so the comparison is meaningful.
+            self.assertGreater(np.max(np.abs(tf_gradients)), 1e-2)
+        net.destroy()
+    
+    def test_regularisation_fit_in_background(self):
+        import mloop.neuralnet as mlnn
+        net = mlnn.NeuralNet(num_params=2,
+                             fit_hyperparameters=True,
+                             hyperparameter_workers=2,
+                             hyperparameter_fit_in_background=True)
+        net.init()
+        release = threading.Event()
+        def fit_candidate(candidate, reg, *args):
+            # Only the candidate with a regularisation coefficient of 0.1 does
+            # significantly better than the current net.
+            release.wait(60)
+            candidate.set_regularisation_coefficient(reg)
+            candidate.init()
+            return 0. if reg == 0.1 else float('inf')
+        net._fit_candidate = fit_candidate
+        original_net = net.net
+        # The first fit starts the regularisation fit and returns without waiting for it.
+        net.fit_neural_net(self.params, self.costs)
+        self.assertIsNotNone(net.pending_hyperfit)
+        self.assertIs(net.net, original_net)
+        net.fit_neural_net(self.params, self.costs)
+        self.assertIs(net.net, original_net)
+        release.set()
+        net.pending_hyperfit[1].wait(60)
+        # The next fit swaps in the best candidate and keeps the others as spares.
+        net.fit_neural_net(self.params, self.costs)
+        self.assertIsNone(net.pending_hyperfit)
+        self.assertIsNot(net.net, original_net)
+        self.assertEqual(net.last_net_reg, 0.1)
+        self.assertEqual(len(net.spare_nets), len(net.regularisation_candidates))
+        self.assertTrue(any(spare is original_net for spare in net.spare_nets))
+        self.assertTrue(np.isfinite(net.predict_cost(self.params[0])))
+        net.destroy()
+        self.assertEqual(net.spare_nets, [])
+        self.assertIsNone(net.hyperparameter_pool)
+    
+class TestArchiveWriter(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'archive.txt')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def test_close_writes_latest_snapshot(self):
+        writer = mlu.ArchiveWriter(self.filename, 'txt')
+        runs = []
+        for run in range(50):
+            runs.append(run)
+            writer.save({'num_runs':len(runs), 'runs':runs})
+        runs.append(50)
+        writer.close()
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(mlu.get_dict_from_file(self.filename), {'num_runs':50, 'runs':list(range(50))})
+        # Saving after the writer is closed writes straight away.
+        writer.save({'num_runs':51, 'runs':runs})
+        self.assertEqual(mlu.get_dict_from_file(self.filename)['num_runs'], 51)
+    
+    def test_owner_thread_ends(self):
+        writers = []
+        def save():
+            writers.append(mlu.ArchiveWriter(self.filename, 'txt'))
+            writers[0].save({'a':1})
+        owner = threading.Thread(target=save)
+        owner.start()
+        owner.join()
+        writers[0].join(10)
+        self.assertFalse(writers[0].is_alive())
+        self.assertEqual(mlu.get_dict_from_file(self.filename), {'a':1})
+    
+    def test_controller_saves_final_archive(self):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type='random',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=10,
+                                           target_cost=-1,
+                                           controller_archive_file_type='txt',
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        controller.optimize()
+        self.assertFalse(controller.archive_writer.is_alive())
+        archive_dict = mlu.get_dict_from_file(controller.total_archive_filename)
+        self.assertEqual(archive_dict['num_in_costs'], 10)
+        self.assertEqual(len(archive_dict['in_costs']), 10)
+        self.assertEqual(archive_dict['best_cost'], controller.best_cost)
+    
+def _h5py_installed():
+    try:
+        import h5py
+    except ImportError:
+        return False
+    return True
+
+@unittest.skipUnless(_h5py_installed(), 'h5py is not installed')
+class TestH5Archive(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'archive.h5')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def assert_dicts_equal(self, new_dict, tdict):
+        self.assertEqual(sorted(new_dict), sorted(tdict))
+        for key, value in tdict.items():
+            self.assertEqual(type(new_dict[key]), type(value), msg=key)
+            np.testing.assert_equal(new_dict[key], value, err_msg=key)
+    
+    def mark_datasets(self):
+        # Datasets that are rewritten rather than appended to lose the mark.
+        import h5py
+        with h5py.File(self.filename, 'a') as h5_file:
+            for key in h5_file:
+                h5_file[key].attrs['marked'] = True
+    
+    def marked_keys(self):
+        import h5py
+        with h5py.File(self.filename, 'r') as h5_file:
+            return sorted(key for key in h5_file if 'marked' in h5_file[key].attrs)
+    
+    def test_archive_round_trip(self):
+        interface = mli.TestInterface(log_filename=None)
+        controller = mlc.create_controller(interface,
+                                           controller_type='gaussian_process',
+                                           num_params=2,
+                                           min_boundary=[-1.,-1.],
+                                           max_boundary=[1.,1.],
+                                           max_num_runs=14,
+                                           target_cost=-1,
+                                           predict_global_minima_at_end=False,
+                                           controller_archive_filename=os.path.join(self.dirname, 'controller_archive'),
+                                           controller_archive_file_type='pkl',
+                                           learner_archive_filename=os.path.join(self.dirname, 'learner_archive'),
+                                           learner_archive_file_type='pkl',
+                                           log_filename=None,
+                                           console_log_level=logging.WARNING)
+        controller.optimize()
+        for archive_filename in [controller.total_archive_filename, controller.ml_learner.total_archive_filename]:
+            archive_dict = mlu.get_dict_from_file(archive_filename)
+            mlu.dict_to_h5_file(archive_dict, self.filename)
+            new_dict = mlu.get_dict_from_file(self.filename)
+            self.assertIsInstance(new_dict, mlu.H5Dict)
+            self.assert_dicts_equal(new_dict, archive_dict)
+        self.assertEqual(mlu.get_dict_from_file(self.filename)['archive_type'], 'gaussian_process_learner')
+    
+    def test_append_in_place(self):
+        tdict = {'in_costs':[1., 2.],
+                 'all_params':np.array([[0., 1.], [2., 3.]]),
+                 'out_type':['random', 'gaussian_process'],
+                 'num_in_costs':2}
+        mlu.dict_to_h5_file(tdict, self.filename)
+        self.mark_datasets()
+        for run in range(2, 40):
+            tdict['in_costs'].append(float(run))
+            tdict['all_params'] = np.concatenate((tdict['all_params'], [[2.*run, 2.*run+1]]))
+            tdict['out_type'].append('gaussian_process')
+            tdict['num_in_costs'] = run + 1
+            mlu.dict_to_h5_file(tdict, self.filename)
+        self.assert_dicts_equal(mlu.get_dict_from_file(self.filename), tdict)
+        # The history is appended to, and only the other values are rewritten.
+        self.assertEqual(self.marked_keys(), ['all_params', 'in_costs', 'out_type'])
+        import h5py
+        with h5py.File(self.filename, 'r') as h5_file:
+            self.assertEqual(h5_file['all_params'].shape, (40, 2))
+            self.assertEqual(h5_file['all_params'].maxshape, (None, 2))
+    
+    def test_rewrite_when_value_changes(self):
+        tdict = {'in_costs':[1., 2.],
+                 'all_params':np.array([[0., 1.], [2., 3.]]),
+                 'all_costs':np.array([1., 2.]),
+                 'out_type':['random', 'random'],
+                 'in_uncers':[0.1, 0.2],
+                 'removed':1}
+        mlu.dict_to_h5_file(tdict, self.filename)
+        self.mark_datasets()
+        # A change of type, of the shape of the rows, and of an item already
+        # saved each need the value to be rewritten, and removed keys are deleted.
+        tdict = {'in_costs':[1., 2., 'bad'],
+                 'all_params':np.array([[0., 1., 2.], [3., 4., 5.], [6., 7., 8.]]),
+                 'all_costs':np.array([1., 5., 3.]),
+                 'out_type':['random', 'nelder_mead', 'random'],
+                 'in_uncers':[0.1, 0.2, 0.3]}
+        mlu.dict_to_h5_file(tdict, self.filename)
+        self.assert_dicts_equal(mlu.get_dict_from_file(self.filename), tdict)
+        self.assertEqual(self.marked_keys(), ['in_uncers'])
+        # Values that shrink are rewritten too.
+        tdict['in_uncers'] = [0.1]
+        mlu.dict_to_h5_file(tdict, self.filename)
+        self.assert_dicts_equal(mlu.get_dict_from_file(self.filename), tdict)
+    
+    def test_h5_dict(self):
+        tdict = {'a':np.arange(5.), 'b':'text', 'c':None, 'd':{'e':1}}
+        mlu.save_dict_to_file(tdict, self.filename, 'h5')
+        h5_dict = mlu.get_dict_from_file(self.filename)
+        self.assertEqual(len(h5_dict), 4)
+        self.assertEqual(sorted(h5_dict), ['a', 'b', 'c', 'd'])
+        self.assertIn('b', h5_dict)
+        self.assertNotIn('f', h5_dict)
+        # Values are only read when they are first accessed.
+        self.assertEqual(h5_dict._values, {})
+        self.assertEqual(h5_dict['b'], 'text')
+        self.assertEqual(list(h5_dict._values), ['b'])
+        with self.assertRaises(KeyError):
+            h5_dict['f']
+        h5_dict['a'] = 1
+        h5_dict['f'] = 2
+        del h5_dict['c']
+        self.assertEqual(dict(h5_dict), {'a':1, 'b':'text', 'd':{'e':1}, 'f':2})
+        # Changing the dict does not change the file.
+        self.assert_dicts_equal(mlu.get_dict_from_file(self.filename), tdict)
+    
+class TestTxtParser(unittest.TestCase):
+    
+    def assert_arrays_equal(self, x, y):
+        self.assertEqual(x.dtype, y.dtype)
+        self.assertEqual(x.shape, y.shape)
+        for a,b in zip(x.ravel(),y.ravel()):
+            self.assertEqual(a, b)
+    
+    def test_ragged_arrays(self):
+        tdict = mlu.txt_string_to_dict('a=array([[1],[2,3,4]], dtype=object)\nb=array([[1,2],3], dtype=object)')
+        self.assert_arrays_equal(tdict['a'], np.array([[1],[2,3,4]], dtype=object))
+        self.assertEqual(tdict['b'].shape, (2,))
+        self.assertEqual(tdict['b'][0], [1,2])
+        self.assertEqual(tdict['b'][1], 3)
+    
+    def test_python_literals(self):
+        tdict = mlu.txt_string_to_dict("a=(1.+2.j)\nb=0x10\nc=1_000\nd='ab' \"cd\"\ne=0o17, f=0b101, g=1.5e-1_0, h=-2j")
+        self.assertEqual(tdict, {'a':1+2j, 'b':16, 'c':1000, 'd':'abcd', 'e':15, 'f':5, 'g':1.5e-10, 'h':-2j})
+    
+    def test_archive_dtypes_round_trip(self):
+        arrays = {'float64':np.array([[1.5,float('nan')],[float('inf'),-2.]]),
+                  'float32':np.array([1.5,0.1],dtype=np.float32),
+                  'int64':np.array([1,-2],dtype=np.int64),
+                  'int32':np.array([1,-2],dtype=np.int32),
+                  'uint8':np.array([1,2],dtype=np.uint8),
+                  'bool':np.array([True,False]),
+                  'complex128':np.array([1.+2.j,3.-float('inf')*1j]),
+                  'str':np.array(['ab','c']),
+                  'object':np.array([1,'a',None],dtype=object),
+                  'empty':np.array([]),
+                  'empty_2d':np.zeros((0,3)),
+                  'big':np.arange(-1500,1500).reshape(1000,3)/8.}
+        scalars = {'np_float64':np.float64(0.1),
+                   'np_float32':np.float32(0.5),
+                   'np_int64':np.int64(3),
+                   'np_bool':np.bool_(True),
+                   'np_complex128':np.complex128(1-2.5j),
+                   'float':0.1,
+                   'int':3,
+                   'complex':1+2j,
+                   'none':None,
+                   'str':"it's",
+                   'bytes':b'x',
+                   'list':[1,2.5,'a',[None]],
+                   'tuple':(1,),
+                   'dict':{'a':1.,'b':[2]}}
+        tdict = dict(arrays)
+        tdict.update(('scalar_'+key,value) for key,value in scalars.items())
+        tdict['nan'] = float('nan')
+        tdict['inf'] = -float('inf')
+        new_dict = mlu.txt_string_to_dict(mlu.dict_to_txt_line(tdict))
+        self.assertEqual(set(new_dict), set(tdict))
+        for key,value in arrays.items():
+            self.assertEqual(new_dict[key].dtype, value.dtype)
+            self.assertEqual(new_dict[key].shape, value.shape)
+            self.assertTrue(np.all((new_dict[key] == value) | (value != value)))
+        for key,value in scalars.items():
+            self.assertEqual(new_dict['scalar_'+key], value)
+            self.assertEqual(np.dtype(type(new_dict['scalar_'+key])).kind, np.dtype(type(value)).kind)
+        self.assertTrue(math.isnan(new_dict['nan']))
+        self.assertEqual(new_dict['inf'], -float('inf'))
+    
+    def test_object_array_round_trip(self):
+        ragged = np.empty(2, dtype=object)
+        ragged[0] = [1]
+        ragged[1] = [2,3,4]
+        mixed = np.array([1, 'a', None, 2.5], dtype=object)
+        tdict = {'ragged':ragged, 'mixed':mixed, 'regular':np.array([[1,2],[3,4]])}
+        new_dict = mlu.txt_string_to_dict(mlu.dict_to_txt_line(tdict))
+        for key in tdict:
+            self.assert_arrays_equal(new_dict[key], tdict[key])
+    
 if __name__ == "__main__":
     mp.freeze_support()
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the time the file interface takes to hand each set of parameters to an experiment and read back its cost, when polling for the file of costs and when watching for it, with and without the atomic file handoff. The experiment responds immediately, so the times are the overhead of the handoff. Runs in a temporary directory.')
+parser.add_argument("-n","--num_runs",type=int,default=10,help="number of runs for each mode")
+parser.add_argument("-w","--interface_wait",type=float,default=1,help="interface_wait of the file interface")
+args = parser.parse_args()
+
+import os
+import tempfile
+import threading
+import time
+import logging
+import numpy as np
+import mloop.interfaces as mli
+import mloop.utilities as mlu
+import mloop.testing as mlt
+
+class ImmediateExperiment(threading.Thread):
+    '''
+    Experiment that writes the cost as soon as it has read the parameters.
+    '''
+    def __init__(self, atomic_file_handoff):
+        super(ImmediateExperiment,self).__init__()
+        self.atomic_file_handoff = atomic_file_handoff
+        self.daemon = True
+        self.end_event = threading.Event()
+        self.test_landscape = mlt.TestLandscape()
+        self.in_filename = mlu.default_interface_out_filename + '.txt'
+        self.out_filename = mlu.default_interface_in_filename + '.txt'
+        self.watcher = mlu.FileWatcher(self.in_filename, write_wait=0)
+
+    def run(self):
+        while not self.end_event.is_set():
+            if not self.watcher.wait(0.01):
+                continue
+            try:
+                in_dict = mlu.get_dict_from_file(self.in_filename, 'txt')
+            except IOError:
+                continue
+            os.remove(self.in_filename)
+            mlu.save_dict_to_file(self.test_landscape.get_cost_dict(in_dict['params']), self.out_filename, 'txt', atomic=self.atomic_file_handoff)
+        self.watcher.close()
+
+def time_runs(watch_in_file, atomic_file_handoff):
+    experiment = ImmediateExperiment(atomic_file_handoff)
+    interface = mli.FileInterface(watch_in_file=watch_in_file, atomic_file_handoff=atomic_file_handoff, interface_wait=args.interface_wait, log_filename=None, console_log_level=logging.WARNING)
+    experiment.start()
+    interface.start()
+    times = []
+    for _ in range(args.num_runs):
+        start = time.time()
+        interface.params_out_queue.put({'params':np.random.random(3)})
+        interface.costs_in_queue.get()
+        times.append(time.time() - start)
+    interface.end_event.set()
+    experiment.end_event.set()
+    interface.join()
+    experiment.join()
+    return np.array(times)
+
+os.chdir(tempfile.mkdtemp())
+for watch_in_file, atomic_file_handoff in [(False, False), (False, True), (True, False), (True, True)]:
+    times = time_runs(watch_in_file, atomic_file_handoff)
+    print('watch_in_file=' + str(watch_in_file) + ', atomic_file_handoff=' + str(atomic_file_handoff) + ': mean {:.4f} s, median {:.4f} s, max {:.4f} s per run'.format(np.mean(times), np.median(times), np.max(times)))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the time the Gaussian process learner takes to find the next parameters for different numbers of parameters, with the batched search of find_next_parameters, which uses the analytic gradient of the biased cost, with a separate scipy search from each start using the analytic gradient, and with separate scipy searches using gradients estimated by finite differences.')
+parser.add_argument("-p","--num_params",type=int,nargs='+',default=[1,2,4,8,16],help="numbers of parameters to test")
+parser.add_argument("-r","--num_runs",type=int,default=100,help="number of runs the Gaussian process is fitted to")
+parser.add_argument("-n","--num_searches",type=int,default=4,help="number of sets of next parameters to find for each number of parameters")
+args = parser.parse_args()
+
+import logging
+import time
+import numpy as np
+import scipy.optimize as so
+import mloop.learners as mll
+import mloop.testing as mlt
+
+def find_next_parameters_scipy(learner, analytic_gradient):
+    '''
+    The search of find_next_parameters with a separate scipy search from each start.
+    '''
+    learner.params_count += 1
+    learner.update_bias_function()
+    learner.update_search_params()
+    next_params = None
+    next_cost = float('inf')
+    for start_params in learner.search_params:
+        if analytic_gradient:
+            result = so.minimize(lambda params: tuple(value[0] for value in learner.predict_biased_costs_and_gradients(params[np.newaxis,:])), start_params, jac=True, bounds = learner.search_region, tol=learner.search_precision)
+        else:
+            result = so.minimize(learner.predict_biased_cost, start_params, bounds = learner.search_region, tol=learner.search_precision)
+        if result.fun < next_cost:
+            next_params = result.x
+            next_cost = result.fun
+    return next_params
+
+def time_searches(learner, find_next_parameters):
+    np.random.seed(0)
+    learner.params_count = 0
+    start = time.time()
+    for _ in range(args.num_searches):
+        find_next_parameters()
+    return (time.time() - start) / args.num_searches
+
+for num_params in args.num_params:
+    test_landscape = mlt.TestLandscape(num_params=num_params)
+    learner = mll.GaussianProcessLearner(num_params=num_params, min_boundary=-np.ones(num_params), max_boundary=np.ones(num_params), update_hyperparameters=False, learner_archive_filename=None)
+    learner.log = logging.getLogger(__name__)
+    learner.all_params = np.random.uniform(-1, 1, size=(args.num_runs, num_params))
+    learner.all_costs = np.array([test_landscape.get_cost_dict(params)['cost'] for params in learner.all_params])
+    learner.all_uncers = 0.01 * np.ones(args.num_runs)
+    learner.costs_count = args.num_runs
+    learner.best_params = learner.all_params[np.argmin(learner.all_costs)]
+    learner.fit_gaussian_process()
+    batched_time = time_searches(learner, learner.find_next_parameters)
+    analytic_time = time_searches(learner, lambda: find_next_parameters_scipy(learner, True))
+    finite_difference_time = time_searches(learner, lambda: find_next_parameters_scipy(learner, False))
+    print('num_params={}: batched {:.3f} s, analytic gradient {:.3f} s, finite differences {:.3f} s per set of next parameters'.format(num_params, batched_time, analytic_time, finite_difference_time))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the time learners take to add runs to their history arrays all_params, all_costs and all_uncers, which are growable arrays whose capacity is doubled when full. Runs are added one at a time, as the random, Nelder-Mead and differential evolution learners do, and a generation at a time from a shared run store, as the machine learning learners do. For comparison, also times growing plain arrays by copying them for every run, as the learners used to, for a smaller number of runs.')
+parser.add_argument("-n","--num_runs",type=int,default=100000,help="number of runs added to the learner")
+parser.add_argument("-c","--copy_num_runs",type=int,default=10000,help="number of runs added by copying the arrays for every run")
+parser.add_argument("-p","--num_params",type=int,default=4,help="number of parameters of each run")
+parser.add_argument("-g","--generation_num",type=int,default=4,help="number of runs read by the machine learning learner at a time")
+args = parser.parse_args()
+
+import logging
+import time
+import numpy as np
+import mloop.learners as mll
+import mloop.utilities as mlu
+
+logging.basicConfig(level=logging.ERROR)
+num_params = args.num_params
+min_boundary = -np.ones(num_params)
+max_boundary = np.ones(num_params)
+params = np.random.uniform(-1, 1, size=(args.num_runs, num_params))
+costs = np.random.uniform(size=args.num_runs)
+
+learner = mll.Learner(num_params=num_params, min_boundary=min_boundary, max_boundary=max_boundary, learner_archive_filename=None)
+start = time.time()
+for index in range(args.num_runs):
+    learner._update_run_data_attributes(params[index], costs[index], 0.1, False)
+single_time = time.time() - start
+assert learner.all_params.shape == (args.num_runs, num_params)
+print('{} runs added one at a time: {:.3f} s, {:.2f} us per run'.format(args.num_runs, single_time, 1e6 * single_time / args.num_runs))
+
+all_params = np.array([params[0]])
+all_costs = np.array([costs[0]])
+all_uncers = np.array([0.1])
+start = time.time()
+for index in range(1, args.copy_num_runs):
+    all_params = np.append(all_params, np.array([params[index]]), axis=0)
+    all_costs = np.append(all_costs, np.array([costs[index]]), axis=0)
+    all_uncers = np.append(all_uncers, np.array([0.1]), axis=0)
+copy_time = time.time() - start
+print('{} runs added one at a time by copying the arrays: {:.3f} s, {:.2f} us per run'.format(args.copy_num_runs, copy_time, 1e6 * copy_time / args.copy_num_runs))
+
+if mlu.shared_memory is not None:
+    learner = mll.GaussianProcessLearner(num_params=num_params, min_boundary=min_boundary, max_boundary=max_boundary, learner_archive_filename=None)
+    learner.log = logging.getLogger(__name__)
+    learner.run_store = mlu.SharedRunStore(num_params)
+    read_time = 0
+    for index in range(args.num_runs):
+        learner.run_store.append(params[index], costs[index], 0.1, False)
+        if (index + 1) % args.generation_num == 0 or index + 1 == args.num_runs:
+            start = time.time()
+            learner.get_params_and_costs()
+            read_time += time.time() - start
+    learner.run_store.close()
+    assert learner.all_params.shape == (args.num_runs, num_params)
+    print('{} runs read from a shared run store {} at a time: {:.3f} s, {:.2f} us per run'.format(args.num_runs, args.generation_num, read_time, 1e6 * read_time / args.num_runs))
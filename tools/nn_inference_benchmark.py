@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the time the neural net learner takes to find the next parameters, with the neural nets evaluated by NumPy from their exported weights and with them evaluated by TensorFlow session runs. Also reports the largest differences between the costs and gradients predicted by the two.')
+parser.add_argument("-p","--num_params",type=int,nargs='+',default=[2,4,8],help="numbers of parameters to test")
+parser.add_argument("-r","--num_runs",type=int,default=100,help="number of runs the neural nets are fitted to")
+parser.add_argument("-n","--num_searches",type=int,default=4,help="number of sets of next parameters to find for each number of parameters")
+args = parser.parse_args()
+
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+import mloop.learners as mll
+import mloop.testing as mlt
+
+def set_numpy_inference(learner, numpy_inference):
+    for neural_net in learner.neural_net:
+        for single_net in neural_net.net.nets:
+            single_net.numpy_inference = numpy_inference
+
+def time_searches(learner, numpy_inference):
+    set_numpy_inference(learner, numpy_inference)
+    np.random.seed(0)
+    start = time.time()
+    for search in range(args.num_searches):
+        learner.find_next_parameters(search % learner.num_nets)
+    return (time.time() - start) / args.num_searches
+
+logging.basicConfig(level=logging.ERROR)
+os.chdir(tempfile.mkdtemp())
+for num_params in args.num_params:
+    test_landscape = mlt.TestLandscape(num_params=num_params)
+    learner = mll.NeuralNetLearner(num_params=num_params, min_boundary=-np.ones(num_params), max_boundary=np.ones(num_params))
+    learner.log = logging.getLogger(__name__)
+    learner.all_params = np.random.uniform(-1, 1, size=(args.num_runs, num_params))
+    learner.all_costs = np.array([test_landscape.get_cost_dict(params)['cost'] for params in learner.all_params])
+    learner.all_uncers = 0.01 * np.ones(args.num_runs)
+    learner.costs_count = args.num_runs
+    learner.best_params = learner.all_params[np.argmin(learner.all_costs)]
+    learner.create_neural_net()
+    learner.cost_scaler_init_index = args.num_runs
+    learner._init_cost_scaler()
+    for net_index in range(learner.num_nets):
+        learner._fit_neural_net(net_index)
+    test_params = np.random.uniform(-1, 1, size=(1000, num_params))
+    set_numpy_inference(learner, False)
+    (tf_costs, tf_gradients) = learner.predict_costs_and_gradients(test_params, 0)
+    set_numpy_inference(learner, True)
+    (numpy_costs, numpy_gradients) = learner.predict_costs_and_gradients(test_params, 0)
+    tensorflow_time = time_searches(learner, False)
+    numpy_time = time_searches(learner, True)
+    print('num_params={}: NumPy {:.4f} s, TensorFlow {:.4f} s per set of next parameters, largest differences cost {:.1e} gradient {:.1e}'.format(
+        num_params, numpy_time, tensorflow_time, np.max(np.abs(numpy_costs - tf_costs)), np.max(np.abs(numpy_gradients - tf_gradients))))
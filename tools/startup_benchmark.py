@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import argparse
+
+parser = argparse.ArgumentParser(description='Measure the time taken to import mloop.controllers and then to create a controller of each type, each in a fresh python interpreter. Also lists which of the slow optional packages, TensorFlow and matplotlib, were imported. Runs in a temporary directory.')
+parser.add_argument("-n","--num_repeats",type=int,default=3,help="number of times each measurement is repeated")
+args = parser.parse_args()
+
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+controller_types = ['random', 'nelder_mead', 'differential_evolution', 'gaussian_process', 'neural_net']
+
+measure_script = '''
+import sys
+import time
+import logging
+start = time.time()
+import mloop.controllers as mlc
+import mloop.interfaces as mli
+import_time = time.time() - start
+controller_type = sys.argv[1]
+if controller_type:
+    start = time.time()
+    interface = mli.TestInterface(log_filename=None, console_log_level=logging.WARNING)
+    controller = mlc.create_controller(interface, controller_type=controller_type, num_params=2, min_boundary=[-1,-1], max_boundary=[1,1], log_filename=None, console_log_level=logging.WARNING)
+    create_time = time.time() - start
+else:
+    create_time = 0
+print(import_time, create_time, ','.join(module for module in ('tensorflow','matplotlib') if module in sys.modules))
+'''
+
+def measure(controller_type):
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = package_dir + os.pathsep + env.get('PYTHONPATH', '')
+    import_times = []
+    create_times = []
+    for _ in range(args.num_repeats):
+        output = subprocess.check_output([sys.executable, '-c', measure_script, controller_type], env=env, stderr=subprocess.DEVNULL)
+        words = output.decode().split()
+        import_times.append(float(words[0]))
+        create_times.append(float(words[1]))
+        imported = words[2] if len(words) > 2 else 'none'
+    return np.median(import_times), np.median(create_times), imported
+
+os.chdir(tempfile.mkdtemp())
+import_time, _, imported = measure('')
+print('import mloop.controllers: {:.3f} s, slow packages imported: {}'.format(import_time, imported))
+for controller_type in controller_types:
+    import_time, create_time, imported = measure(controller_type)
+    print(controller_type + ': import {:.3f} s, create_controller {:.3f} s, slow packages imported: {}'.format(import_time, create_time, imported))